@@ -0,0 +1,206 @@
+"""Admission control in front of the router.
+
+Expensive routes get limits per caller role: a cap on requests in flight and
+a token bucket refilled at ``rate`` per second up to ``burst``, counted per
+user, per role or for the route as a whole. A request over a limit is answered
+straight away instead of queueing: 429 when the caller exceeded its rate, 503
+when the route is at its concurrency limit, both with ``Retry-After``. Routes
+without a rule, such as the ``/me`` lookups dashboards need to render, are
+never held back.
+
+Counters live in an AdmissionStore. MemoryAdmissionStore keeps them in the
+process, so with several workers each enforces its own share; a store backed
+by a shared service (Redis, for example) implements the same three calls to
+enforce limits across workers.
+"""
+import json
+import math
+import os
+import re
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from codec import dumpb
+from metrics import registry
+
+requests_shed = registry.counter(
+    "http_requests_shed_total", "Requests rejected by admission control by route template, role and reason",
+    ["route", "role", "reason"]
+)
+
+# Defaults: bcrypt-bound auth, candidate scans and the whole-pool views. Auth
+# calls are anonymous and often arrive through one proxy address, so they are
+# only capped in flight; authenticated callers also get per-user rates.
+DEFAULT_RULES = [
+    {"route": "POST /api/auth/login", "concurrency": 64},
+    {"route": "POST /api/auth/register", "concurrency": 32},
+    {"route": "GET /api/matches/potential", "concurrency": 128, "rate": 50, "burst": 100},
+    {"route": "GET /api/matches/matrix", "concurrency": 4, "rate": 1, "burst": 5},
+    {"route": "GET /api/allocations", "concurrency": 4, "rate": 1, "burst": 5},
+    {"route": "POST /api/matches/batch", "concurrency": 8, "rate": 2, "burst": 10},
+    {"route": "GET /api/donors", "roles": ["hospital"], "concurrency": 32, "rate": 20, "burst": 40},
+    {"route": "GET /api/recipients", "roles": ["hospital"], "concurrency": 32, "rate": 20, "burst": 40},
+    {"route": "POST /api/registry/{registry}/import", "concurrency": 2},
+    {"route": "GET /api/registry/{registry}/export", "concurrency": 4},
+]
+
+
+class AdmissionRule:
+    """Limits of one route (``"METHOD /path/{param}"``) for the listed roles, ``*`` for any"""
+
+    def __init__(self, route: str, roles: Optional[List[str]] = None, concurrency: Optional[int] = None,
+                 rate: Optional[float] = None, burst: Optional[float] = None, per: str = "user"):
+        if per not in ("user", "role", "route"):
+            raise ValueError(f"Unknown admission scope: {per}")
+        self.method, _, self.path = route.partition(" ")
+        self.route = route
+        self.roles = set(roles or ["*"])
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.per = per
+        self._pattern = re.compile("^" + re.sub(r"\\{[^/]+?\\}", "[^/]+", re.escape(self.path)) + "$")
+
+    def matches(self, method: str, path: str) -> bool:
+        return method == self.method and self._pattern.match(path) is not None
+
+    def applies_to(self, role: str) -> bool:
+        return "*" in self.roles or role in self.roles
+
+    def rate_key(self, role: str, subject: str) -> str:
+        scope = {"user": f"{role}:{subject}", "role": role, "route": "*"}[self.per]
+        return f"{self.route}|{scope}"
+
+    def concurrency_key(self, role: str) -> str:
+        # In-flight requests are capped per role, or for everyone with per="route"
+        return f"{self.route}|{'*' if self.per == 'route' else role}"
+
+
+class AdmissionStore:
+    """Counter backend; every call is awaited so implementations may do I/O"""
+
+    async def take_token(self, key: str, rate: float, burst: float) -> float:
+        """Take a token from the bucket, returning 0, or the seconds until one is available"""
+        raise NotImplementedError
+
+    async def enter(self, key: str, limit: int) -> bool:
+        """Count a request in flight unless ``limit`` are already"""
+        raise NotImplementedError
+
+    async def leave(self, key: str):
+        raise NotImplementedError
+
+
+class MemoryAdmissionStore(AdmissionStore):
+    # Idle buckets are dropped once there are this many
+    MAX_BUCKETS = 100_000
+
+    def __init__(self):
+        self.buckets: Dict[str, Tuple[float, float, float, float]] = {}  # key -> (tokens, last refill, rate, burst)
+        self.in_flight: Dict[str, int] = {}
+
+    async def take_token(self, key: str, rate: float, burst: float) -> float:
+        now = time.monotonic()
+        tokens, last, _, _ = self.buckets.get(key, (burst, now, rate, burst))
+        tokens = min(burst, tokens + (now - last) * rate)
+        if len(self.buckets) >= self.MAX_BUCKETS and key not in self.buckets:
+            self._prune(now)
+        if tokens >= 1:
+            self.buckets[key] = (tokens - 1, now, rate, burst)
+            return 0.0
+        self.buckets[key] = (tokens, now, rate, burst)
+        return (1 - tokens) / rate if rate > 0 else math.inf
+
+    def _prune(self, now: float):
+        # A bucket that has refilled is the same as no bucket
+        for key in [key for key, (tokens, last, rate, burst) in self.buckets.items() if tokens + (now - last) * rate >= burst]:
+            del self.buckets[key]
+
+    async def enter(self, key: str, limit: int) -> bool:
+        count = self.in_flight.get(key, 0)
+        if count >= limit:
+            return False
+        self.in_flight[key] = count + 1
+        return True
+
+    async def leave(self, key: str):
+        count = self.in_flight.get(key, 0) - 1
+        if count > 0:
+            self.in_flight[key] = count
+        else:
+            self.in_flight.pop(key, None)
+
+    def stats(self) -> dict:
+        return {"buckets": len(self.buckets), "in_flight": sum(self.in_flight.values())}
+
+
+class AdmissionMiddleware:
+    """ASGI middleware applying AdmissionRules.
+
+    ``identify(scope)`` returns the caller's ``(role, subject)``; it is only
+    called for requests to a limited route, and must be cheap (the API decodes
+    the JWT without a database lookup).
+    """
+
+    def __init__(self, app, rules: List[AdmissionRule], identify: Callable[[dict], Tuple[str, str]],
+                 store: Optional[AdmissionStore] = None):
+        self.app = app
+        self.rules = rules
+        self.identify = identify
+        self.store = store or MemoryAdmissionStore()
+
+    @staticmethod
+    def rules_from_env() -> List[AdmissionRule]:
+        # ADMISSION_RULES is a JSON list shaped like DEFAULT_RULES, replacing it
+        raw = os.environ.get('ADMISSION_RULES')
+        return [AdmissionRule(**rule) for rule in (json.loads(raw) if raw else DEFAULT_RULES)]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        rules = [rule for rule in self.rules if rule.matches(scope["method"], scope["path"])]
+        if not rules:
+            await self.app(scope, receive, send)
+            return
+        role, subject = self.identify(scope)
+        rule = next((rule for rule in rules if rule.applies_to(role)), None)
+        if rule is None:
+            await self.app(scope, receive, send)
+            return
+
+        state = scope.setdefault("state", {})
+        state.setdefault("role", role)
+        state["route_template"] = rule.path
+
+        if rule.rate is not None:
+            wait = await self.store.take_token(rule.rate_key(role, subject), rule.rate, rule.burst)
+            if wait > 0:
+                await self._reject(send, rule, role, 429, "rate", wait)
+                return
+        if rule.concurrency is None:
+            await self.app(scope, receive, send)
+            return
+        concurrency_key = rule.concurrency_key(role)
+        if not await self.store.enter(concurrency_key, rule.concurrency):
+            await self._reject(send, rule, role, 503, "concurrency", 1)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            await self.store.leave(concurrency_key)
+
+    async def _reject(self, send, rule: AdmissionRule, role: str, status: int, reason: str, retry_after: float):
+        requests_shed.inc(route=rule.path, role=role, reason=reason)
+        detail = "Too many requests, slow down" if status == 429 else "Server is busy, please retry shortly"
+        body = dumpb({"detail": detail})
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, math.ceil(retry_after)) if retry_after != math.inf else 60).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
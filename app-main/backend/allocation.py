@@ -0,0 +1,207 @@
+import asyncio
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from codec import parse_date
+from compatibility import BLOOD_COMPATIBILITY, BLOOD_TYPES, CompatibilityIndex, compatibility_score
+
+# Priority of a recipient: urgency dominates, then time on the waiting list,
+# then the blood type score of the donor they are paired with
+URGENCY_POINTS = {"low": 0, "medium": 2000, "high": 4000, "critical": 6000}
+POINTS_PER_WAITING_DAY = 1
+MAX_WAITING_POINTS = 1825
+
+
+def recipient_priority(recipient: dict, now: datetime) -> float:
+    created_at = parse_date(recipient['created_at'])
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    waiting_days = max(0.0, (now - created_at).total_seconds() / 86400)
+    return URGENCY_POINTS.get(recipient.get('urgency_level'), 0) + min(MAX_WAITING_POINTS, waiting_days * POINTS_PER_WAITING_DAY)
+
+
+def solve_organ(donors: Dict[str, List[dict]], recipients: Dict[str, List[dict]], now: datetime) -> List[dict]:
+    """Maximum-weight assignment of one organ type's donors to recipients.
+
+    ``donors`` and ``recipients`` map blood type to the profiles offering or
+    needing the organ. The weight of a pair is the recipient's priority plus
+    the blood type score, so within a blood type donors are interchangeable and
+    the best recipients of a blood type are always taken first. That reduces the
+    bipartite matching to a min-cost flow over blood type classes:
+
+        source -> donor blood type (capacity: donors of that type)
+               -> compatible recipient blood type (cost: -score)
+               -> sink (k-th unit costs -priority of the k-th best recipient)
+
+    solved by successive shortest paths, one unit per augmentation, on a graph
+    of at most 18 nodes. The per-unit sink costs are non-decreasing, so the
+    convex arcs need no special handling.
+    """
+    supply = {blood: len(donors.get(blood, [])) for blood in BLOOD_TYPES}
+    ranked = {
+        blood: sorted(recipients.get(blood, []), key=lambda r: (-recipient_priority(r, now), r['id']))
+        for blood in BLOOD_TYPES
+    }
+    priority = {blood: [recipient_priority(r, now) for r in ranked[blood]] for blood in BLOOD_TYPES}
+
+    sent = {blood: 0 for blood in BLOOD_TYPES}          # source -> donor class
+    flow = {(d, r): 0 for d in BLOOD_TYPES for r in BLOOD_COMPATIBILITY[d]}  # donor class -> recipient class
+    taken = {blood: 0 for blood in BLOOD_TYPES}         # recipient class -> sink
+
+    source, sink = "source", "sink"
+    donor_node = {blood: ("donor", blood) for blood in BLOOD_TYPES}
+    recipient_node = {blood: ("recipient", blood) for blood in BLOOD_TYPES}
+
+    def residual_edges():
+        for blood in BLOOD_TYPES:
+            if sent[blood] < supply[blood]:
+                yield source, donor_node[blood], 0, ("sent", blood, 1)
+            if sent[blood] > 0:
+                yield donor_node[blood], source, 0, ("sent", blood, -1)
+            if taken[blood] < len(ranked[blood]):
+                yield recipient_node[blood], sink, -priority[blood][taken[blood]], ("taken", blood, 1)
+            if taken[blood] > 0:
+                yield sink, recipient_node[blood], priority[blood][taken[blood] - 1], ("taken", blood, -1)
+        for (d, r), units in flow.items():
+            score = compatibility_score(d, r)
+            yield donor_node[d], recipient_node[r], -score, ("flow", (d, r), 1)
+            if units > 0:
+                yield recipient_node[r], donor_node[d], score, ("flow", (d, r), -1)
+
+    while True:
+        # Bellman-Ford from the source; the residual graph has no negative cycles
+        edges = list(residual_edges())
+        dist = {source: 0}
+        via = {}
+        for _ in range(len(BLOOD_TYPES) * 2 + 2):
+            changed = False
+            for tail, head, cost, step in edges:
+                if tail in dist and dist[tail] + cost < dist.get(head, float("inf")):
+                    dist[head] = dist[tail] + cost
+                    via[head] = (tail, step)
+                    changed = True
+            if not changed:
+                break
+
+        # Stop once no augmenting path improves the total weight
+        if dist.get(sink, 0) >= 0:
+            break
+
+        node = sink
+        while node != source:
+            node, (kind, key, delta) = via[node]
+            if kind == "sent":
+                sent[key] += delta
+            elif kind == "taken":
+                taken[key] += delta
+            else:
+                flow[key] += delta
+
+    # Expand class flows into concrete pairs: the top recipients of each class,
+    # drawing from the donor classes that feed it, oldest donor first
+    pools = {
+        blood: iter(sorted(donors.get(blood, []), key=lambda d: (parse_date(d['created_at']), d['id'])))
+        for blood in BLOOD_TYPES
+    }
+    assignments = []
+    for recipient_blood in BLOOD_TYPES:
+        queue = ranked[recipient_blood][:taken[recipient_blood]]
+        position = 0
+        feeders = sorted(
+            (d for d in BLOOD_TYPES if (d, recipient_blood) in flow),
+            key=lambda d: d != recipient_blood
+        )
+        for donor_blood in feeders:
+            for _ in range(flow[(donor_blood, recipient_blood)]):
+                donor = next(pools[donor_blood])
+                recipient = queue[position]
+                position += 1
+                score = compatibility_score(donor_blood, recipient_blood)
+                assignments.append({
+                    'donor_id': donor['id'],
+                    'recipient_id': recipient['id'],
+                    'compatibility_score': score,
+                    'priority': round(recipient_priority(recipient, now) + score, 3)
+                })
+    return assignments
+
+
+def solve_all(problems: Dict[str, tuple], now: datetime) -> Dict[str, List[dict]]:
+    """solve_organ for every organ's (donors, recipients)"""
+    return {organ: solve_organ(donors, recipients, now) for organ, (donors, recipients) in problems.items()}
+
+
+class Allocator:
+    """Organ allocation plan over the compatibility index, re-solved incrementally.
+
+    Organ types are independent assignment problems, so a profile change only
+    marks the organs it offers or needs as dirty and only those are re-solved.
+    The API solves with ``solve_in_thread``, which keeps the event loop free.
+    """
+
+    def __init__(self, index: CompatibilityIndex):
+        self.index = index
+        self.plans: Dict[str, dict] = {}
+        self.dirty = set()
+        self.generation = None
+        self._solving = asyncio.Lock()
+        index.listeners.append(self.profile_changed)
+
+    def profile_changed(self, kind: str, old: Optional[dict], new: Optional[dict]):
+        field = 'organs_available' if kind == 'donor' else 'organs_needed'
+        for profile in (old, new):
+            if profile is not None:
+                self.dirty.update(profile[field])
+
+    def organs(self) -> set:
+        return {organ for _, organ in self.index.donors} | {organ for _, organ in self.index.recipients}
+
+    def _problems(self, full: bool) -> Tuple[set, Dict[str, tuple]]:
+        """The organs to re-solve and a snapshot of each one's (donors, recipients) by blood type"""
+        if full or self.generation != self.index.generation:
+            self.plans.clear()
+            targets = self.organs()
+        else:
+            targets = self.dirty & (self.organs() | set(self.plans))
+        self.dirty = set()
+        self.generation = self.index.generation
+
+        problems = {}
+        for organ in targets:
+            donors = {blood: list(self.index.donors.get((blood, organ), {}).values()) for blood in BLOOD_TYPES}
+            recipients = {blood: list(self.index.recipients.get((blood, organ), {}).values()) for blood in BLOOD_TYPES}
+            if any(donors.values()) and any(recipients.values()):
+                problems[organ] = (donors, recipients)
+        return targets, problems
+
+    def _plan(self, targets: set, solved: Dict[str, List[dict]], now: datetime) -> dict:
+        for organ in targets:
+            if organ not in solved:
+                self.plans.pop(organ, None)
+                continue
+            self.plans[organ] = {
+                'organ_type': organ,
+                'solved_at': now,
+                'assignments': [dict(a, organ_type=organ) for a in solved[organ]]
+            }
+
+        return {
+            'resolved_organs': sorted(targets),
+            'plans': [self.plans[organ] for organ in sorted(self.plans)]
+        }
+
+    def solve(self, full: bool = False) -> dict:
+        now = datetime.now(timezone.utc)
+        targets, problems = self._problems(full)
+        return self._plan(targets, solve_all(problems, now), now)
+
+    async def solve_in_thread(self, full: bool = False) -> dict:
+        """Like solve, but the assignment problems are solved in a worker thread off the event loop.
+
+        The pools are copied on the loop first, so writes to the index during the
+        solve are left for the next one; solves run one at a time.
+        """
+        async with self._solving:
+            now = datetime.now(timezone.utc)
+            targets, problems = self._problems(full)
+            return self._plan(targets, await asyncio.to_thread(solve_all, problems, now), now)
@@ -0,0 +1,71 @@
+import json
+import time
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from fastapi import Response
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Document fields stored as native BSON datetimes
+DATE_FIELDS = ("created_at",)
+
+
+def format_date(value: datetime) -> str:
+    """ISO 8601 with a ``Z`` for UTC, as pydantic writes response_model dates"""
+    if value.tzinfo is None:
+        # BSON dates are UTC; clients without tz_aware hand back naive values
+        value = value.replace(tzinfo=timezone.utc)
+    text = value.isoformat()
+    return text[:-6] + "Z" if text.endswith("+00:00") else text
+
+def _default(value):
+    if isinstance(value, datetime):
+        return format_date(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+# Seconds spent encoding JSON in the current request, set per request by the metrics middleware
+serialization_time: ContextVar[Optional[List[float]]] = ContextVar("serialization_time", default=None)
+
+def dumpb(content) -> bytes:
+    """Compact JSON bytes, encoding datetimes (naive ones as UTC) and UUIDs natively"""
+    start = time.perf_counter()
+    if orjson is not None:
+        body = orjson.dumps(content, default=_default, option=orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z)
+    else:
+        body = json.dumps(content, default=_default, separators=(",", ":")).encode()
+    spent = serialization_time.get()
+    if spent is not None:
+        spent[0] += time.perf_counter() - start
+    return body
+
+def dumps(content) -> str:
+    return dumpb(content).decode()
+
+def json_response(content, status_code: int = 200, headers: dict = None) -> Response:
+    """Serialize stored documents straight to a response, skipping model revalidation"""
+    return Response(content=dumpb(content), status_code=status_code, headers=headers, media_type="application/json")
+
+
+class FastJSONResponse(JSONResponse):
+    """Default response class: the usual FastAPI encoding with the fast encoder underneath"""
+
+    def render(self, content) -> bytes:
+        return dumpb(content)
+
+def parse_date(value):
+    """Native datetime for a stored date that may still be a legacy ISO string"""
+    if isinstance(value, str):
+        # fromisoformat only reads a trailing Z from Python 3.11
+        return datetime.fromisoformat(value[:-1] + "+00:00" if value.endswith("Z") else value)
+    return value
+
+def utc_date(value) -> datetime:
+    """parse_date, taking naive values to be UTC so that every result compares with every other"""
+    value = parse_date(value)
+    return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
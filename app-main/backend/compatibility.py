@@ -0,0 +1,432 @@
+import asyncio
+from collections import defaultdict
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from codec import utc_date
+from etags import VERSIONS_COLLECTION
+
+# Donor blood type -> recipient blood types that can receive from it
+BLOOD_COMPATIBILITY = {
+    "O-": ["O-", "O+", "A-", "A+", "B-", "B+", "AB-", "AB+"],
+    "O+": ["O+", "A+", "B+", "AB+"],
+    "A-": ["A-", "A+", "AB-", "AB+"],
+    "A+": ["A+", "AB+"],
+    "B-": ["B-", "B+", "AB-", "AB+"],
+    "B+": ["B+", "AB+"],
+    "AB-": ["AB-", "AB+"],
+    "AB+": ["AB+"]
+}
+
+# Recipient blood type -> donor blood types it can receive from
+COMPATIBLE_DONORS = defaultdict(list)
+for _donor_blood, _recipient_bloods in BLOOD_COMPATIBILITY.items():
+    for _recipient_blood in _recipient_bloods:
+        COMPATIBLE_DONORS[_recipient_blood].append(_donor_blood)
+
+BLOOD_TYPES = list(BLOOD_COMPATIBILITY)
+
+# Recipient urgency levels, least to most urgent
+URGENCY_LEVELS = ["low", "medium", "high", "critical"]
+
+# Blood type code lookup table for vectorised matching. The extra last row and
+# column stand for unknown blood types, which are compatible with nothing.
+_BLOOD_CODES = {blood: code for code, blood in enumerate(BLOOD_TYPES)}
+_UNKNOWN_BLOOD = len(BLOOD_TYPES)
+_BLOOD_TABLE = np.zeros((_UNKNOWN_BLOOD + 1, _UNKNOWN_BLOOD + 1), dtype=bool)
+for _donor_blood, _recipient_bloods in BLOOD_COMPATIBILITY.items():
+    for _recipient_blood in _recipient_bloods:
+        _BLOOD_TABLE[_BLOOD_CODES[_donor_blood], _BLOOD_CODES[_recipient_blood]] = True
+
+# Upper bound on donor x recipient cells evaluated per block
+MATRIX_BLOCK_CELLS = 1 << 22
+
+
+def is_blood_compatible(donor_blood: str, recipient_blood: str) -> bool:
+    return recipient_blood in BLOOD_COMPATIBILITY.get(donor_blood, [])
+
+def compatibility_score(donor_blood: str, recipient_blood: str) -> int:
+    # Base score for blood compatibility, perfect match for identical types
+    return 100 if donor_blood == recipient_blood else 80
+
+
+def _with_native_date(profile: dict) -> dict:
+    """The profile with an aware created_at, so that indexed entries sort together
+    whether or not migrate_dates.py has run"""
+    created_at = profile.get('created_at')
+    if created_at is None or isinstance(created_at, datetime) and created_at.tzinfo is not None:
+        return profile
+    return {**profile, 'created_at': utc_date(created_at)}
+
+
+class CompatibilityIndex:
+    """Resident index of matchable profiles bucketed by (blood type, organ).
+
+    Only available donors and waiting recipients are indexed. A lookup walks
+    the buckets compatible with the given profile, so its cost depends on the
+    number of candidates returned rather than on the size of the registry.
+
+    Listeners are called as ``listener(kind, old, new)`` whenever a donor or
+    recipient entry changes, with ``None`` standing for "not indexed". A full
+    reload bumps ``generation`` instead.
+    """
+
+    def __init__(self):
+        self.donors: Dict[Tuple[str, str], Dict[str, dict]] = defaultdict(dict)
+        self.recipients: Dict[Tuple[str, str], Dict[str, dict]] = defaultdict(dict)
+        self._donors_by_id: Dict[str, dict] = {}
+        self._recipients_by_id: Dict[str, dict] = {}
+        self.loaded = False
+        self.generation = 0
+        self.listeners: List[Callable[[str, Optional[dict], Optional[dict]], None]] = []
+
+    async def load(self, db):
+        self.clear()
+        async for donor in db.donor_profiles.find({"status": "available"}, {"_id": 0}):
+            self.put_donor(donor)
+        async for recipient in db.recipient_profiles.find({"status": "waiting"}, {"_id": 0}):
+            self.put_recipient(recipient)
+        self.loaded = True
+
+    def clear(self):
+        self.donors.clear()
+        self.recipients.clear()
+        self._donors_by_id.clear()
+        self._recipients_by_id.clear()
+        self.loaded = False
+        self.generation += 1
+
+    def _notify(self, kind: str, old: Optional[dict], new: Optional[dict]):
+        if old is None and new is None:
+            return
+        for listener in self.listeners:
+            listener(kind, old, new)
+
+    def put_donor(self, donor: dict):
+        donor = _with_native_date(donor)
+        old = self._unindex_donor(donor['id'])
+        if donor.get('status', 'available') != 'available':
+            self._notify('donor', old, None)
+            return
+        for organ in set(donor['organs_available']):
+            self.donors[(donor['blood_type'], organ)][donor['id']] = donor
+        self._donors_by_id[donor['id']] = donor
+        self._notify('donor', old, donor)
+
+    def remove_donor(self, donor_id: str):
+        self._notify('donor', self._unindex_donor(donor_id), None)
+
+    def _unindex_donor(self, donor_id: str) -> Optional[dict]:
+        donor = self._donors_by_id.pop(donor_id, None)
+        if donor is None:
+            return None
+        for organ in set(donor['organs_available']):
+            key = (donor['blood_type'], organ)
+            bucket = self.donors[key]
+            bucket.pop(donor_id, None)
+            if not bucket:
+                del self.donors[key]
+        return donor
+
+    def put_recipient(self, recipient: dict):
+        recipient = _with_native_date(recipient)
+        old = self._unindex_recipient(recipient['id'])
+        if recipient.get('status', 'waiting') != 'waiting':
+            self._notify('recipient', old, None)
+            return
+        for organ in set(recipient['organs_needed']):
+            self.recipients[(recipient['blood_type'], organ)][recipient['id']] = recipient
+        self._recipients_by_id[recipient['id']] = recipient
+        self._notify('recipient', old, recipient)
+
+    def remove_recipient(self, recipient_id: str):
+        self._notify('recipient', self._unindex_recipient(recipient_id), None)
+
+    def _unindex_recipient(self, recipient_id: str) -> Optional[dict]:
+        recipient = self._recipients_by_id.pop(recipient_id, None)
+        if recipient is None:
+            return None
+        for organ in set(recipient['organs_needed']):
+            key = (recipient['blood_type'], organ)
+            bucket = self.recipients[key]
+            bucket.pop(recipient_id, None)
+            if not bucket:
+                del self.recipients[key]
+        return recipient
+
+    def get_donor(self, donor_id: str) -> Optional[dict]:
+        return self._donors_by_id.get(donor_id)
+
+    def get_recipient(self, recipient_id: str) -> Optional[dict]:
+        return self._recipients_by_id.get(recipient_id)
+
+    def available_donors(self) -> List[dict]:
+        return list(self._donors_by_id.values())
+
+    def waiting_recipients(self) -> List[dict]:
+        return list(self._recipients_by_id.values())
+
+    def donors_for(self, recipient: dict) -> List[dict]:
+        """Available donors compatible with a recipient, annotated like /matches/potential."""
+        found: Dict[str, Tuple[dict, List[str]]] = {}
+        for donor_blood in COMPATIBLE_DONORS.get(recipient['blood_type'], []):
+            for organ in recipient['organs_needed']:
+                for donor_id, donor in self.donors.get((donor_blood, organ), {}).items():
+                    entry = found.setdefault(donor_id, (donor, []))
+                    if organ not in entry[1]:
+                        entry[1].append(organ)
+
+        return [
+            {
+                **donor,
+                'matching_organs': organs,
+                'compatibility_score': compatibility_score(donor['blood_type'], recipient['blood_type'])
+            }
+            for donor, organs in found.values()
+        ]
+
+    def recipients_for(self, donor: dict) -> List[dict]:
+        """Waiting recipients compatible with a donor, annotated like /matches/potential."""
+        found: Dict[str, Tuple[dict, List[str]]] = {}
+        for recipient_blood in BLOOD_COMPATIBILITY.get(donor['blood_type'], []):
+            for organ in donor['organs_available']:
+                for recipient_id, recipient in self.recipients.get((recipient_blood, organ), {}).items():
+                    entry = found.setdefault(recipient_id, (recipient, []))
+                    if organ not in entry[1]:
+                        entry[1].append(organ)
+
+        return [
+            {
+                **recipient,
+                'matching_organs': organs,
+                'compatibility_score': compatibility_score(donor['blood_type'], recipient['blood_type'])
+            }
+            for recipient, organs in found.values()
+        ]
+
+
+
+PROFILE_COLLECTIONS = ("donor_profiles", "recipient_profiles")
+# Marks a collection whose synced version is unknown, as opposed to one that had no version document
+_UNKNOWN = object()
+
+
+class IndexSync:
+    """Reloads a CompatibilityIndex when another process writes the profile collections.
+
+    The index only sees the writes made through its own process, plus those
+    the change stream relay delivers. Without the relay it is only correct
+    while this is the single writer, so every read can first compare the
+    profile collections' version counters with the ones the index was loaded
+    at. This process's own writes advance the synced versions one step at a
+    time; any other change means a foreign write, and the index is reloaded.
+    """
+
+    def __init__(self, db, index: CompatibilityIndex):
+        self.db = db
+        self.index = index
+        self.synced: Dict[str, object] = {}
+        self.writes = 0
+        self.reloads = 0
+        self._reload: Optional[asyncio.Task] = None
+
+    async def _versions(self) -> Dict[str, object]:
+        versions = dict.fromkeys(PROFILE_COLLECTIONS)
+        async for doc in self.db[VERSIONS_COLLECTION].find({"_id": {"$in": list(PROFILE_COLLECTIONS)}}):
+            # Version 0 is only a read having created the counter
+            versions[doc['_id']] = (doc['epoch'], doc['version']) if doc['version'] else None
+        return versions
+
+    async def load(self):
+        writes = self.writes
+        versions = await self._versions()
+        await self.index.load(self.db)
+        # A write of this process during the load may have been replaced by the older stored row
+        self.synced = versions if self.writes == writes else {}
+
+    def written(self, name: str, version: Tuple[str, int]):
+        """Record that this process bumped a profile collection to version, after applying its write"""
+        self.writes += 1
+        previous = self.synced.get(name, _UNKNOWN)
+        epoch, number = version
+        if previous == (epoch, number - 1) or (previous is None and number == 1):
+            self.synced[name] = version
+        else:
+            # Someone else wrote in between
+            self.synced.pop(name, None)
+
+    async def fresh(self) -> bool:
+        """Whether the index has seen every write made since it was loaded"""
+        versions = await self._versions()
+        return all(self.synced.get(name, _UNKNOWN) == version for name, version in versions.items())
+
+    def refresh(self) -> asyncio.Task:
+        """Reload the index in the background, once however many callers ask"""
+        if self._reload is None or self._reload.done():
+            self._reload = asyncio.create_task(self._reload_index())
+        return self._reload
+
+    async def _reload_index(self):
+        await self.load()
+        self.reloads += 1
+
+    async def current(self):
+        """Wait until the index holds every write made so far"""
+        if not await self.fresh():
+            await asyncio.shield(self.refresh())
+
+    def stats(self) -> dict:
+        return {"reloads": self.reloads, "synced": int(len(self.synced) == len(PROFILE_COLLECTIONS))}
+
+# Fields of a candidate profile the dashboards show, besides the match annotations
+CANDIDATE_FIELDS = {
+    "donor": ["id", "blood_type", "age", "status"],
+    "recipient": ["id", "blood_type", "age", "status", "urgency_level"],
+}
+
+def candidate_view(kind: str, candidate: dict) -> dict:
+    """Trim an annotated candidate from the index to the fields the dashboards show"""
+    view = {field: candidate[field] for field in CANDIDATE_FIELDS[kind] if field in candidate}
+    view['matching_organs'] = candidate['matching_organs']
+    view['compatibility_score'] = candidate['compatibility_score']
+    return view
+
+def candidate_pipeline(kind: str, profile: dict, radii_km: Optional[Dict[str, float]] = None,
+                       limit: Optional[int] = None) -> List[dict]:
+    """Aggregation over the ``kind`` collection returning the candidates compatible with ``profile``.
+
+    The mirror image of donors_for/recipients_for evaluated by the database:
+    blood type and organ overlap are matched with $in, and only the displayed
+    fields, matching_organs and compatibility_score leave the server.
+
+    With ``radii_km`` (organ -> maximum distance) the pipeline starts with a
+    $geoNear over the 2dsphere index on ``coordinates``, bounded by the largest
+    radius, adds ``distance_km`` and keeps only the organs within their own
+    radius. Candidates without coordinates are left out.
+
+    Donors come oldest first; recipients in waiting list priority order like
+    WaitlistQueues: urgency, then time on the list, then score.
+    """
+    if kind == "donor":
+        blood_types = COMPATIBLE_DONORS.get(profile['blood_type'], [])
+        status, organs_field, wanted = "available", "organs_available", profile['organs_needed']
+    else:
+        blood_types = BLOOD_COMPATIBILITY.get(profile['blood_type'], [])
+        status, organs_field, wanted = "waiting", "organs_needed", profile['organs_available']
+
+    query = {"status": status, "blood_type": {"$in": blood_types}, organs_field: {"$in": wanted}}
+    organ_matches = {"$in": ["$$this", f"${organs_field}"]}
+    fields = {field: 1 for field in CANDIDATE_FIELDS[kind]}
+    if radii_km is None:
+        stages = [{"$match": query}]
+    else:
+        furthest = max(radii_km.values(), default=0)
+        stages = [{"$geoNear": {
+            "near": profile['coordinates'],
+            "key": "coordinates",
+            "distanceField": "distance_km",
+            "distanceMultiplier": 0.001,
+            "spherical": True,
+            "query": query,
+            **({"maxDistance": furthest * 1000} if furthest != float("inf") else {}),
+        }}]
+        organ_matches = {"$and": [organ_matches, *(
+            {"$or": [{"$ne": ["$$this", organ]}, {"$lte": ["$distance_km", radius]}]}
+            for organ, radius in radii_km.items() if radius != float("inf")
+        )]}
+        fields["distance_km"] = 1
+
+    score = {"$cond": [{"$eq": ["$blood_type", profile['blood_type']]}, 100, 80]}
+    if kind == "donor":
+        stages.append({"$sort": {"created_at": 1, "id": 1}})
+    else:
+        stages += [
+            {"$addFields": {"urgency_rank": {"$indexOfArray": [{"$literal": URGENCY_LEVELS}, "$urgency_level"]}, "compatibility_score": score}},
+            {"$sort": {"urgency_rank": -1, "created_at": 1, "compatibility_score": -1, "id": 1}},
+        ]
+    if limit is not None and radii_km is None:
+        stages.append({"$limit": limit})
+
+    stages += [
+        {"$project": {
+            "_id": 0,
+            **fields,
+            # In the order the viewing profile lists them, like the index lookup
+            "matching_organs": {"$filter": {
+                "input": {"$literal": list(dict.fromkeys(wanted))},
+                "cond": organ_matches
+            }},
+            "compatibility_score": score,
+        }},
+    ]
+    if radii_km is not None:
+        # Candidates whose only shared organs are too far away
+        stages.append({"$match": {"matching_organs": {"$ne": []}}})
+        if limit is not None:
+            stages.append({"$limit": limit})
+    return stages
+
+def compatibility_matrix(donors: List[dict], recipients: List[dict]) -> dict:
+    """Every feasible donor x recipient pairing, computed with array operations.
+
+    Blood types are encoded as codes into a boolean lookup table and organ lists
+    as bitmasks over the organs present in the pool, so a pair is feasible when
+    its blood types are compatible and the masks overlap. The donor axis is
+    processed in blocks to bound memory on large pools.
+
+    The result is columnar: pair ``i`` links ``donor_ids[pairs['donor'][i]]`` to
+    ``recipient_ids[pairs['recipient'][i]]`` for the organs whose bits are set
+    in ``pairs['organs'][i]`` (bit ``n`` is ``organs[n]``).
+    """
+    organs = sorted(
+        {organ for donor in donors for organ in donor['organs_available']}
+        & {organ for recipient in recipients for organ in recipient['organs_needed']}
+    )
+    if len(organs) > 64:
+        raise ValueError("Too many distinct organ types to encode as bitmasks")
+    organ_bits = {organ: 1 << bit for bit, organ in enumerate(organs)}
+
+    def encode(profiles, organs_field):
+        blood = np.fromiter(
+            (_BLOOD_CODES.get(p['blood_type'], _UNKNOWN_BLOOD) for p in profiles),
+            dtype=np.intp, count=len(profiles)
+        )
+        masks = np.fromiter(
+            (sum(organ_bits.get(organ, 0) for organ in set(p[organs_field])) for p in profiles),
+            dtype=np.uint64, count=len(profiles)
+        )
+        return blood, masks
+
+    donor_blood, donor_masks = encode(donors, 'organs_available')
+    recipient_blood, recipient_masks = encode(recipients, 'organs_needed')
+
+    pair_donors, pair_recipients, pair_organs, pair_scores = [], [], [], []
+    block = max(1, MATRIX_BLOCK_CELLS // max(1, len(recipients)))
+    for start in range(0, len(donors), block):
+        stop = min(start + block, len(donors))
+        overlap = donor_masks[start:stop, None] & recipient_masks[None, :]
+        feasible = _BLOOD_TABLE[donor_blood[start:stop, None], recipient_blood[None, :]] & (overlap != 0)
+        d_idx, r_idx = np.nonzero(feasible)
+        pair_donors.append(d_idx + start)
+        pair_recipients.append(r_idx)
+        pair_organs.append(overlap[d_idx, r_idx])
+        pair_scores.append(np.where(donor_blood[d_idx + start] == recipient_blood[r_idx], 100, 80))
+
+    def flat(parts, dtype):
+        return np.concatenate(parts).astype(dtype) if parts else np.empty(0, dtype=dtype)
+
+    donor_index = flat(pair_donors, np.int64)
+    return {
+        'donor_ids': [donor['id'] for donor in donors],
+        'recipient_ids': [recipient['id'] for recipient in recipients],
+        'organs': organs,
+        'count': int(donor_index.size),
+        'pairs': {
+            'donor': donor_index.tolist(),
+            'recipient': flat(pair_recipients, np.int64).tolist(),
+            'organs': flat(pair_organs, np.uint64).tolist(),
+            'score': flat(pair_scores, np.int64).tolist()
+        }
+    }
@@ -0,0 +1,141 @@
+"""Negotiated response compression.
+
+Brotli is used when the ``brotli`` package is installed and the client accepts
+``br``; otherwise gzip. Bodies under ``minimum_size`` are sent as they are.
+Streamed responses (NDJSON exports) are compressed chunk by chunk with a
+flush after each, so clients still see rows as they are produced. Server-sent
+events are never compressed, because proxies and browsers would buffer them.
+"""
+import gzip
+import os
+import zlib
+from typing import Optional
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content types worth compressing
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/plain", "text/csv", "text/html")
+
+
+def _accepted(accept_encoding: str) -> set:
+    encodings = set()
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        encodings.add(name.strip())
+    return encodings
+
+
+class _Encoder:
+    def __init__(self, encoding: str, gzip_level: int, brotli_quality: int):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=brotli_quality)
+        else:
+            self._compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def chunk(self, data: bytes) -> bytes:
+        if self.encoding == "br":
+            return self._compressor.process(data) + self._compressor.flush()
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    @classmethod
+    def options_from_env(cls) -> dict:
+        return {
+            "minimum_size": int(os.environ.get('COMPRESSION_MIN_BYTES', '1024')),
+            "gzip_level": int(os.environ.get('COMPRESSION_GZIP_LEVEL', '6')),
+            "brotli_quality": int(os.environ.get('COMPRESSION_BROTLI_QUALITY', '4')),
+        }
+
+    def negotiate(self, scope) -> Optional[str]:
+        accept = ""
+        for name, value in scope.get("headers", []):
+            if name == b"accept-encoding":
+                accept = value.decode("latin-1")
+        encodings = _accepted(accept)
+        if brotli is not None and "br" in encodings:
+            return "br"
+        if "gzip" in encodings:
+            return "gzip"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = self.negotiate(scope)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        encoder: Optional[_Encoder] = None
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start_message, encoder, passthrough
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more = message.get("more_body", False)
+            if encoder is None:
+                headers = {name.lower(): value for name, value in start_message["headers"]}
+                content_type = headers.get(b"content-type", b"").decode("latin-1")
+                compressible = (
+                    b"content-encoding" not in headers
+                    and content_type.split(";")[0].strip() in COMPRESSIBLE_TYPES
+                    and (more or len(body) >= self.minimum_size)
+                )
+                if not compressible:
+                    passthrough = True
+                    await send(start_message)
+                    await send(message)
+                    return
+                encoder = _Encoder(encoding, self.gzip_level, self.brotli_quality)
+                new_headers = [
+                    (name, value) for name, value in start_message["headers"]
+                    if name.lower() not in (b"content-length", b"vary")
+                ]
+                vary = headers.get(b"vary")
+                new_headers.append((b"vary", vary + b", Accept-Encoding" if vary else b"Accept-Encoding"))
+                new_headers.append((b"content-encoding", encoding.encode()))
+                if not more:
+                    compressed = gzip.compress(body, self.gzip_level) if encoding == "gzip" else brotli.compress(body, quality=self.brotli_quality)
+                    new_headers.append((b"content-length", str(len(compressed)).encode()))
+                    await send({**start_message, "headers": new_headers})
+                    await send({"type": "http.response.body", "body": compressed})
+                    return
+                await send({**start_message, "headers": new_headers})
+
+            data = encoder.chunk(body) if body else b""
+            if not more:
+                data += encoder.finish()
+            if data or not more:
+                await send({"type": "http.response.body", "body": data, "more_body": more})
+
+        await self.app(scope, receive, send_wrapper)
+        if start_message is not None and encoder is None and not passthrough:
+            # Response without a body message
+            await send(start_message)
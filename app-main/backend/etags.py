@@ -0,0 +1,112 @@
+"""Collection version counters, ETags and a cache of serialized list responses.
+
+Every write to a listed collection bumps a counter document in
+``collection_versions``, shared by all workers. A list response's ETag is
+derived from that version and the request's query, so a repeat request with
+``If-None-Match`` is answered with a 304 after a single indexed lookup, and
+the serialized body can be cached until the next write.
+"""
+import hashlib
+import json
+import os
+import uuid
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+VERSIONS_COLLECTION = "collection_versions"
+
+
+async def collection_version(db, name: str) -> str:
+    doc = await db[VERSIONS_COLLECTION].find_one({"_id": name})
+    if doc is None:
+        doc = await db[VERSIONS_COLLECTION].find_one_and_update(
+            {"_id": name},
+            {"$setOnInsert": {"epoch": uuid.uuid4().hex, "version": 0}},
+            upsert=True,
+            return_document=True
+        )
+    # The epoch keeps tags unique if the counters are ever reset
+    return f"{doc['epoch']}.{doc['version']}"
+
+async def bump_versions(db, *names: str) -> Dict[str, Tuple[str, int]]:
+    """Advance the listed collections' versions, returning each new (epoch, version)"""
+    versions = {}
+    for name in names:
+        doc = await db[VERSIONS_COLLECTION].find_one_and_update(
+            {"_id": name},
+            {"$inc": {"version": 1}, "$setOnInsert": {"epoch": uuid.uuid4().hex}},
+            upsert=True,
+            return_document=True
+        )
+        versions[name] = (doc['epoch'], doc['version'])
+    return versions
+
+def make_etag(collection: str, version: str, *variant) -> str:
+    digest = hashlib.sha1(json.dumps([collection, version, *variant], sort_keys=True, default=str).encode()).hexdigest()
+    # Weak, so a compressed representation may carry the same tag
+    return f'W/"{digest[:24]}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == opaque for candidate in if_none_match.split(","))
+
+
+class ResponseCache:
+    """LRU of serialized response bodies keyed by ETag, bounded in bytes.
+
+    Entries never go stale, because the ETag changes with every write; writes
+    made by this process also drop the collection's entries straight away to
+    free the memory.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[str, str, object]]" = OrderedDict()
+
+    @classmethod
+    def from_env(cls) -> "ResponseCache":
+        return cls(max_bytes=int(float(os.environ.get('RESPONSE_CACHE_MB', '32')) * 1024 * 1024))
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, etag: str) -> Optional[Tuple[str, object]]:
+        entry = self._entries.get(etag)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(etag)
+        self.hits += 1
+        return entry[1], entry[2]
+
+    def put(self, collection: str, etag: str, body: str, extra=None):
+        if not self.enabled or len(body) > self.max_bytes:
+            return
+        if etag in self._entries:
+            self.size -= len(self._entries.pop(etag)[1])
+        self._entries[etag] = (collection, body, extra)
+        self.size += len(body)
+        while self.size > self.max_bytes:
+            _, (_, evicted, _) = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def invalidate(self, collection: str):
+        for etag in [etag for etag, entry in self._entries.items() if entry[0] == collection]:
+            self.size -= len(self._entries.pop(etag)[1])
+
+    def stats(self) -> dict:
+        return {
+            "max_bytes": self.max_bytes,
+            "bytes": self.size,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses
+        }
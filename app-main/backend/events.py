@@ -0,0 +1,166 @@
+import asyncio
+import logging
+from collections import OrderedDict, defaultdict, deque
+from typing import Awaitable, Callable, Hashable, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class EventBus:
+    """In-process publish/subscribe of per-user events.
+
+    Each subscriber gets a bounded queue. A subscriber that stops draining its
+    queue loses events rather than holding memory for the whole process.
+    """
+
+    def __init__(self, queue_size: int = 256):
+        self.queue_size = queue_size
+        self._by_user = defaultdict(set)
+        self._by_role = defaultdict(set)
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, user_id: str, role: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._by_user[user_id].add(queue)
+        self._by_role[role].add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: str, role: str, queue: asyncio.Queue):
+        for registry, key in ((self._by_user, user_id), (self._by_role, role)):
+            subscribers = registry.get(key)
+            if subscribers is not None:
+                subscribers.discard(queue)
+                if not subscribers:
+                    del registry[key]
+
+    def publish(self, event: dict, user_ids: Iterable[str] = (), roles: Iterable[str] = ()):
+        targets = set()
+        for user_id in user_ids:
+            targets |= self._by_user.get(user_id, set())
+        for role in roles:
+            targets |= self._by_role.get(role, set())
+
+        self.published += 1
+        for queue in targets:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self.dropped += 1
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": sum(len(queues) for queues in self._by_role.values()),
+            "published": self.published,
+            "dropped": self.dropped
+        }
+
+
+class ChangeStreamRelay:
+    """Feeds inserts and updates on the given collections to a handler via a MongoDB change stream.
+
+    The handler is awaited as ``handler(collection, operation, document)`` with
+    the full post-change document.
+
+    Change streams need a replica set or sharded cluster. ``start`` returns
+    False on a standalone server, and ``active`` stays False so callers can
+    publish events in-process instead.
+    """
+
+    def __init__(self, db, collections: List[str], handler: Callable[[str, str, dict], Awaitable[None]]):
+        self.db = db
+        self.collections = collections
+        self.handler = handler
+        self.active = False
+        self._stream = None
+        self._task = None
+
+    async def start(self) -> bool:
+        pipeline = [{"$match": {
+            "ns.coll": {"$in": self.collections},
+            "operationType": {"$in": ["insert", "update", "replace"]}
+        }}]
+        try:
+            self._stream = self.db.watch(pipeline, full_document="updateLookup")
+            # Opens the stream, which fails straight away where change streams are unsupported
+            first = await self._stream.try_next()
+        except Exception as e:
+            logger.info("Change streams unavailable, publishing events in-process: %s", e)
+            self._stream = None
+            return False
+
+        self.active = True
+        self._task = asyncio.create_task(self._run(first))
+        return True
+
+    async def _run(self, first):
+        try:
+            if first is not None:
+                await self._dispatch(first)
+            async for change in self._stream:
+                await self._dispatch(change)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Change stream relay stopped, falling back to in-process events")
+        finally:
+            self.active = False
+
+    async def _dispatch(self, change: dict):
+        document = change.get("fullDocument")
+        if document is None:
+            return
+        document.pop("_id", None)
+        try:
+            await self.handler(change["ns"]["coll"], change["operationType"], document)
+        except Exception:
+            logger.exception("Failed to handle change on %s", change["ns"]["coll"])
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._stream is not None:
+            await self._stream.close()
+            self._stream = None
+        self.active = False
+
+
+class OwnWrites:
+    """Writes this process already applied, waiting for their change stream echo.
+
+    The relay delivers every write, this process's own included, but those
+    were applied to the resident structures when they were made. ``record``
+    keeps the version each one replaced and ``pop`` hands it back, oldest
+    first, so that the echo is published against the real previous version
+    instead of being applied a second time. Bounded by ``maxsize``: if echoes
+    stop arriving the oldest entries are dropped, and their echo, should it
+    come after all, is applied like any other write.
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self.size = 0
+        self._entries: "OrderedDict[Hashable, deque]" = OrderedDict()
+
+    def record(self, key: Hashable, previous: Optional[dict]):
+        self._entries.setdefault(key, deque()).append(previous)
+        self.size += 1
+        while self.size > self.maxsize:
+            _, dropped = self._entries.popitem(last=False)
+            self.size -= len(dropped)
+
+    def pop(self, key: Hashable) -> Tuple[bool, Optional[dict]]:
+        """(whether the write was this process's, the version it replaced)"""
+        pending = self._entries.get(key)
+        if not pending:
+            return False, None
+        previous = pending.popleft()
+        self.size -= 1
+        if not pending:
+            del self._entries[key]
+        return True, previous
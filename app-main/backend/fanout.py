@@ -0,0 +1,98 @@
+"""Background fan-out of donor and recipient writes to the profiles they affect.
+
+A profile write changes the candidate list of every counterpart compatible
+with its old or new version, and finding those walks the compatibility
+index. The write path only queues the change; a background task finds the
+counterparts once per change and hands them to the handler, which both
+publishes the events and marks the materialized lists from the same result.
+"""
+import asyncio
+import logging
+from collections import deque
+from typing import Callable, Deque, List, Optional, Tuple
+
+from compatibility import CompatibilityIndex
+
+logger = logging.getLogger(__name__)
+
+# kind, old version, new version, publish events
+Change = Tuple[str, Optional[dict], dict, bool]
+
+
+class ProfileFanout:
+    """Calls ``handler(kind, old, profile, counterparts, publish)`` for every submitted change.
+
+    ``counterparts`` are the indexed profiles of the other kind compatible
+    with the old or the new version. Changes are handled in submission order;
+    until ``start`` they are handled inline.
+    """
+
+    def __init__(self, index: CompatibilityIndex, handler: Callable[[str, Optional[dict], dict, List[dict], bool], None],
+                 batch_size: int = 100):
+        self.index = index
+        self.handler = handler
+        self.batch_size = batch_size
+        self.queue: Deque[Change] = deque()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.handled = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def busy(self) -> bool:
+        """Whether changes are waiting to be handled"""
+        return bool(self.queue)
+
+    def counterparts(self, kind: str, old: Optional[dict], profile: dict) -> List[dict]:
+        found = {}
+        for version in (old, profile):
+            if version is not None:
+                for candidate in self.index.recipients_for(version) if kind == 'donor' else self.index.donors_for(version):
+                    found[candidate['id']] = candidate
+        return list(found.values())
+
+    def submit(self, kind: str, old: Optional[dict], profile: dict, publish: bool = True):
+        if self._task is None:
+            self._handle((kind, old, profile, publish))
+            return
+        self.queue.append((kind, old, profile, publish))
+        self._wakeup.set()
+
+    def _handle(self, change: Change):
+        kind, old, profile, publish = change
+        try:
+            self.handler(kind, old, profile, self.counterparts(kind, old, profile), publish)
+        except Exception:
+            logger.exception("Failed to fan out a %s profile change", kind)
+        self.handled += 1
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self.queue:
+                for _ in range(min(self.batch_size, len(self.queue))):
+                    self._handle(self.queue.popleft())
+                # Let requests in between batches
+                await asyncio.sleep(0)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Whatever is left still gets its events and list updates
+        while self.queue:
+            self._handle(self.queue.popleft())
+
+    def stats(self) -> dict:
+        return {"running": int(self.running), "queued": len(self.queue), "handled": self.handled}
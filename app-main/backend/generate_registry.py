@@ -0,0 +1,303 @@
+"""Synthetic registry generator for scale testing.
+
+Bulk-loads users, donor, recipient and hospital profiles and matches with
+realistic blood type frequencies, organ mixes, urgency levels and timestamps
+straight into the collections of the configured database::
+
+    python generate_registry.py --donors 1000000 --recipients 1000000 --hospitals 500 --matches 200000
+
+Documents are built from the models in server.py. Every generated user shares
+one password (``--password``) hashed once with ``--bcrypt-rounds``, unless
+``--hash-per-user`` asks for a real hash per account. Profiles are written
+with unordered insert_many batches, several in flight at once, and the index
+manifest is applied after loading.
+"""
+import argparse
+import asyncio
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+import server
+from compatibility import BLOOD_COMPATIBILITY, BLOOD_TYPES, compatibility_score
+from etags import bump_versions
+from geo import point
+from indexes import ensure_indexes
+from match_status import ORGAN_LISTS
+from passwords import pwd_context
+from registry_stats import RegistryStats
+import storage
+
+# Population blood type frequencies, in BLOOD_TYPES order (O-, O+, A-, A+, B-, B+, AB-, AB+)
+BLOOD_FREQUENCIES = [0.066, 0.374, 0.063, 0.357, 0.015, 0.085, 0.006, 0.034]
+
+ORGANS = ["kidney", "liver", "lungs", "heart", "pancreas", "intestines"]
+# Chance that a donor offers each organ
+DONOR_ORGAN_RATES = [0.90, 0.70, 0.40, 0.30, 0.25, 0.10]
+# Share of waiting-list demand for each organ
+RECIPIENT_ORGAN_SHARES = [0.83, 0.12, 0.015, 0.025, 0.005, 0.005]
+
+# Hospitals are spread over this (longitude, latitude) box, roughly the contiguous US
+HOSPITAL_AREA = ((-124.0, 25.0), (-67.0, 49.0))
+
+URGENCY_LEVELS = ["low", "medium", "high", "critical"]
+URGENCY_FREQUENCIES = [0.35, 0.35, 0.20, 0.10]
+
+DONOR_STATUSES = (["available", "matched", "donated"], [0.85, 0.10, 0.05])
+RECIPIENT_STATUSES = (["waiting", "matched", "received"], [0.85, 0.10, 0.05])
+MATCH_STATUSES = (["pending", "accepted", "rejected", "completed"], [0.50, 0.25, 0.15, 0.10])
+
+_COMPATIBLE = np.array([[r in BLOOD_COMPATIBILITY[d] for r in BLOOD_TYPES] for d in BLOOD_TYPES])
+
+
+class RegistryGenerator:
+    def __init__(self, db, args):
+        self.db = db
+        self.args = args
+        self.rng = np.random.default_rng(args.seed)
+        self.now = datetime.now(timezone.utc)
+        self.run = uuid.UUID(int=int(self.rng.integers(0, 2**63))).hex[:8]
+        # Per-kind id prefixes; ids are derived from the row index so none need to be kept in memory
+        self.prefixes = {kind: int(self.rng.integers(0, 2**63)) for kind in ("user", "donor", "recipient", "hospital")}
+        self.inflight = set()
+        self.semaphore = asyncio.Semaphore(args.concurrency)
+        self.written = {}
+        self.password_hash = None
+        (west, south), (east, north) = HOSPITAL_AREA
+        self.hospital_points = np.column_stack([
+            self.rng.uniform(west, east, args.hospitals),
+            self.rng.uniform(south, north, args.hospitals)
+        ])
+        self.donor_blood = self.donor_organs = None
+        self.recipient_blood = self.recipient_organs = None
+
+    def make_id(self, kind: str, index: int) -> str:
+        return str(uuid.UUID(int=(self.prefixes[kind] << 64) | index, version=4))
+
+    def user_index(self, kind: str, index: int) -> int:
+        # Users are numbered hospitals, then donors, then recipients
+        offset = {"hospital": 0, "donor": self.args.hospitals, "recipient": self.args.hospitals + self.args.donors}
+        return offset[kind] + index
+
+    def hash_password(self) -> str:
+        return pwd_context.copy(bcrypt__rounds=self.args.bcrypt_rounds).hash(self.args.password)
+
+    def timestamps(self, count: int):
+        seconds = self.rng.random(count) * self.args.days * 86400
+        return [self.now - timedelta(seconds=float(s)) for s in seconds]
+
+    async def write(self, collection: str, docs: list):
+        await self.semaphore.acquire()
+
+        async def insert():
+            try:
+                await self.db[collection].insert_many(docs, ordered=False, bypass_document_validation=True)
+                self.written[collection] = self.written.get(collection, 0) + len(docs)
+            finally:
+                self.semaphore.release()
+
+        task = asyncio.create_task(insert())
+        self.inflight.add(task)
+        task.add_done_callback(self.inflight.discard)
+
+    async def flush(self):
+        if self.inflight:
+            await asyncio.gather(*list(self.inflight))
+
+    def user_doc(self, kind: str, index: int, created_at: datetime) -> dict:
+        user_number = self.user_index(kind, index)
+        user = server.User.model_construct(
+            id=self.make_id("user", user_number),
+            email=f"{kind}{index}.{self.run}@example.com",
+            name=f"Synthetic {kind.title()} {index}",
+            role=kind,
+            created_at=created_at
+        ).model_dump()
+        user['password'] = self.hash_password() if self.args.hash_per_user else self.password_hash
+        return user
+
+    async def generate_hospitals(self):
+        for start in range(0, self.args.hospitals, self.args.batch_size):
+            count = min(self.args.batch_size, self.args.hospitals - start)
+            created = self.timestamps(count)
+            users, profiles = [], []
+            for offset in range(count):
+                index = start + offset
+                users.append(self.user_doc("hospital", index, created[offset]))
+                profiles.append(server.HospitalProfile.model_construct(
+                    id=self.make_id("hospital", index),
+                    user_id=users[-1]['id'],
+                    hospital_name=f"Synthetic Hospital {index}",
+                    location=f"City {index % 1000}",
+                    contact_number=f"555-{index % 10000:04d}",
+                    coordinates=point(*self.hospital_points[index]),
+                    created_at=created[offset]
+                ).model_dump())
+            await self.write("users", users)
+            await self.write("hospital_profiles", profiles)
+
+    def organ_masks(self, count: int, donor: bool):
+        if donor:
+            masks = (self.rng.random((count, len(ORGANS))) < DONOR_ORGAN_RATES) @ (1 << np.arange(len(ORGANS)))
+            # Every donor offers at least a kidney
+            return np.where(masks == 0, 1, masks).astype(np.uint8)
+        needed = self.rng.choice(len(ORGANS), size=count, p=RECIPIENT_ORGAN_SHARES)
+        return (1 << needed).astype(np.uint8)
+
+    async def generate_profiles(self, kind: str, total: int):
+        donor = kind == "donor"
+        blood_all = np.empty(total, dtype=np.uint8)
+        organs_all = np.empty(total, dtype=np.uint8)
+        statuses, status_p = DONOR_STATUSES if donor else RECIPIENT_STATUSES
+
+        for start in range(0, total, self.args.batch_size):
+            count = min(self.args.batch_size, total - start)
+            blood = self.rng.choice(len(BLOOD_TYPES), size=count, p=BLOOD_FREQUENCIES).astype(np.uint8)
+            organs = self.organ_masks(count, donor)
+            blood_all[start:start + count] = blood
+            organs_all[start:start + count] = organs
+            ages = self.rng.integers(18, 76, count) if donor else self.rng.integers(1, 81, count)
+            status = self.rng.choice(len(statuses), size=count, p=status_p)
+            urgency = self.rng.choice(len(URGENCY_LEVELS), size=count, p=URGENCY_FREQUENCIES)
+            # Each profile is registered at a hospital and shares its coordinates
+            hospitals = self.rng.integers(0, self.args.hospitals, count) if self.args.hospitals else None
+            created = self.timestamps(count)
+
+            users, profiles = [], []
+            for offset in range(count):
+                index = start + offset
+                users.append(self.user_doc(kind, index, created[offset]))
+                organ_list = [organ for bit, organ in enumerate(ORGANS) if organs[offset] >> bit & 1]
+                fields = dict(
+                    id=self.make_id(kind, index),
+                    user_id=users[-1]['id'],
+                    blood_type=BLOOD_TYPES[blood[offset]],
+                    age=int(ages[offset]),
+                    medical_history=None,
+                    hospital_id=None,
+                    coordinates=None,
+                    status=statuses[status[offset]],
+                    created_at=created[offset]
+                )
+                if hospitals is not None:
+                    fields['hospital_id'] = self.make_id("hospital", int(hospitals[offset]))
+                    fields['coordinates'] = point(*self.hospital_points[hospitals[offset]])
+                # Matched profiles hold their organs as allocated, donated or received ones as done
+                stage = ("pool", "allocated", "done")[status[offset]]
+                fields.update({ORGAN_LISTS[kind][name]: organ_list if name == stage else [] for name in ("pool", "offered", "allocated", "done")})
+                if donor:
+                    profiles.append(server.DonorProfile.model_construct(**fields).model_dump())
+                else:
+                    profiles.append(server.RecipientProfile.model_construct(
+                        urgency_level=URGENCY_LEVELS[urgency[offset]], **fields
+                    ).model_dump())
+            await self.write("users", users)
+            await self.write(f"{kind}_profiles", profiles)
+
+        if donor:
+            self.donor_blood, self.donor_organs = blood_all, organs_all
+        else:
+            self.recipient_blood, self.recipient_organs = blood_all, organs_all
+
+    async def generate_matches(self):
+        if not (self.args.donors and self.args.recipients and self.args.hospitals):
+            return
+        statuses, status_p = MATCH_STATUSES
+        remaining = self.args.matches
+        while remaining > 0:
+            # Oversample random pairs and keep the compatible ones
+            count = min(self.args.batch_size, remaining)
+            donors = self.rng.integers(0, self.args.donors, count * 4)
+            recipients = self.rng.integers(0, self.args.recipients, count * 4)
+            shared = self.donor_organs[donors] & self.recipient_organs[recipients]
+            feasible = _COMPATIBLE[self.donor_blood[donors], self.recipient_blood[recipients]] & (shared != 0)
+            donors, recipients, shared = donors[feasible][:count], recipients[feasible][:count], shared[feasible][:count]
+            if not len(donors):
+                continue
+
+            hospitals = self.rng.integers(0, self.args.hospitals, len(donors))
+            status = self.rng.choice(len(statuses), size=len(donors), p=status_p)
+            created = self.timestamps(len(donors))
+            matches = []
+            for offset in range(len(donors)):
+                organ_bit = int(shared[offset]) & -int(shared[offset])
+                donor_blood = BLOOD_TYPES[self.donor_blood[donors[offset]]]
+                recipient_blood = BLOOD_TYPES[self.recipient_blood[recipients[offset]]]
+                matches.append(server.Match.model_construct(
+                    id=str(uuid.UUID(bytes=self.rng.bytes(16), version=4)),
+                    donor_id=self.make_id("donor", int(donors[offset])),
+                    recipient_id=self.make_id("recipient", int(recipients[offset])),
+                    organ_type=ORGANS[organ_bit.bit_length() - 1],
+                    compatibility_score=compatibility_score(donor_blood, recipient_blood),
+                    status=statuses[status[offset]],
+                    created_by=self.make_id("user", self.user_index("hospital", int(hospitals[offset]))),
+                    created_at=created[offset]
+                ).model_dump())
+            await self.write("matches", matches)
+            remaining -= len(matches)
+
+    async def generate(self):
+        self.password_hash = self.hash_password()
+        steps = [
+            ("hospitals", self.generate_hospitals()),
+            ("donors", self.generate_profiles("donor", self.args.donors)),
+            ("recipients", self.generate_profiles("recipient", self.args.recipients)),
+            ("matches", self.generate_matches()),
+        ]
+        for name, step in steps:
+            start = time.perf_counter()
+            await step
+            await self.flush()
+            print(f"{name}: done in {time.perf_counter() - start:.1f}s")
+
+
+async def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--donors", type=int, default=10000)
+    parser.add_argument("--recipients", type=int, default=10000)
+    parser.add_argument("--hospitals", type=int, default=100)
+    parser.add_argument("--matches", type=int, default=1000)
+    parser.add_argument("--days", type=int, default=1825, help="spread created_at over this many past days")
+    parser.add_argument("--password", default="synthetic-password")
+    parser.add_argument("--bcrypt-rounds", type=int, default=4, help="bcrypt cost factor (4-31)")
+    parser.add_argument("--hash-per-user", action="store_true", help="hash every user's password separately (slow)")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=4, help="insert_many batches in flight")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--drop", action="store_true", help="drop the registry collections first")
+    parser.add_argument("--no-indexes", action="store_true", help="skip applying the index manifest after loading")
+    args = parser.parse_args(argv)
+
+    client, db = storage.connect()
+    if args.drop:
+        for collection in ("users", "donor_profiles", "recipient_profiles", "hospital_profiles", "matches"):
+            await db[collection].drop()
+
+    start = time.perf_counter()
+    generator = RegistryGenerator(db, args)
+    try:
+        await generator.generate()
+        # Invalidate the ETags of cached list pages
+        await bump_versions(db, *generator.written)
+        # Recount the dashboard figures, which only track writes made through the API
+        await RegistryStats(db).reconcile()
+        print("stats: reconciled")
+        if not args.no_indexes:
+            await ensure_indexes(db)
+            print("indexes: applied")
+    finally:
+        client.close()
+
+    elapsed = time.perf_counter() - start
+    total = sum(generator.written.values())
+    for collection, count in sorted(generator.written.items()):
+        print(f"{collection}: {count} documents")
+    print(f"{total} documents in {elapsed:.1f}s ({total / elapsed:.0f} docs/s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,78 @@
+"""Hospital coordinates and transport limits for distance-aware matching.
+
+Locations are stored as GeoJSON points (``[longitude, latitude]``) on hospital
+profiles and copied onto the donor and recipient profiles registered at that
+hospital, where a ``2dsphere`` index lets the database do the distance
+filtering. A travel time is turned into a radius with an assumed door-to-door
+transport speed, and each organ type can be limited to the distance it can
+cover within its cold ischemia time.
+"""
+import math
+import os
+from typing import Dict, Iterable, List, Optional
+
+# The radius MongoDB uses to convert between radians and distances
+EARTH_RADIUS_KM = 6378.1
+
+# Hours an organ stays viable between procurement and transplant
+ORGAN_ISCHEMIA_HOURS = {
+    "heart": 4.0,
+    "lungs": 6.0,
+    "intestines": 8.0,
+    "liver": 12.0,
+    "pancreas": 12.0,
+    "kidney": 36.0,
+}
+
+
+def point(longitude: float, latitude: float) -> dict:
+    return {"type": "Point", "coordinates": [float(longitude), float(latitude)]}
+
+def km_to_radians(km: float) -> float:
+    return km / EARTH_RADIUS_KM
+
+def within_km(location: dict, km: float) -> dict:
+    """Filter on ``coordinates`` for points within ``km`` of a GeoJSON point"""
+    return {"$geoWithin": {"$centerSphere": [location["coordinates"], km_to_radians(km)]}}
+
+def haversine_km(a: List[float], b: List[float]) -> float:
+    """Great-circle distance between two ``[longitude, latitude]`` pairs"""
+    lon1, lat1, lon2, lat2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(h)))
+
+
+class TransportLimits:
+    """Maximum distance per organ type from a radius, a travel time and ischemia times"""
+
+    def __init__(self, speed_kmh: float = 500.0, ischemia_hours: Optional[Dict[str, float]] = None):
+        self.speed_kmh = speed_kmh
+        self.ischemia_hours = dict(ORGAN_ISCHEMIA_HOURS if ischemia_hours is None else ischemia_hours)
+
+    @classmethod
+    def from_env(cls) -> "TransportLimits":
+        # ORGAN_ISCHEMIA_HOURS overrides individual organs, e.g. "heart=5,lungs=8"
+        hours = dict(ORGAN_ISCHEMIA_HOURS)
+        for item in filter(None, os.environ.get('ORGAN_ISCHEMIA_HOURS', '').split(',')):
+            organ, _, value = item.partition('=')
+            hours[organ.strip()] = float(value)
+        return cls(speed_kmh=float(os.environ.get('TRANSPORT_SPEED_KMH', '500')), ischemia_hours=hours)
+
+    def radius_km(self, max_km: Optional[float] = None, max_hours: Optional[float] = None) -> Optional[float]:
+        """One distance limit from a radius and a travel time, None when neither is given"""
+        limits = [limit for limit in (max_km, None if max_hours is None else max_hours * self.speed_kmh) if limit is not None]
+        return min(limits) if limits else None
+
+    def radii_km(self, organs: Iterable[str], max_km: Optional[float] = None,
+                 max_hours: Optional[float] = None, ischemia: bool = False) -> Optional[Dict[str, float]]:
+        """The distance limit of each organ, or None when nothing limits the distance"""
+        radius = self.radius_km(max_km, max_hours)
+        if radius is None and not ischemia:
+            return None
+        radii = {}
+        for organ in dict.fromkeys(organs):
+            limits = [math.inf if radius is None else radius]
+            if ischemia and organ in self.ischemia_hours:
+                limits.append(self.ischemia_hours[organ] * self.speed_kmh)
+            radii[organ] = min(limits)
+        return radii
@@ -0,0 +1,95 @@
+"""Multi-worker launcher for the API::
+
+    cd backend && gunicorn -c gunicorn.conf.py server:app
+
+Each worker is a separate process serving ``create_app()`` under uvicorn. Its
+lifespan builds the worker's own Motor client, compatibility index and
+caches, so the MongoDB connection budget of a host is roughly
+
+    WEB_CONCURRENCY x (MONGO_MAX_POOL_SIZE + 2 monitoring connections per mongod)
+
+Size MONGO_MAX_POOL_SIZE so that this stays under the server's connection
+limit across all hosts; MONGO_MIN_POOL_SIZE (or MONGO_WARMUP_CONNECTIONS) sets
+how many connections each worker opens before accepting traffic. The app is
+not preloaded, and importing it connects to nothing: every worker opens its
+connections after the fork, so no driver threads or sockets are shared
+between processes.
+
+Settings, all optional:
+
+    BIND                      address to listen on (0.0.0.0:8001)
+    WEB_CONCURRENCY           worker processes (CPU count)
+    GUNICORN_TIMEOUT          seconds before a silent worker is restarted (60)
+    GUNICORN_GRACEFUL_TIMEOUT seconds a worker has to finish on shutdown (30)
+    GUNICORN_KEEPALIVE        idle keep-alive seconds (5)
+    GUNICORN_MAX_REQUESTS     recycle a worker after this many requests (0, never)
+
+Limits of running more than one worker:
+
+- Workers learn about each other's writes through the change stream relay,
+  which needs a replica set (or sharded cluster) and EVENTS_CHANGE_STREAMS
+  not off. Without it, reads still see every write: the index checks the
+  collection versions and reloads after another worker's write, but each
+  reload scans the profiles, push events only reach the clients of the
+  worker that made a write, and materialized potential match lists of other
+  workers lag behind.
+- STORAGE_BACKEND=memory keeps the data inside each process, so every worker
+  serves a separate, empty registry. Run it with WEB_CONCURRENCY=1.
+- Caches, admission counters and metrics are per worker; /metrics answers
+  for the worker that serves the scrape.
+
+A warning is logged on startup when several workers run without change
+streams.
+
+The access log shows paths without their query strings, which may carry SSE
+tickets.
+"""
+import multiprocessing
+import os
+from pathlib import Path
+
+bind = os.environ.get("BIND", "0.0.0.0:8001")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = False
+
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "5"))
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "0"))
+max_requests_jitter = max_requests // 10
+
+accesslog = "-"
+errorlog = "-"
+
+
+def change_streams_unavailable() -> str:
+    """Why workers cannot relay writes to each other, or an empty string when they can"""
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+    from pymongo.errors import PyMongoError
+
+    load_dotenv(Path(__file__).parent / ".env")
+    if os.environ.get("STORAGE_BACKEND", "mongo").lower() == "memory":
+        return "STORAGE_BACKEND=memory gives every worker its own separate data"
+    if os.environ.get("EVENTS_CHANGE_STREAMS", "auto").lower() == "off":
+        return "EVENTS_CHANGE_STREAMS=off disables the change stream relay"
+    client = MongoClient(os.environ["MONGO_URL"], serverSelectionTimeoutMS=5000)
+    try:
+        hello = client.admin.command("hello")
+    except PyMongoError as e:
+        return f"could not reach MongoDB to check for a replica set: {e}"
+    finally:
+        client.close()
+    if "setName" not in hello and hello.get("msg") != "isdbgrid":
+        return "MongoDB is a standalone server without change streams"
+    return ""
+
+
+def on_starting(server):
+    pool = os.environ.get("MONGO_MAX_POOL_SIZE", "100")
+    server.log.info("Starting %d workers with up to %s pooled MongoDB connections each", workers, pool)
+    if workers > 1:
+        reason = change_streams_unavailable()
+        if reason:
+            server.log.warning("%d workers without change streams (%s): see gunicorn.conf.py for the limits", workers, reason)
@@ -0,0 +1,186 @@
+"""MongoDB index manifest.
+
+Applied on API startup (unless MONGO_ENSURE_INDEXES=false) or from the command
+line::
+
+    python indexes.py           # create missing indexes
+    python indexes.py --check   # also explain every route query, fail on COLLSCAN
+"""
+import argparse
+import asyncio
+import os
+import sys
+from pathlib import Path
+from typing import List
+
+from bson import SON
+from pymongo import ASCENDING, GEOSPHERE, IndexModel
+from pymongo.errors import OperationFailure
+
+# Error code of a unique index that existing documents violate
+DUPLICATE_KEY = 11000
+
+PAGE_KEYS = [("created_at", ASCENDING), ("id", ASCENDING)]
+
+INDEXES = {
+    "users": [
+        IndexModel([("email", ASCENDING)], unique=True, name="email_unique"),
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+    ],
+    "donor_profiles": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("user_id", ASCENDING)], unique=True, name="user_id_unique"),
+        IndexModel([("status", ASCENDING), ("blood_type", ASCENDING)], name="status_blood_type"),
+        IndexModel(PAGE_KEYS, name="created_at_id"),
+        IndexModel([("hospital_id", ASCENDING)], name="hospital_id"),
+        IndexModel([("coordinates", GEOSPHERE)], name="coordinates_2dsphere"),
+    ],
+    "recipient_profiles": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("user_id", ASCENDING)], unique=True, name="user_id_unique"),
+        IndexModel([("status", ASCENDING), ("blood_type", ASCENDING)], name="status_blood_type"),
+        IndexModel(PAGE_KEYS, name="created_at_id"),
+        IndexModel([("hospital_id", ASCENDING)], name="hospital_id"),
+        IndexModel([("coordinates", GEOSPHERE)], name="coordinates_2dsphere"),
+    ],
+    "hospital_profiles": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("user_id", ASCENDING)], unique=True, name="user_id_unique"),
+        IndexModel([("coordinates", GEOSPHERE)], name="coordinates_2dsphere"),
+    ],
+    "matches": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("donor_id", ASCENDING)] + PAGE_KEYS, name="donor_id_created_at_id"),
+        IndexModel([("recipient_id", ASCENDING)] + PAGE_KEYS, name="recipient_id_created_at_id"),
+        IndexModel(PAGE_KEYS, name="created_at_id"),
+    ],
+    "potential_matches": [
+        IndexModel([("profile_id", ASCENDING)], unique=True, name="profile_id_unique"),
+        IndexModel([("user_id", ASCENDING), ("kind", ASCENDING)], name="user_id_kind"),
+        IndexModel([("computed_at", ASCENDING)], name="computed_at"),
+    ],
+}
+
+# Representative query shape of every route: (route, collection, filter, sort)
+QUERY_SHAPES = [
+    ("POST /auth/register, POST /auth/login", "users", {"email": "x@example.com"}, None),
+    ("get_current_user", "users", {"id": "x"}, None),
+    ("/donors/me", "donor_profiles", {"user_id": "x"}, None),
+    ("/recipients/me", "recipient_profiles", {"user_id": "x"}, None),
+    ("/hospitals/me", "hospital_profiles", {"user_id": "x"}, None),
+    ("POST /donors, POST /recipients hospital lookup", "hospital_profiles", {"id": "x"}, None),
+    ("POST /matches donor lookup", "donor_profiles", {"id": "x"}, None),
+    ("POST /matches recipient lookup", "recipient_profiles", {"id": "x"}, None),
+    ("compatibility index load", "donor_profiles", {"status": "available"}, None),
+    ("compatibility index load", "recipient_profiles", {"status": "waiting"}, None),
+    ("GET /matches/potential (query)", "donor_profiles",
+     {"status": "available", "blood_type": {"$in": ["O-", "A-"]}, "organs_available": {"$in": ["kidney"]}}, None),
+    ("GET /matches/potential (query)", "recipient_profiles",
+     {"status": "waiting", "blood_type": {"$in": ["A-", "A+"]}, "organs_needed": {"$in": ["kidney"]}}, None),
+    ("PUT /hospitals/me", "donor_profiles", {"hospital_id": "x"}, None),
+    ("PUT /hospitals/me", "recipient_profiles", {"hospital_id": "x"}, None),
+    ("GET /matches/potential (materialized)", "potential_matches", {"user_id": "x", "kind": "donor"}, None),
+    ("potential match worker", "potential_matches", {"profile_id": "x"}, None),
+    ("potential match rebuild", "potential_matches", {"computed_at": {"$lt": "x"}}, None),
+    ("GET /donors?max_km", "donor_profiles",
+     {"coordinates": {"$geoWithin": {"$centerSphere": [[-73.9, 40.7], 0.05]}}}, PAGE_KEYS),
+    ("GET /recipients?max_km", "recipient_profiles",
+     {"coordinates": {"$geoWithin": {"$centerSphere": [[-73.9, 40.7], 0.05]}}}, PAGE_KEYS),
+    ("GET /donors", "donor_profiles", {}, PAGE_KEYS),
+    ("GET /recipients", "recipient_profiles", {}, PAGE_KEYS),
+    ("GET /matches (hospital)", "matches", {}, PAGE_KEYS),
+    ("GET /matches (donor)", "matches", {"donor_id": "x"}, PAGE_KEYS),
+    ("GET /matches (recipient)", "matches", {"recipient_id": "x"}, PAGE_KEYS),
+]
+
+
+async def ensure_indexes(db) -> List[str]:
+    """Create the manifest's indexes, returning a message for each unique index
+    that existing duplicate values keep from being built"""
+    conflicts = []
+    for collection, indexes in INDEXES.items():
+        try:
+            await db[collection].create_indexes(indexes)
+        except OperationFailure as e:
+            if e.code != DUPLICATE_KEY:
+                raise
+            # Build the others one by one and report the keys holding up the rest
+            for index in indexes:
+                try:
+                    await db[collection].create_indexes([index])
+                except OperationFailure as e:
+                    if e.code != DUPLICATE_KEY:
+                        raise
+                    conflicts.append(await _describe_duplicates(db, collection, index))
+    return conflicts
+
+async def _describe_duplicates(db, collection: str, index: IndexModel, examples: int = 5) -> str:
+    fields = list(index.document["key"])
+    duplicates = await db[collection].aggregate([
+        {"$group": {"_id": {field.replace(".", "_"): f"${field}" for field in fields}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$sort": {"count": -1}}
+    ]).to_list(None)
+    shown = ", ".join(
+        f"{' '.join(str(value) for value in duplicate['_id'].values())} ({duplicate['count']} documents)"
+        for duplicate in duplicates[:examples]
+    )
+    more = f" and {len(duplicates) - examples} more" if len(duplicates) > examples else ""
+    return (
+        f"{collection}.{index.document['name']} not created: {len(duplicates)} duplicate "
+        f"{'/'.join(fields)} values, e.g. {shown}{more}; remove the duplicates and restart"
+    )
+
+def _plan_stages(plan: dict):
+    yield plan.get("stage")
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            yield from _plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from _plan_stages(child)
+
+async def check_query_plans(db) -> List[str]:
+    """Explain every route query shape, returning a message for each COLLSCAN"""
+    failures = []
+    for route, collection, query, sort in QUERY_SHAPES:
+        command = {"find": collection, "filter": query}
+        if sort:
+            command["sort"] = SON(sort)
+        explain = await db.command(SON([("explain", command), ("verbosity", "queryPlanner")]))
+        if "COLLSCAN" in set(_plan_stages(explain["queryPlanner"]["winningPlan"])):
+            failures.append(f"{route}: {collection} {query} sort={sort} uses COLLSCAN")
+    return failures
+
+
+async def main(argv=None) -> int:
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--check", action="store_true", help="fail if any route query does a collection scan")
+    args = parser.parse_args(argv)
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        conflicts = await ensure_indexes(db)
+        for conflict in conflicts:
+            print(conflict, file=sys.stderr)
+        if conflicts:
+            return 1
+        print("Indexes are up to date")
+        if args.check:
+            failures = await check_query_plans(db)
+            for failure in failures:
+                print(failure, file=sys.stderr)
+            if failures:
+                return 1
+            print(f"All {len(QUERY_SHAPES)} query shapes use an index")
+    finally:
+        client.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,255 @@
+"""Match status state machine and the profile updates each transition implies.
+
+A match holds one organ of its donor and recipient. Each profile keeps its
+organs in lists by stage: the pool (``organs_available`` / ``organs_needed``),
+``organs_offered`` while a match is pending, ``organs_allocated`` once it is
+accepted and ``organs_donated`` / ``organs_received`` once it is completed.
+Creating a match and every status change move the match's organ from one list
+to the next with a conditional write, so only one of several competing
+matches can take an organ, and a donor's other organs stay in the pool. The
+profile status follows from the lists: available (waiting) while any organ is
+in the pool or offered, matched once the rest are allocated, donated
+(received) when all are done.
+
+On a replica set the writes of a change run in one transaction. Elsewhere (a
+standalone server or the in-memory engine) they run in order, and the writes
+already made are compensated if a later condition fails.
+"""
+import logging
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+MATCH_TRANSITIONS = {
+    "pending": {"accepted", "rejected"},
+    "accepted": {"completed", "rejected"},
+    "rejected": set(),
+    "completed": set(),
+}
+MATCH_STATUSES = list(MATCH_TRANSITIONS)
+
+# Organ lists of each profile kind, by stage
+ORGAN_LISTS = {
+    "donor": {"pool": "organs_available", "offered": "organs_offered", "allocated": "organs_allocated", "done": "organs_donated"},
+    "recipient": {"pool": "organs_needed", "offered": "organs_offered", "allocated": "organs_allocated", "done": "organs_received"},
+}
+# Profile status while organs are in the pool or offered, once the rest are allocated, once all are done
+PROFILE_STATUSES = {"donor": ("available", "matched", "donated"), "recipient": ("waiting", "matched", "received")}
+
+# (match from, match to) -> (stage the organ leaves, stage it enters); None is the match's creation
+ORGAN_MOVES: Dict[Tuple[Optional[str], str], Tuple[str, str]] = {
+    (None, "pending"): ("pool", "offered"),
+    ("pending", "accepted"): ("offered", "allocated"),
+    ("pending", "rejected"): ("offered", "pool"),
+    ("accepted", "completed"): ("allocated", "done"),
+    ("accepted", "rejected"): ("allocated", "pool"),
+}
+
+PROFILE_KEYS = (("donor", "donor_profiles", "donor_id"), ("recipient", "recipient_profiles", "recipient_id"))
+
+TRANSACTION_RETRIES = 3
+
+# Rollback steps of a change made without a transaction: (description, write)
+Undo = List[Tuple[str, Callable[[], Awaitable[object]]]]
+
+
+class TransitionConflict(Exception):
+    """The match or one of its profiles is not in the state the transition requires"""
+
+
+def check_transition(current: str, new: str):
+    if new not in MATCH_TRANSITIONS:
+        raise ValueError(f"Unknown match status: {new}")
+    if new not in MATCH_TRANSITIONS.get(current, set()):
+        raise TransitionConflict(f"Cannot change match status from {current} to {new}")
+
+def profile_status(kind: str, profile: dict) -> str:
+    lists = ORGAN_LISTS[kind]
+    in_play, matched, done = PROFILE_STATUSES[kind]
+    if profile.get(lists["pool"]) or profile.get(lists["offered"]):
+        return in_play
+    return matched if profile.get(lists["allocated"]) else done
+
+def committed_organs(kind: str, profile: dict) -> set:
+    """Organs of a profile taken by a pending, accepted or completed match"""
+    lists = ORGAN_LISTS[kind]
+    return {organ for stage in ("offered", "allocated", "done") for organ in profile.get(lists[stage]) or []}
+
+def _status_filter(kind: str, status: str) -> dict:
+    """Condition on the organ lists under which profile_status is status"""
+    lists = ORGAN_LISTS[kind]
+    in_play, matched, _ = PROFILE_STATUSES[kind]
+    if status == in_play:
+        return {"$or": [{f"{lists['pool']}.0": {"$exists": True}}, {f"{lists['offered']}.0": {"$exists": True}}]}
+    settled = {f"{lists['pool']}.0": {"$exists": False}, f"{lists['offered']}.0": {"$exists": False}}
+    return {**settled, f"{lists['allocated']}.0": {"$exists": status == matched}}
+
+def _match_filter(match: dict, version: int) -> dict:
+    # Matches stored before versioning count as version 0
+    return {"id": match['id'], "status": match['status'], "version": {"$in": [version, None]} if version == 0 else version}
+
+async def supports_transactions(db) -> bool:
+    try:
+        hello = await db.command("hello")
+    except Exception:
+        return False
+    return bool(hello.get("setName")) or hello.get("msg") == "isdbgrid"
+
+
+async def move_organ(collection, kind: str, profile_id: str, organ: str, source: str, target: str,
+                     session=None) -> Optional[Tuple[dict, dict]]:
+    """Move an organ between two stages of a profile if it is in the first, returning (before, after).
+
+    The status is re-derived from the lists with a write conditional on them
+    still implying it; a concurrent move that changed them sets its own.
+    """
+    lists = ORGAN_LISTS[kind]
+    before = await collection.find_one_and_update(
+        {"id": profile_id, lists[source]: organ},
+        {"$pull": {lists[source]: organ}, "$push": {lists[target]: organ}},
+        projection={"_id": 0}, return_document=ReturnDocument.BEFORE, session=session
+    )
+    if before is None:
+        return None
+    after = {
+        **before,
+        lists[source]: [o for o in before.get(lists[source], []) if o != organ],
+        lists[target]: [*before.get(lists[target], []), organ],
+    }
+    await _sync_status(collection, kind, before, after, session=session)
+    return before, after
+
+async def _sync_status(collection, kind: str, before: dict, after: dict, session=None):
+    after['status'] = profile_status(kind, after)
+    if after['status'] != before.get('status'):
+        await collection.update_one(
+            {"id": before['id'], **_status_filter(kind, after['status'])},
+            {"$set": {"status": after['status']}},
+            session=session
+        )
+
+async def _move_legacy_organ(collection, kind: str, profile_id: str, organ: str, target: str,
+                             session=None) -> Optional[Tuple[dict, dict]]:
+    """Move the organ of a match stored before organs were offered, which left it in the pool"""
+    if target != "pool":
+        return await move_organ(collection, kind, profile_id, organ, "pool", target, session=session)
+    profile = await collection.find_one({"id": profile_id, ORGAN_LISTS[kind]["pool"]: organ}, {"_id": 0}, session=session)
+    if profile is None:
+        return None
+    after = dict(profile)
+    await _sync_status(collection, kind, profile, after, session=session)
+    return profile, after
+
+async def _move_organs(db, match: dict, source: str, target: str, session=None, undo: Optional[Undo] = None) -> Dict[str, Tuple[dict, dict]]:
+    profiles = {}
+    organ = match['organ_type']
+    for kind, name, key in PROFILE_KEYS:
+        moved_from = source
+        moved = await move_organ(db[name], kind, match[key], organ, source, target, session=session)
+        if moved is None and source != "pool":
+            moved = await _move_legacy_organ(db[name], kind, match[key], organ, target, session=session)
+            moved_from = "pool"
+        if moved is None:
+            stage = "available" if source == "pool" else source
+            raise TransitionConflict(f"The {kind}'s {organ} is no longer {stage}")
+        if undo is not None and moved_from != target:
+            undo.append((f"{name} {match[key]}", lambda name=name, kind=kind, key=key, moved_from=moved_from: move_organ(
+                db[name], kind, match[key], organ, target, moved_from
+            )))
+        profiles[kind] = moved
+    return profiles
+
+async def _transition_steps(db, match: dict, new_status: str, version: int, session=None, undo: Optional[Undo] = None):
+    now = datetime.now(timezone.utc)
+    updated = await db.matches.find_one_and_update(
+        _match_filter(match, version),
+        {"$set": {"status": new_status, "updated_at": now}, "$inc": {"version": 1}},
+        projection={"_id": 0}, return_document=ReturnDocument.AFTER, session=session
+    )
+    if updated is None:
+        raise TransitionConflict("Match was changed by someone else, reload and retry")
+    if undo is not None:
+        undo.append((f"matches {match['id']}", lambda: db.matches.update_one(
+            {"id": match['id'], "version": updated['version']},
+            {"$set": {"status": match['status'], "updated_at": match.get('updated_at')}, "$inc": {"version": 1}}
+        )))
+    source, target = ORGAN_MOVES[(match['status'], new_status)]
+    return updated, await _move_organs(db, match, source, target, session=session, undo=undo)
+
+async def _reserve_steps(db, match: dict, session=None, undo: Optional[Undo] = None):
+    return await _move_organs(db, match, *ORGAN_MOVES[(None, "pending")], session=session, undo=undo)
+
+async def _open_steps(db, match: dict, session=None, undo: Optional[Undo] = None):
+    profiles = await _reserve_steps(db, match, session=session, undo=undo)
+    await db.matches.insert_one(match, session=session)
+    match.pop('_id', None)
+    return profiles
+
+async def release_organs(db, match: dict) -> Dict[str, Tuple[dict, dict]]:
+    """Return the organ reserved for a match that was never stored to both pools"""
+    source, target = ORGAN_MOVES[(None, "pending")]
+    profiles = {}
+    for kind, name, key in PROFILE_KEYS:
+        moved = await move_organ(db[name], kind, match[key], match['organ_type'], target, source)
+        if moved is not None:
+            profiles[kind] = moved
+    return profiles
+
+async def rollback(undo: Undo):
+    for description, write in reversed(undo):
+        try:
+            await write()
+        except PyMongoError:
+            logger.exception("Failed to roll back %s", description)
+
+async def _run(client, steps, use_transactions: bool):
+    """Run ``steps(session=..., undo=...)`` in a transaction, or with compensating writes"""
+    if use_transactions:
+        for attempt in range(TRANSACTION_RETRIES):
+            try:
+                async with await client.start_session() as session:
+                    async with session.start_transaction():
+                        return await steps(session=session)
+            except OperationFailure as e:
+                # A concurrent change touched the same documents; the retry re-checks the conditions
+                if not e.has_error_label("TransientTransactionError") or attempt == TRANSACTION_RETRIES - 1:
+                    raise
+
+    undo: Undo = []
+    try:
+        return await steps(undo=undo)
+    except (TransitionConflict, PyMongoError):
+        await rollback(undo)
+        raise
+
+
+async def open_match(client, db, match: dict, use_transactions: bool) -> Dict[str, Tuple[dict, dict]]:
+    """Store a new pending match, offering its organ on both profiles.
+
+    Returns each profile's (before, after) and raises TransitionConflict when
+    the organ is no longer available from the donor or needed by the
+    recipient, so of two concurrent matches for the same organ one fails.
+    """
+    return await _run(client, lambda **kwargs: _open_steps(db, match, **kwargs), use_transactions)
+
+async def reserve_organs(client, db, match: dict, use_transactions: bool) -> Dict[str, Tuple[dict, dict]]:
+    """Offer the organ of a match about to be stored on both profiles, like open_match without the insert.
+
+    For bulk inserts; release_organs hands the organ back if the insert fails.
+    """
+    return await _run(client, lambda **kwargs: _reserve_steps(db, match, **kwargs), use_transactions)
+
+async def transition_match(client, db, match: dict, new_status: str, version: int,
+                           use_transactions: bool) -> Tuple[dict, Dict[str, Tuple[dict, dict]]]:
+    """Move a match to ``new_status``, returning the updated match and each profile's (before, after).
+
+    Raises ValueError for an unknown status and TransitionConflict when the
+    transition is not allowed, the version is stale or the organ has already
+    been taken by another match.
+    """
+    check_transition(match['status'], new_status)
+    return await _run(client, lambda **kwargs: _transition_steps(db, match, new_status, version, **kwargs), use_transactions)
@@ -0,0 +1,283 @@
+"""Materialized potential matches.
+
+With ``POTENTIAL_MATCH_SOURCE=materialized`` every donor and recipient profile
+has a document in ``potential_matches`` holding its current candidate list, so
+``/matches/potential`` is a single read on ``user_id``. A profile write marks
+the profile dirty; the profile fan-out (fanout.py) then marks every
+counterpart compatible with its old or new version, and a background task
+recomputes the dirty lists from the resident compatibility index and writes
+them in unordered batches. The index is brought up to date with the database
+before each batch, so lists never come from an index that missed another
+process's writes.
+
+Lists are capped at ``POTENTIAL_MATCH_CAPACITY`` candidates; a capped list
+still answers requests for up to that many. Until a dirty list is rewritten,
+or when no list is stored yet, or while profile changes still wait for
+their counterparts to be found, the endpoint computes the candidates live.
+Lists are only marked dirty by the process that made the write, so other
+workers may serve a list that lags behind by the staleness shown in the
+Prometheus metrics. Every list is rebuilt in the background on startup
+(unless ``POTENTIAL_MATCH_REBUILD=off``), with candidates computed live until it
+succeeds; a failed rebuild is retried. To rebuild every list by hand::
+
+    python materialize.py
+"""
+import asyncio
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import PyMongoError
+
+from compatibility import CompatibilityIndex
+from metrics import potential_match_staleness
+from pagination import MAX_PAGE_SIZE
+from waitlist import WaitlistQueues, indexed_candidates
+
+logger = logging.getLogger(__name__)
+
+COLLECTION = "potential_matches"
+COUNTERPART = {"donor": "recipient", "recipient": "donor"}
+
+
+class PotentialMatchStore:
+    def __init__(self, db, index: CompatibilityIndex, waitlist: WaitlistQueues,
+                 capacity: int = MAX_PAGE_SIZE, batch_size: int = 500, rebuild_on_start: bool = True,
+                 rebuild_retry_seconds: float = 5.0):
+        self.db = db
+        self.index = index
+        self.waitlist = waitlist
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.rebuild_on_start = rebuild_on_start
+        self.rebuild_retry_seconds = rebuild_retry_seconds
+        # Brings the index up to date before each batch
+        self.refresh: Optional[Callable[[], Awaitable[None]]] = None
+        # Whether changes are queued that have not marked their counterparts yet
+        self.unsettled: Optional[Callable[[], bool]] = None
+        self.rebuilding = False
+        # (kind, profile id) -> monotonic time it was first marked dirty
+        self.pending: Dict[Tuple[str, str], float] = {}
+        self._profiles: Dict[Tuple[str, str], dict] = {}
+        self._inflight: set = set()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._rebuild: Optional[asyncio.Task] = None
+        self.written = 0
+        self.hits = 0
+        self.misses = 0
+        self.last_rebuild_seconds = 0.0
+
+    @classmethod
+    def from_env(cls, db, index: CompatibilityIndex, waitlist: WaitlistQueues) -> "PotentialMatchStore":
+        return cls(
+            db, index, waitlist,
+            capacity=int(os.environ.get('POTENTIAL_MATCH_CAPACITY', str(MAX_PAGE_SIZE))),
+            rebuild_on_start=os.environ.get('POTENTIAL_MATCH_REBUILD', 'on').lower() != 'off'
+        )
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    # Change tracking
+
+    def profile_written(self, kind: str, profile: dict):
+        """Mark the list of a written donor or recipient, ahead of its counterparts'"""
+        self._mark(kind, profile['id'], profile)
+        self._wakeup.set()
+
+    def profile_changed(self, kind: str, profile: dict, counterparts: List[dict]):
+        """Mark the lists a donor or recipient write affects: its own and its counterparts'"""
+        self._mark(kind, profile['id'], profile)
+        for candidate in counterparts:
+            self._mark(COUNTERPART[kind], candidate['id'])
+        self._wakeup.set()
+
+    def _mark(self, kind: str, profile_id: str, profile: Optional[dict] = None):
+        self.pending.setdefault((kind, profile_id), time.monotonic())
+        if profile is not None:
+            self._profiles[(kind, profile_id)] = profile
+
+    def is_dirty(self, kind: str, profile_id: str) -> bool:
+        return (kind, profile_id) in self.pending or (kind, profile_id) in self._inflight
+
+    # Reads
+
+    async def read(self, kind: str, user_id: str, limit: Optional[int] = None) -> Optional[List[dict]]:
+        """The stored candidates of a user's profile, None when they must be computed live"""
+        if self.rebuilding or (self.unsettled is not None and self.unsettled()):
+            self.misses += 1
+            return None
+        doc = await self.db[COLLECTION].find_one({"user_id": user_id, "kind": kind}, {"_id": 0})
+        if (
+            doc is None
+            or self.is_dirty(kind, doc['profile_id'])
+            or (not doc['complete'] and (limit is None or limit > len(doc['candidates'])))
+        ):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return doc['candidates'][:limit]
+
+    # Writes
+
+    def document(self, kind: str, profile: dict) -> dict:
+        candidates = indexed_candidates(self.index, self.waitlist, COUNTERPART[kind], profile, self.capacity + 1)
+        return {
+            "profile_id": profile['id'],
+            "kind": kind,
+            "user_id": profile['user_id'],
+            "candidates": candidates[:self.capacity],
+            "complete": len(candidates) <= self.capacity,
+            "computed_at": datetime.now(timezone.utc)
+        }
+
+    async def _load(self, kind: str, profile_id: str) -> Optional[dict]:
+        profile = self.index.get_donor(profile_id) if kind == 'donor' else self.index.get_recipient(profile_id)
+        if profile is None:
+            profile = await self.db[f"{kind}_profiles"].find_one({"id": profile_id}, {"_id": 0})
+        return profile
+
+    async def _materialize(self, batch: List[Tuple[Tuple[str, str], float]]):
+        operations = []
+        for key, _ in batch:
+            kind, profile_id = key
+            profile = self._profiles.pop(key, None) or await self._load(kind, profile_id)
+            if profile is None:
+                operations.append(DeleteOne({"profile_id": profile_id}))
+            else:
+                operations.append(UpdateOne({"profile_id": profile_id}, {"$set": self.document(kind, profile)}, upsert=True))
+        await self.db[COLLECTION].bulk_write(operations, ordered=False)
+        self.written += len(operations)
+        now = time.monotonic()
+        for _, queued_at in batch:
+            potential_match_staleness.observe(now - queued_at)
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self.pending:
+                batch = []
+                for key in list(self.pending)[:self.batch_size]:
+                    batch.append((key, self.pending.pop(key)))
+                    self._inflight.add(key)
+                try:
+                    if self.refresh is not None:
+                        await self.refresh()
+                    await self._materialize(batch)
+                except PyMongoError:
+                    logger.exception("Failed to write %d potential match lists, retrying", len(batch))
+                    for key, queued_at in batch:
+                        self.pending.setdefault(key, queued_at)
+                    await asyncio.sleep(1)
+                finally:
+                    self._inflight.clear()
+                # Let requests in between batches
+                await asyncio.sleep(0)
+
+    def start(self, refresh: Optional[Callable[[], Awaitable[None]]] = None, unsettled: Optional[Callable[[], bool]] = None):
+        self.refresh = refresh
+        self.unsettled = unsettled
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        if self.rebuild_on_start and self._rebuild is None:
+            self.rebuilding = True
+            self._rebuild = asyncio.create_task(self._rebuild_on_start())
+
+    async def _rebuild_on_start(self):
+        # Lists may predate writes made while no worker was materializing, so
+        # they are only served once a rebuild succeeded
+        while True:
+            try:
+                if self.refresh is not None:
+                    await self.refresh()
+                count = await self.rebuild()
+                break
+            except PyMongoError:
+                logger.exception("Failed to rebuild the potential match lists, computing candidates live and retrying")
+                await asyncio.sleep(self.rebuild_retry_seconds)
+        logger.info("Rebuilt %d potential match lists in %.1fs", count, self.last_rebuild_seconds)
+        self.rebuilding = False
+
+    async def stop(self):
+        if self._rebuild is not None:
+            self._rebuild.cancel()
+            try:
+                await self._rebuild
+            except asyncio.CancelledError:
+                pass
+            self._rebuild = None
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def rebuild(self) -> int:
+        """Rewrite the list of every profile and drop lists of profiles that no longer exist"""
+        start, started_at = time.perf_counter(), datetime.now(timezone.utc)
+        count = 0
+        for kind in ("donor", "recipient"):
+            operations = []
+            async for profile in self.db[f"{kind}_profiles"].find({}, {"_id": 0}):
+                # The index may already hold a newer version than the cursor
+                profile = (self.index.get_donor if kind == 'donor' else self.index.get_recipient)(profile['id']) or profile
+                operations.append(UpdateOne({"profile_id": profile['id']}, {"$set": self.document(kind, profile)}, upsert=True))
+                if len(operations) >= self.batch_size:
+                    await self.db[COLLECTION].bulk_write(operations, ordered=False)
+                    count += len(operations)
+                    operations = []
+            if operations:
+                await self.db[COLLECTION].bulk_write(operations, ordered=False)
+                count += len(operations)
+        await self.db[COLLECTION].delete_many({"computed_at": {"$lt": started_at}})
+        self.last_rebuild_seconds = time.perf_counter() - start
+        return count
+
+    def stats(self) -> dict:
+        oldest = min(self.pending.values(), default=None)
+        return {
+            "running": int(self.running),
+            "pending": len(self.pending),
+            "oldest_pending_seconds": 0.0 if oldest is None else time.monotonic() - oldest,
+            "written": self.written,
+            "hits": self.hits,
+            "misses": self.misses,
+            "capacity": self.capacity,
+            "rebuilding": int(self.rebuilding),
+            "last_rebuild_seconds": self.last_rebuild_seconds
+        }
+
+
+async def main() -> int:
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    from indexes import INDEXES
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], tz_aware=True)
+    db = client[os.environ['DB_NAME']]
+    try:
+        await db[COLLECTION].create_indexes(INDEXES[COLLECTION])
+        index = CompatibilityIndex()
+        await index.load(db)
+        store = PotentialMatchStore.from_env(db, index, WaitlistQueues(index))
+        count = await store.rebuild()
+        print(f"Rebuilt {count} potential match lists in {store.last_rebuild_seconds:.1f}s")
+    finally:
+        client.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,351 @@
+"""Process metrics in the Prometheus text exposition format.
+
+Covers request latency per route and role, MongoDB command timings from
+pymongo command monitoring, connection pool checkout wait, password hashing
+time and event-loop lag. Metrics are per process, so each worker is scraped
+separately. The server exposes them at ``/metrics``, outside ``/api``, only
+when ``METRICS_TOKEN`` is set and only to scrapers sending it as a bearer
+token.
+"""
+import asyncio
+import bisect
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import monitoring
+
+from codec import serialization_time
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # pymongo listeners report from driver threads
+        self._lock = threading.Lock()
+        self._series: Dict[Tuple[str, ...], object] = {}
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            series = sorted(self._series.items())
+        for key, value in series:
+            lines.extend(self._render_series(key, value))
+        return lines
+
+    def _render_series(self, key, value) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(value)}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._series[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket counts (not cumulative), then sum and count
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            if position < len(self.buckets):
+                series[0][position] += 1
+            series[1] += value
+            series[2] += 1
+
+    def _render_series(self, key, value) -> List[str]:
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts + [count - sum(counts)]):
+            cumulative += bucket_count
+            le = 'le="%s"' % _number(bound)
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+        lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        # Called before rendering to refresh gauges from component stats
+        self.collectors: List[Callable[[], None]] = []
+        # Current stats() source of each stats gauge, by name
+        self._stats_sources: Dict[str, Callable[[], dict]] = {}
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._add(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Gauge:
+        return self._add(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def _add(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def stats_gauge(self, name: str, documentation: str, stats: Callable[[], dict]) -> None:
+        """Gauge labelled by field over the numeric values of a component's stats() dict.
+
+        Registering a name again points its gauge at the new component, as
+        when the application's services are rebuilt.
+        """
+        if name not in self._stats_sources:
+            gauge = self.gauge(name, documentation, ["field"])
+
+            def collect():
+                for field, value in self._stats_sources[name]().items():
+                    if isinstance(value, (int, float)):
+                        gauge.set(value, field=field)
+
+            self.collectors.append(collect)
+        self._stats_sources[name] = stats
+
+    def render(self) -> str:
+        for collect in self.collectors:
+            try:
+                collect()
+            except Exception:
+                logger.exception("Metrics collector failed")
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "Request latency by route template and caller role",
+    ["method", "route", "role"]
+)
+http_requests = registry.counter(
+    "http_requests_total", "Requests by route template, caller role and status code",
+    ["method", "route", "role", "status"]
+)
+http_serialization_duration = registry.histogram(
+    "http_response_serialization_seconds", "JSON encoding time per request by route template",
+    ["method", "route"], FAST_BUCKETS
+)
+http_response_bytes = registry.counter(
+    "http_response_bytes_total", "Response body bytes sent, after compression, by route template",
+    ["method", "route"]
+)
+mongo_command_duration = registry.histogram(
+    "mongodb_command_duration_seconds", "MongoDB command round trips by collection and operation",
+    ["collection", "operation"], FAST_BUCKETS
+)
+mongo_command_failures = registry.counter(
+    "mongodb_command_failures_total", "Failed MongoDB commands by collection and operation",
+    ["collection", "operation"]
+)
+mongo_checkout_wait = registry.histogram(
+    "mongodb_pool_checkout_wait_seconds", "Time spent waiting to check a connection out of the pool",
+    buckets=FAST_BUCKETS
+)
+mongo_checkout_failures = registry.counter(
+    "mongodb_pool_checkout_failures_total", "Connection checkouts that failed, by reason", ["reason"]
+)
+password_duration = registry.histogram(
+    "password_hash_duration_seconds", "bcrypt hash and verify time including pool queueing", ["operation"]
+)
+potential_match_staleness = registry.histogram(
+    "potential_matches_staleness_seconds", "Delay between a profile write and the rewrite of the candidate lists it affects"
+)
+event_loop_lag = registry.gauge("event_loop_lag_seconds", "Most recent event-loop scheduling delay")
+event_loop_lag_histogram = registry.histogram(
+    "event_loop_lag_observed_seconds", "Event-loop scheduling delay samples", buckets=FAST_BUCKETS
+)
+
+
+class CommandTimer(monitoring.CommandListener):
+    """Times every MongoDB command, labelled by collection and operation"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._collections: Dict[Tuple[int, object], str] = {}
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        collection = event.command.get("collection") if event.command_name == "getMore" else target
+        with self._lock:
+            self._collections[(event.request_id, event.connection_id)] = collection if isinstance(collection, str) else ""
+
+    def _collection(self, event) -> str:
+        with self._lock:
+            return self._collections.pop((event.request_id, event.connection_id), "")
+
+    def succeeded(self, event):
+        mongo_command_duration.observe(event.duration_micros / 1e6, collection=self._collection(event), operation=event.command_name)
+
+    def failed(self, event):
+        collection = self._collection(event)
+        mongo_command_duration.observe(event.duration_micros / 1e6, collection=collection, operation=event.command_name)
+        mongo_command_failures.inc(collection=collection, operation=event.command_name)
+
+
+class CheckoutTimer(monitoring.ConnectionPoolListener):
+    """Measures pool checkout wait; a checkout starts and finishes on the same driver thread"""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        started = getattr(self._local, "started", None)
+        if started is not None:
+            mongo_checkout_wait.observe(time.perf_counter() - started)
+            self._local.started = None
+
+    def connection_check_out_failed(self, event):
+        self._local.started = None
+        mongo_checkout_failures.inc(reason=event.reason)
+
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_created(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_closed(self, event): pass
+    def connection_checked_in(self, event): pass
+
+
+def mongo_listeners() -> list:
+    return [CommandTimer(), CheckoutTimer()]
+
+
+class LoopLagMonitor:
+    """Samples how late the event loop wakes a sleeping task"""
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start - self.interval)
+            event_loop_lag.set(lag)
+            event_loop_lag_histogram.observe(lag)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class RequestMetricsMiddleware:
+    """ASGI middleware timing each HTTP request.
+
+    The route label is the matched path template, so ids in the URL do not
+    create new series. The role label comes from ``request.state.role``, which
+    the auth dependencies set once the caller is known. JSON encoding time is
+    also reported to the client in a ``Server-Timing`` header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        scope.setdefault("state", {})
+        status = 500
+        sent = 0
+        encoding = [0.0]
+        token = serialization_time.set(encoding)
+
+        async def send_wrapper(message):
+            nonlocal status, sent
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                timing = f"serialize;dur={encoding[0] * 1000:.3f}".encode()
+                message = {**message, "headers": [*message.get("headers", []), (b"server-timing", timing)]}
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            serialization_time.reset(token)
+            elapsed = time.perf_counter() - start
+            route = scope.get("route")
+            labels = {
+                "method": scope["method"],
+                # Requests shed before routing carry the template admission control matched
+                "route": getattr(route, "path", None) or scope["state"].get("route_template", "unmatched"),
+                "role": scope["state"].get("role", "anonymous"),
+            }
+            http_request_duration.observe(elapsed, **labels)
+            http_requests.inc(status=status, **labels)
+            http_serialization_duration.observe(encoding[0], method=labels["method"], route=labels["route"])
+            http_response_bytes.inc(sent, method=labels["method"], route=labels["route"])
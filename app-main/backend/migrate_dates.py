@@ -0,0 +1,66 @@
+"""One-off migration of ISO-string dates to native BSON datetimes.
+
+    python migrate_dates.py
+
+Safe to re-run: only documents whose date fields are still strings are touched.
+The API server also runs it on startup when string dates remain, since keyset
+pagination cannot order string and native dates together.
+"""
+import asyncio
+import os
+import sys
+from pathlib import Path
+from typing import List
+
+from pymongo import UpdateOne
+
+from codec import DATE_FIELDS, parse_date
+from etags import bump_versions
+
+COLLECTIONS = ["users", "donor_profiles", "recipient_profiles", "hospital_profiles", "matches"]
+BATCH_SIZE = 1000
+
+
+async def string_date_collections(db) -> List[str]:
+    """The collections that still hold a date field as a string"""
+    return [
+        collection for collection in COLLECTIONS
+        if await db[collection].find_one({"$or": [{field: {"$type": "string"}} for field in DATE_FIELDS]}, {"_id": 1})
+    ]
+
+async def migrate_string_dates(db) -> dict:
+    migrated = {}
+    for collection in COLLECTIONS:
+        count = 0
+        for field in DATE_FIELDS:
+            batch = []
+            async for doc in db[collection].find({field: {"$type": "string"}}, {"_id": 1, field: 1}):
+                batch.append(UpdateOne({"_id": doc["_id"], field: doc[field]}, {"$set": {field: parse_date(doc[field])}}))
+                if len(batch) >= BATCH_SIZE:
+                    count += (await db[collection].bulk_write(batch, ordered=False)).modified_count
+                    batch = []
+            if batch:
+                count += (await db[collection].bulk_write(batch, ordered=False)).modified_count
+        migrated[collection] = count
+        if count:
+            await bump_versions(db, collection)
+    return migrated
+
+
+async def main() -> int:
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], tz_aware=True)
+    try:
+        migrated = await migrate_string_dates(client[os.environ['DB_NAME']])
+    finally:
+        client.close()
+    for collection, count in migrated.items():
+        print(f"{collection}: {count} documents migrated")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,78 @@
+import base64
+import json
+from datetime import datetime
+from typing import AsyncIterator, List, Optional, Tuple
+
+from codec import dumps, parse_date
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Stable keyset order: creation time, with the unique id as tie-breaker
+PAGE_SORT = [("created_at", 1), ("id", 1)]
+
+# Flush streamed NDJSON to the client once this many bytes are buffered
+STREAM_CHUNK_BYTES = 64 * 1024
+
+
+def encode_cursor(doc: dict) -> str:
+    created_at = doc['created_at']
+    if isinstance(created_at, datetime):
+        # Tagged so the cursor compares against native dates, not strings
+        created_at = {"$date": dumps(created_at).strip('"')}
+    raw = json.dumps([created_at, doc['id']]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[object, str]:
+    """Inverse of encode_cursor, raising ValueError for malformed cursors"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, doc_id = json.loads(raw)
+        if isinstance(created_at, dict):
+            created_at = parse_date(created_at["$date"])
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(doc_id, str):
+        raise ValueError("Invalid cursor")
+    return created_at, doc_id
+
+def after_cursor(query: dict, cursor: Optional[str]) -> dict:
+    """Restrict query to the documents that sort after cursor"""
+    if not cursor:
+        return query
+    created_at, doc_id = decode_cursor(cursor)
+    keyset = {"$or": [
+        {"created_at": {"$gt": created_at}},
+        {"created_at": created_at, "id": {"$gt": doc_id}}
+    ]}
+    return {"$and": [query, keyset]} if query else keyset
+
+async def fetch_page(collection, query: dict, limit: int, cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+    """One page of documents in keyset order plus the cursor of the next page, if any"""
+    docs = await collection.find(after_cursor(query, cursor), {"_id": 0}).sort(PAGE_SORT).limit(limit + 1).to_list(limit + 1)
+    if len(docs) > limit:
+        del docs[limit:]
+        return docs, encode_cursor(docs[-1])
+    return docs, None
+
+def ndjson_stream(collection, query: dict, cursor: Optional[str] = None) -> AsyncIterator[str]:
+    """Newline-delimited JSON for every matching document as the cursor produces it.
+
+    The cursor is decoded before anything is streamed, so a malformed one
+    raises ValueError here rather than once the response has started.
+    """
+    return _ndjson_chunks(collection.find(after_cursor(query, cursor), {"_id": 0}).sort(PAGE_SORT))
+
+async def _ndjson_chunks(docs) -> AsyncIterator[str]:
+    buffer = []
+    size = 0
+    async for doc in docs:
+        line = dumps(doc) + "\n"
+        buffer.append(line)
+        size += len(line)
+        if size >= STREAM_CHUNK_BYTES:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer)
@@ -0,0 +1,119 @@
+import asyncio
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+from passlib.context import CryptContext
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+# Module level so they can be pickled into a process pool
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+def _verify(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+def _noop():
+    return None
+
+
+class PasswordPoolFull(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("Password hashing pool is saturated")
+        self.retry_after = retry_after
+
+
+class PasswordHasher:
+    """Runs bcrypt work in a bounded worker pool so it never blocks the event loop.
+
+    At most ``workers`` jobs run at once and at most ``queue_size`` more wait for
+    a worker. Further calls are rejected with PasswordPoolFull straight away
+    instead of queueing without bound.
+    """
+
+    def __init__(self, mode: str = "thread", workers: Optional[int] = None, queue_size: Optional[int] = None):
+        if mode not in ("thread", "process"):
+            raise ValueError(f"Unknown password pool mode: {mode}")
+        self.mode = mode
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = self.workers * 8 if queue_size is None else queue_size
+        self._executor: Optional[Executor] = None
+        self.pending = 0
+        self.max_pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.busy_seconds = 0.0
+
+    @classmethod
+    def from_env(cls) -> "PasswordHasher":
+        workers = os.environ.get('PASSWORD_POOL_WORKERS')
+        queue_size = os.environ.get('PASSWORD_POOL_QUEUE')
+        return cls(
+            mode=os.environ.get('PASSWORD_POOL_MODE', 'thread'),
+            workers=int(workers) if workers else None,
+            queue_size=int(queue_size) if queue_size else None
+        )
+
+    @property
+    def capacity(self) -> int:
+        return self.workers + self.queue_size
+
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.mode == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        return self._executor
+
+    async def hash(self, password: str) -> str:
+        return await self._run(_hash, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(_verify, plain_password, hashed_password)
+
+    async def _run(self, fn, *args):
+        if self.pending >= self.capacity:
+            self.rejected += 1
+            raise PasswordPoolFull(retry_after=self._retry_after())
+
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor(), fn, *args)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+            self.busy_seconds += time.perf_counter() - start
+
+    async def warm_up(self):
+        """Start the pool's workers, so the first logins do not pay for it"""
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self.executor(), _noop) for _ in range(self.workers)))
+
+    def _retry_after(self) -> int:
+        # Time for the queue ahead to drain, from the mean job duration so far
+        mean = self.busy_seconds / self.completed if self.completed else 0.25
+        return max(1, round(mean * self.capacity / self.workers))
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "in_flight": min(self.pending, self.workers),
+            "queue_depth": max(0, self.pending - self.workers),
+            "max_depth": max(0, self.max_pending - self.workers),
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "busy_seconds": round(self.busy_seconds, 3)
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,102 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional
+
+
+class PrincipalCache:
+    """TTL and size-bounded LRU cache of authenticated users keyed by user id.
+
+    Concurrent misses for the same user share one loader call, so a dashboard
+    firing several authenticated requests at once costs a single lookup.
+    Anything in this process that writes a user document must call
+    ``invalidate``, which also keeps a load already under way from caching
+    what it read. Users that were not found are not cached, so new accounts
+    are seen at once; writes made by other processes show up within ``ttl``.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._loading: Dict[str, asyncio.Future] = {}
+        # Bumped by invalidate while a load is in flight, whose result is then not cached
+        self._generations: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls) -> "PrincipalCache":
+        return cls(
+            maxsize=int(os.environ.get('PRINCIPAL_CACHE_SIZE', 10000)),
+            ttl=float(os.environ.get('PRINCIPAL_CACHE_TTL', 60))
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, user_id: str) -> Optional[dict]:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        expires, user = entry
+        if expires < time.monotonic():
+            del self._entries[user_id]
+            return None
+        self._entries.move_to_end(user_id)
+        # Handlers mutate the principal they receive, so hand out copies
+        return dict(user)
+
+    def put(self, user_id: str, user: dict):
+        if not self.enabled:
+            return
+        self._entries[user_id] = (time.monotonic() + self.ttl, dict(user))
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: str):
+        self._entries.pop(user_id, None)
+        if user_id in self._loading:
+            # The load may have read the old document; later callers start a new one
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            del self._loading[user_id]
+
+    def clear(self):
+        self._entries.clear()
+
+    async def get_or_load(self, user_id: str, loader: Callable[[str], Awaitable[Optional[dict]]]) -> Optional[dict]:
+        user = self.get(user_id)
+        if user is not None:
+            self.hits += 1
+            return user
+        self.misses += 1
+
+        pending = self._loading.get(user_id)
+        if pending is None:
+            pending = asyncio.ensure_future(self._load(user_id, loader, self._generations.get(user_id, 0)))
+            self._loading[user_id] = pending
+        user = await asyncio.shield(pending)
+        return dict(user) if user is not None else None
+
+    async def _load(self, user_id: str, loader, generation: int) -> Optional[dict]:
+        try:
+            user = await loader(user_id)
+        finally:
+            current = self._generations.get(user_id, 0) == generation
+            if current:
+                del self._loading[user_id]
+        if user is not None and current:
+            self.put(user_id, user)
+        return user
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses
+        }
@@ -0,0 +1,459 @@
+"""Bulk import and export of donor and recipient registries.
+
+Hospitals onboard an existing registry from a CSV or Parquet file instead of
+registering every donor and recipient through the API. Files are read
+``--chunk-size`` rows at a time, every row is validated against
+DonorProfileCreate or RecipientProfileCreate, and each chunk is written with
+unordered insert_many batches, a few in flight at once, so memory stays
+constant whatever the size of the file::
+
+    python registry_io.py import donors registry.csv --hospital-id <hospital profile id>
+    python registry_io.py export matches matches.parquet
+
+Every row also needs ``email`` and ``name`` columns: it creates the user
+account holding the profile. Imported accounts have no password and cannot
+sign in. The organ list columns are ``;``-separated in CSV files and may be
+native lists in Parquet files. Rows without a ``hospital_id`` are registered
+at the importing hospital. A row that fails validation, names an unknown
+hospital or an email that is already registered is skipped and reported.
+
+Exports stream profiles or matches in keyset order, one chunk at a time;
+profile coordinates become ``longitude`` and ``latitude`` columns. Parquet
+needs ``pyarrow``.
+
+The API offers the same as ``POST /api/registry/{donors,recipients}/import``
+and ``GET /api/registry/{donors,recipients,matches}/export``. Running servers
+see rows imported with the CLI through change streams; without a replica set,
+restart them (and run ``python materialize.py`` when potential matches are
+materialized).
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, timezone
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError
+
+from codec import format_date, parse_date
+from pagination import PAGE_SORT
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+FORMATS = ("csv", "parquet")
+MEDIA_TYPES = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+# Rows read, validated and written per insert_many batch
+CHUNK_SIZE = 5000
+# Separator of the values in a CSV list cell
+LIST_SEPARATOR = ";"
+# Row errors listed in an import report; "failed" counts all of them
+MAX_REPORTED_ERRORS = 100
+
+IMPORT_KINDS = {"donors": "donor", "recipients": "recipient"}
+EXPORT_COLLECTIONS = {"donors": "donor_profiles", "recipients": "recipient_profiles", "matches": "matches"}
+LIST_FIELDS = {"donor": "organs_available", "recipient": "organs_needed"}
+
+_PROFILE_HEAD = [("id", "string"), ("user_id", "string"), ("blood_type", "string"), ("age", "int")]
+_PROFILE_TAIL = [
+    ("medical_history", "string"), ("hospital_id", "string"), ("longitude", "float"), ("latitude", "float"),
+    ("status", "string"), ("created_at", "timestamp")
+]
+# Exported columns of each collection and their types
+EXPORT_COLUMNS = {
+    "donor_profiles": _PROFILE_HEAD + [
+        ("organs_available", "list"), ("organs_offered", "list"), ("organs_allocated", "list"), ("organs_donated", "list")
+    ] + _PROFILE_TAIL,
+    "recipient_profiles": _PROFILE_HEAD + [
+        ("organs_needed", "list"), ("organs_offered", "list"), ("organs_allocated", "list"), ("organs_received", "list"),
+        ("urgency_level", "string")
+    ] + _PROFILE_TAIL,
+    "matches": [
+        ("id", "string"), ("donor_id", "string"), ("recipient_id", "string"), ("organ_type", "string"),
+        ("compatibility_score", "int"), ("status", "string"), ("created_by", "string"),
+        ("created_at", "timestamp"), ("updated_at", "timestamp"), ("version", "int")
+    ],
+}
+
+
+def file_format(filename: Optional[str], fmt: Optional[str] = None) -> str:
+    """The format given, or else the one of the file extension; ValueError if unsupported"""
+    fmt = (fmt or os.path.splitext(filename or "")[1].lstrip(".")).lower()
+    if fmt == "pq":
+        fmt = "parquet"
+    if fmt not in FORMATS:
+        raise ValueError("Unsupported file format, use csv or parquet")
+    if fmt == "parquet" and pq is None:
+        raise ValueError("Parquet support needs pyarrow")
+    return fmt
+
+def read_chunks(source, fmt: str, chunk_size: int = CHUNK_SIZE) -> Iterator[List[dict]]:
+    """Rows of a CSV or Parquet file (a path or binary file object), ``chunk_size`` at a time"""
+    if fmt == "csv":
+        # Every cell as text: the models coerce numbers, and empty cells stay ""
+        with pd.read_csv(source, chunksize=chunk_size, dtype=str, keep_default_na=False) as reader:
+            for frame in reader:
+                yield frame.to_dict("records")
+    else:
+        for batch in pq.ParquetFile(source).iter_batches(batch_size=chunk_size):
+            yield batch.to_pylist()
+
+def clean_row(kind: str, row: dict) -> dict:
+    cleaned = {}
+    for key, value in row.items():
+        if isinstance(value, str):
+            value = value.strip() or None
+        cleaned[str(key).strip()] = value
+    organs = cleaned.get(LIST_FIELDS[kind])
+    if isinstance(organs, str):
+        cleaned[LIST_FIELDS[kind]] = [organ.strip() for organ in organs.split(LIST_SEPARATOR) if organ.strip()]
+    return cleaned
+
+def error_detail(error: Exception) -> str:
+    if isinstance(error, ValidationError):
+        return "; ".join(f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in error.errors())
+    return str(error)
+
+
+class RegistryImporter:
+    """Validates the rows of one file and writes them as users and donor or recipient profiles.
+
+    ``create_model`` validates a row, ``profile_model`` and ``user_model``
+    build the stored documents. ``on_written(kind, profiles)`` is called with
+    every batch of profiles written, ``on_users_written(user_ids)`` with the
+    ids of every batch of users inserted or removed again.
+    """
+
+    def __init__(self, db, kind: str, create_model, profile_model, user_model, hospital_id: Optional[str] = None,
+                 chunk_size: int = CHUNK_SIZE, concurrency: int = 4,
+                 on_written: Optional[Callable[[str, List[dict]], None]] = None,
+                 on_users_written: Optional[Callable[[List[str]], None]] = None):
+        self.db = db
+        self.kind = kind
+        self.create_model = create_model
+        self.profile_model = profile_model
+        self.user_model = user_model
+        self.hospital_id = hospital_id
+        self.chunk_size = chunk_size
+        self.on_written = on_written
+        self.on_users_written = on_users_written
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.inflight = set()
+        # Hospital profile id -> its coordinates, or False when there is no such hospital
+        self.hospitals: Dict[str, object] = {}
+        self.rows = 0
+        self.imported = 0
+        self.failed = 0
+        self.errors: List[dict] = []
+
+    def fail(self, row: int, detail: str):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"row": row, "detail": detail})
+
+    # validate and build run in a worker thread and return their row errors
+
+    def validate(self, rows: List[dict], first: int) -> Tuple[List[Tuple[int, dict, object]], List[Tuple[int, str]]]:
+        valid, errors = [], []
+        for number, row in enumerate(rows, first):
+            row = clean_row(self.kind, row)
+            try:
+                user = self.user_model(email=row.get("email"), name=row.get("name"), role=self.kind)
+                data = self.create_model.model_validate(row)
+            except ValueError as e:
+                errors.append((number, error_detail(e)))
+                continue
+            if data.hospital_id is None:
+                data.hospital_id = self.hospital_id
+            valid.append((number, user.model_dump(), data))
+        return valid, errors
+
+    async def resolve_hospitals(self, valid: List[Tuple[int, dict, object]]):
+        missing = {data.hospital_id for _, _, data in valid if data.hospital_id is not None} - self.hospitals.keys()
+        if not missing:
+            return
+        async for hospital in self.db.hospital_profiles.find({"id": {"$in": list(missing)}}, {"_id": 0, "id": 1, "coordinates": 1}):
+            self.hospitals[hospital['id']] = hospital.get('coordinates')
+        for hospital_id in missing:
+            self.hospitals.setdefault(hospital_id, False)
+
+    def build(self, valid: List[Tuple[int, dict, object]]) -> Tuple[List[int], List[dict], List[dict], List[Tuple[int, str]]]:
+        numbers, users, profiles, errors = [], [], [], []
+        for number, user, data in valid:
+            coordinates = None if data.hospital_id is None else self.hospitals[data.hospital_id]
+            if coordinates is False:
+                errors.append((number, "Hospital not found"))
+                continue
+            profile = self.profile_model(user_id=user['id'], **{**data.model_dump(), "coordinates": coordinates})
+            # Imported accounts cannot sign in until a password is set
+            user['password'] = None
+            numbers.append(number)
+            users.append(user)
+            profiles.append(profile.model_dump())
+        return numbers, users, profiles, errors
+
+    async def insert(self, collection: str, docs: List[dict], numbers: List[int], duplicate: str) -> set:
+        """Positions of the documents that could not be written"""
+        try:
+            await self.db[collection].insert_many(docs, ordered=False)
+            return set()
+        except BulkWriteError as e:
+            failed = set()
+            for error in e.details['writeErrors']:
+                failed.add(error['index'])
+                self.fail(numbers[error['index']], duplicate if error['code'] == 11000 else error['errmsg'])
+            return failed
+
+    async def write(self, numbers: List[int], users: List[dict], profiles: List[dict]):
+        try:
+            failed = await self.insert("users", users, numbers, "Email already registered")
+            kept = [position for position in range(len(users)) if position not in failed]
+            numbers, users, profiles = ([items[position] for position in kept] for items in (numbers, users, profiles))
+            self.users_written([user['id'] for user in users])
+            if not profiles:
+                return
+            failed = await self.insert(f"{self.kind}_profiles", profiles, numbers, "Profile already exists")
+            if failed:
+                orphans = [users[position]['id'] for position in failed]
+                await self.db.users.delete_many({"id": {"$in": orphans}})
+                self.users_written(orphans)
+            written = [profile for position, profile in enumerate(profiles) if position not in failed]
+            for profile in written:
+                profile.pop('_id', None)
+            self.imported += len(written)
+            if written and self.on_written is not None:
+                self.on_written(self.kind, written)
+        finally:
+            self.semaphore.release()
+
+    def users_written(self, user_ids: List[str]):
+        if user_ids and self.on_users_written is not None:
+            self.on_users_written(user_ids)
+
+    async def load(self, rows: List[dict]):
+        first = self.rows + 1
+        self.rows += len(rows)
+        valid, invalid = await asyncio.to_thread(self.validate, rows, first)
+        await self.resolve_hospitals(valid)
+        numbers, users, profiles, unplaced = await asyncio.to_thread(self.build, valid)
+        for number, detail in invalid + unplaced:
+            self.fail(number, detail)
+        if not users:
+            return
+        await self.semaphore.acquire()
+        task = asyncio.create_task(self.write(numbers, users, profiles))
+        self.inflight.add(task)
+        task.add_done_callback(self.inflight.discard)
+
+    async def run(self, source, fmt: str) -> dict:
+        """Import every row of a file, returning the report"""
+        start = time.perf_counter()
+        chunks = read_chunks(source, fmt, self.chunk_size)
+        error = None
+        try:
+            while True:
+                # Parsing runs in a thread, so requests keep being served during an upload
+                rows = await asyncio.to_thread(next, chunks, None)
+                if rows is None:
+                    break
+                await self.load(rows)
+        except ValueError as e:
+            # Unreadable file: what was read so far stays imported
+            error = f"Could not read the file after row {self.rows}: {e}"
+        finally:
+            chunks.close()
+            if self.inflight:
+                await asyncio.gather(*list(self.inflight))
+        report = {
+            "rows": self.rows,
+            "imported": self.imported,
+            "failed": self.failed,
+            "errors": sorted(self.errors, key=lambda error: error["row"]),
+            "seconds": round(time.perf_counter() - start, 3)
+        }
+        if error:
+            report["error"] = error
+        return report
+
+
+def _timestamp(value) -> Optional[datetime]:
+    if value is None:
+        return None
+    value = parse_date(value)
+    return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
+
+def export_row(doc: dict, columns: List[Tuple[str, str]]) -> dict:
+    row = {}
+    longitude, latitude = (doc.get('coordinates') or {}).get('coordinates') or (None, None)
+    for name, kind in columns:
+        value = {"longitude": longitude, "latitude": latitude}.get(name, doc.get(name))
+        row[name] = _timestamp(value) if kind == "timestamp" else value
+    return row
+
+
+class _CsvEncoder:
+    def __init__(self, columns: List[Tuple[str, str]]):
+        self.columns = columns
+        self.header = True
+
+    def encode(self, rows: List[dict]) -> bytes:
+        for row in rows:
+            for name, kind in self.columns:
+                if kind == "list" and row[name] is not None:
+                    row[name] = LIST_SEPARATOR.join(row[name])
+                elif kind == "timestamp" and row[name] is not None:
+                    row[name] = format_date(row[name])
+        frame = pd.DataFrame(rows, columns=[name for name, _ in self.columns])
+        data = frame.to_csv(index=False, header=self.header).encode()
+        self.header = False
+        return data
+
+    def finish(self) -> bytes:
+        # An empty export still has its header
+        return self.encode([]) if self.header else b""
+
+
+class _ParquetSink:
+    """Write-only file for ParquetWriter whose bytes are taken out as they are written"""
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        # Offsets in the footer count every byte written, not just those still buffered
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class _ParquetEncoder:
+    TYPES = {"string": "string", "int": "int64", "float": "float64"}
+
+    def __init__(self, columns: List[Tuple[str, str]]):
+        fields = []
+        for name, kind in columns:
+            if kind == "list":
+                fields.append((name, pa.list_(pa.string())))
+            elif kind == "timestamp":
+                fields.append((name, pa.timestamp("us", tz="UTC")))
+            else:
+                fields.append((name, pa.type_for_alias(self.TYPES[kind])))
+        self.schema = pa.schema(fields)
+        self.sink = _ParquetSink()
+        self.writer = pq.ParquetWriter(self.sink, self.schema)
+
+    def encode(self, rows: List[dict]) -> bytes:
+        # One row group per chunk
+        self.writer.write_table(pa.Table.from_pylist(rows, schema=self.schema))
+        return self.sink.take()
+
+    def finish(self) -> bytes:
+        self.writer.close()
+        return self.sink.take()
+
+
+async def export_chunks(collection, fmt: str, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """Every document of a registry collection in keyset order, encoded ``chunk_size`` rows at a time"""
+    columns = EXPORT_COLUMNS[collection.name]
+    encoder = _ParquetEncoder(columns) if fmt == "parquet" else _CsvEncoder(columns)
+    rows = []
+    async for doc in collection.find({}, {"_id": 0}).sort(PAGE_SORT):
+        rows.append(export_row(doc, columns))
+        if len(rows) >= chunk_size:
+            yield await asyncio.to_thread(encoder.encode, rows)
+            rows = []
+    if rows:
+        yield await asyncio.to_thread(encoder.encode, rows)
+    yield encoder.finish()
+
+
+async def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    importing = commands.add_parser("import", help="load donors or recipients from a file")
+    importing.add_argument("registry", choices=list(IMPORT_KINDS))
+    importing.add_argument("path")
+    importing.add_argument("--hospital-id", help="hospital profile id for rows without a hospital_id")
+    importing.add_argument("--concurrency", type=int, default=4, help="insert_many batches in flight")
+    exporting = commands.add_parser("export", help="write profiles or matches to a file")
+    exporting.add_argument("registry", choices=list(EXPORT_COLLECTIONS))
+    exporting.add_argument("path")
+    for command in (importing, exporting):
+        command.add_argument("--format", choices=FORMATS, help="defaults to the file extension")
+        command.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    try:
+        fmt = file_format(args.path, args.format)
+    except ValueError as e:
+        parser.error(str(e))
+
+    import server
+    import storage
+    from etags import bump_versions
+    from registry_stats import RegistryStats
+
+    client, db = storage.connect()
+    try:
+        if args.command == "import":
+            kind = IMPORT_KINDS[args.registry]
+            create_model, profile_model = server.REGISTRY_MODELS[kind]
+            stats = RegistryStats(db)
+
+            def written(kind: str, profiles: List[dict]):
+                for profile in profiles:
+                    stats.profile_changed(kind, None, profile)
+
+            importer = RegistryImporter(
+                db, kind, create_model, profile_model, server.User, hospital_id=args.hospital_id,
+                chunk_size=args.chunk_size, concurrency=args.concurrency, on_written=written
+            )
+            report = await importer.run(args.path, fmt)
+            # Invalidate the ETags of cached list pages and count the new profiles in the dashboard figures
+            await bump_versions(db, f"{kind}_profiles")
+            await stats.flush()
+            for error in report['errors']:
+                print(f"row {error['row']}: {error['detail']}", file=sys.stderr)
+            if report.get('error'):
+                print(report['error'], file=sys.stderr)
+            print(f"{report['imported']} of {report['rows']} rows imported, {report['failed']} failed, in {report['seconds']:.1f}s")
+            return 1 if report.get('error') else 0
+
+        start, count = time.perf_counter(), 0
+        with open(args.path, "wb") as out:
+            async for chunk in export_chunks(db[EXPORT_COLLECTIONS[args.registry]], fmt, args.chunk_size):
+                out.write(chunk)
+                count += len(chunk)
+        print(f"{args.registry}: {count} bytes written in {time.perf_counter() - start:.1f}s")
+        return 0
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,365 @@
+"""Registry analytics for the hospital dashboard, kept as persisted counters.
+
+Every profile and match write made through the API turns the difference
+between the stored version it replaced and the new one into counter deltas:
+
+    profiles       kind, blood type, status
+    organs         kind, blood type, organ, status
+    urgency        urgency level, status (recipients)
+    waiting_since  day a waiting recipient was registered
+    matches        organ, status
+
+Deltas are summed in memory and flushed as ``$inc`` upserts on the
+``registry_stats`` collection every ``STATS_FLUSH_SECONDS``, so every worker
+adds to the same counters. ``/stats`` reads the few hundred counter documents,
+however large the registry. The median waiting time comes from the per-day
+histogram, to the day.
+
+Reconciliation is a pass over the collections that recounts everything and
+overwrites the counters. It corrects writes that bypass the API and counts
+lost to a crash between two flushes. A pass runs on startup when there has
+been none, then every ``STATS_RECONCILE_SECONDS`` in whichever worker finds
+the last one too old, and after generate_registry.py; the registry_io.py CLI
+adds its rows to the counters directly.
+
+Deltas are kept per second they were recorded in. A pass first stores the
+time it started, and every worker's next flush drops the deltas recorded
+before then: the recount already includes their writes. Deltas recorded in
+the second a pass starts may still be counted twice, and any a failed pass
+made workers drop stay missing until the next one; worker clocks are taken
+to agree to within a second. To run a pass by hand::
+
+    python registry_stats.py
+"""
+import asyncio
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+from codec import parse_date, utc_date
+
+logger = logging.getLogger(__name__)
+
+COLLECTION = "registry_stats"
+# _id of the document recording the last reconciliation
+RECONCILED = "reconciled"
+
+STATUSES = {"donor": "available", "recipient": "waiting"}
+ORGAN_FIELDS = {"donor": "organs_available", "recipient": "organs_needed"}
+
+
+def _day(value) -> str:
+    created_at = parse_date(value)
+    if created_at.tzinfo is not None:
+        created_at = created_at.astimezone(timezone.utc)
+    return created_at.date().isoformat()
+
+def profile_keys(kind: str, profile: Optional[dict]) -> List[Tuple[str, ...]]:
+    """The counters a donor or recipient profile adds one to"""
+    if profile is None:
+        return []
+    blood, status = profile['blood_type'], profile.get('status', STATUSES[kind])
+    keys = [("profiles", kind, blood, status)]
+    keys += [("organs", kind, blood, organ, status) for organ in dict.fromkeys(profile[ORGAN_FIELDS[kind]])]
+    if kind == 'recipient':
+        keys.append(("urgency", profile['urgency_level'], status))
+        if status == 'waiting':
+            keys.append(("waiting_since", _day(profile['created_at'])))
+    return keys
+
+def match_keys(match: Optional[dict]) -> List[Tuple[str, ...]]:
+    if match is None:
+        return []
+    return [("matches", match['organ_type'], match.get('status', 'pending'))]
+
+def counter_id(key: Tuple[str, ...]) -> str:
+    return "|".join(key)
+
+
+class RegistryStats:
+    def __init__(self, db, flush_interval: float = 1.0, reconcile_interval: float = 3600.0, batch_size: int = 1000):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.reconcile_interval = reconcile_interval
+        self.batch_size = batch_size
+        # Second the delta was recorded in -> counter key -> delta not yet flushed
+        self.pending: Dict[int, Counter] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.flushed = 0
+        # Deltas dropped because a later recount included their writes
+        self.dropped = 0
+        self.reconciliations = 0
+        self.last_reconcile_seconds = 0.0
+        self.last_drift = 0
+
+    @classmethod
+    def from_env(cls, db) -> "RegistryStats":
+        return cls(
+            db,
+            flush_interval=float(os.environ.get('STATS_FLUSH_SECONDS', '1')),
+            reconcile_interval=float(os.environ.get('STATS_RECONCILE_SECONDS', '3600'))
+        )
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    # Change tracking
+
+    def profile_changed(self, kind: str, old: Optional[dict], new: Optional[dict]):
+        self._apply(profile_keys(kind, old), profile_keys(kind, new))
+
+    def match_changed(self, old: Optional[dict], new: Optional[dict]):
+        self._apply(match_keys(old), match_keys(new))
+
+    def _apply(self, removed: List[Tuple[str, ...]], added: List[Tuple[str, ...]]):
+        if not removed and not added:
+            return
+        pending = self.pending.setdefault(int(time.time()), Counter())
+        for key in removed:
+            pending[key] -= 1
+        for key in added:
+            pending[key] += 1
+
+    def _pending_total(self) -> Counter:
+        total: Counter = Counter()
+        for pending in self.pending.values():
+            total.update(pending)
+        return total
+
+    # Persistence
+
+    async def _recount_started(self) -> Optional[float]:
+        """When the last reconciliation pass started, as a timestamp"""
+        doc = await self.db[COLLECTION].find_one({"_id": RECONCILED}, {"started_at": 1})
+        if doc is None or doc.get('started_at') is None:
+            return None
+        return utc_date(doc['started_at']).timestamp()
+
+    async def flush(self):
+        """Add the pending deltas to the stored counters, dropping those a recount already included"""
+        if not self.pending:
+            return
+        started = await self._recount_started()
+        buckets, self.pending = self.pending, {}
+        deltas: Counter = Counter()
+        for second, pending in buckets.items():
+            if started is not None and second + 1 <= started:
+                self.dropped += sum(1 for delta in pending.values() if delta)
+            else:
+                deltas.update(pending)
+        newest = max(buckets)
+        items = [(key, delta) for key, delta in deltas.items() if delta]
+        for start in range(0, len(items), self.batch_size):
+            batch = items[start:start + self.batch_size]
+            try:
+                await self.db[COLLECTION].bulk_write([
+                    UpdateOne(
+                        {"_id": counter_id(key)},
+                        {"$inc": {"count": delta}, "$setOnInsert": {"key": list(key)}},
+                        upsert=True
+                    )
+                    for key, delta in batch
+                ], ordered=False)
+            except PyMongoError:
+                # Keep what was not written for the next flush; reconciliation fixes a partial write
+                pending = self.pending.setdefault(newest, Counter())
+                for key, delta in items[start:]:
+                    pending[key] += delta
+                raise
+            self.flushed += len(batch)
+
+    async def reconcile(self) -> int:
+        """Recount the registry and overwrite the counters, returning how far they had drifted"""
+        start, started_at = time.perf_counter(), datetime.now(timezone.utc)
+        # From here on every worker drops the deltas of writes this recount includes
+        await self.db[COLLECTION].update_one({"_id": RECONCILED}, {"$set": {"started_at": started_at}}, upsert=True)
+        counts: Counter = Counter()
+        for kind in ("donor", "recipient"):
+            projection = {"_id": 0, "blood_type": 1, "status": 1, ORGAN_FIELDS[kind]: 1}
+            if kind == 'recipient':
+                projection.update(urgency_level=1, created_at=1)
+            async for profile in self.db[f"{kind}_profiles"].find({}, projection):
+                counts.update(profile_keys(kind, profile))
+        async for match in self.db.matches.find({}, {"_id": 0, "organ_type": 1, "status": 1}):
+            counts.update(match_keys(match))
+
+        stored = {doc['_id']: doc.get('count', 0) async for doc in self.db[COLLECTION].find({"_id": {"$ne": RECONCILED}})}
+        ids = {counter_id(key): key for key in counts}
+        drift = sum(abs(stored.get(doc_id, 0) - counts[key]) for doc_id, key in ids.items())
+        drift += sum(abs(count) for doc_id, count in stored.items() if doc_id not in ids)
+
+        operations = [
+            UpdateOne({"_id": doc_id}, {"$set": {"key": list(key), "count": counts[key]}}, upsert=True)
+            for doc_id, key in ids.items()
+        ]
+        for position in range(0, len(operations), self.batch_size):
+            await self.db[COLLECTION].bulk_write(operations[position:position + self.batch_size], ordered=False)
+        await self.db[COLLECTION].delete_many({"_id": {"$nin": [*ids, RECONCILED]}})
+        self.last_reconcile_seconds = time.perf_counter() - start
+        await self.db[COLLECTION].update_one(
+            {"_id": RECONCILED},
+            {"$set": {"at": started_at, "seconds": self.last_reconcile_seconds, "drift": drift}},
+            upsert=True
+        )
+        self.reconciliations += 1
+        self.last_drift = drift
+        return drift
+
+    async def _reconcile_due(self) -> bool:
+        if self.reconcile_interval <= 0:
+            return False
+        last = await self.db[COLLECTION].find_one({"_id": RECONCILED}, {"at": 1})
+        if last is None or last.get('at') is None:
+            return True
+        at = last['at'] if last['at'].tzinfo is not None else last['at'].replace(tzinfo=timezone.utc)
+        return datetime.now(timezone.utc) - at >= timedelta(seconds=self.reconcile_interval)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.flush()
+                if await self._reconcile_due():
+                    drift = await self.reconcile()
+                    logger.info("Reconciled registry stats in %.1fs, %d counts corrected", self.last_reconcile_seconds, drift)
+            except PyMongoError:
+                logger.exception("Failed to update registry stats, retrying")
+            await asyncio.sleep(self.flush_interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except PyMongoError:
+            logger.exception("Failed to flush registry stats on shutdown")
+
+    # Reads
+
+    async def summary(self) -> dict:
+        """The dashboard figures from the stored counters plus this process's unflushed deltas"""
+        counts: Counter = Counter()
+        reconciled = None
+        async for doc in self.db[COLLECTION].find({}):
+            if doc['_id'] == RECONCILED:
+                reconciled = doc
+            else:
+                counts[tuple(doc['key'])] += doc.get('count', 0)
+        started = utc_date(reconciled['started_at']).timestamp() if reconciled and reconciled.get('started_at') else None
+        for second, pending in self.pending.items():
+            if started is None or second + 1 > started:
+                counts.update(pending)
+
+        result = {kind: {"total": 0, "by_status": {}, "by_blood_type": {}, "organs": []} for kind in ("donor", "recipient")}
+        urgency: Dict[str, Dict[str, int]] = {}
+        waiting_days: Dict[str, int] = {}
+        matches: Dict[str, Dict[str, int]] = {}
+        for key, count in sorted(counts.items()):
+            if count <= 0:
+                continue
+            family = key[0]
+            if family == "profiles":
+                _, kind, blood, status = key
+                result[kind]["total"] += count
+                result[kind]["by_status"][status] = result[kind]["by_status"].get(status, 0) + count
+                result[kind]["by_blood_type"].setdefault(blood, {})[status] = count
+            elif family == "organs":
+                _, kind, blood, organ, status = key
+                result[kind]["organs"].append({"blood_type": blood, "organ": organ, "status": status, "count": count})
+            elif family == "urgency":
+                urgency.setdefault(key[1], {})[key[2]] = count
+            elif family == "waiting_since":
+                waiting_days[key[1]] = count
+            elif family == "matches":
+                matches.setdefault(key[1], {})[key[2]] = count
+
+        by_status = Counter()
+        for statuses in matches.values():
+            by_status.update(statuses)
+        total = sum(by_status.values())
+
+        def share(count: int) -> Optional[float]:
+            return round(count / total, 4) if total else None
+
+        return {
+            "donors": result["donor"],
+            "recipients": {
+                **result["recipient"],
+                "urgency": urgency,
+                "waiting": {"count": sum(waiting_days.values()), "median_waiting_days": median_waiting_days(waiting_days)}
+            },
+            "matches": {
+                "total": total,
+                "by_status": dict(by_status),
+                "by_organ": matches,
+                "conversion": {
+                    # Share of all matches that were accepted (and possibly completed since), and completed
+                    "accepted": share(by_status["accepted"] + by_status["completed"]),
+                    "completed": share(by_status["completed"]),
+                    "rejected": share(by_status["rejected"])
+                }
+            },
+            "reconciled_at": reconciled.get('at') if reconciled else None
+        }
+
+    def stats(self) -> dict:
+        return {
+            "running": int(self.running),
+            "pending": sum(1 for delta in self._pending_total().values() if delta),
+            "flushed": self.flushed,
+            "dropped": self.dropped,
+            "reconciliations": self.reconciliations,
+            "last_reconcile_seconds": self.last_reconcile_seconds,
+            "last_drift": self.last_drift
+        }
+
+
+def median_waiting_days(days: Dict[str, int], now: Optional[datetime] = None) -> Optional[float]:
+    """Median days on the waiting list from a histogram of registration days"""
+    total = sum(days.values())
+    if not total:
+        return None
+    now = now or datetime.now(timezone.utc)
+    seen = 0
+    for day in sorted(days, reverse=True):
+        seen += days[day]
+        if seen * 2 >= total:
+            # Registrations are taken to be at noon of their day
+            registered = datetime.fromisoformat(day).replace(hour=12, tzinfo=timezone.utc)
+            return round(max(0.0, (now - registered).total_seconds() / 86400), 1)
+
+
+async def main() -> int:
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], tz_aware=True)
+    try:
+        stats = RegistryStats(client[os.environ['DB_NAME']])
+        drift = await stats.reconcile()
+        print(f"Reconciled registry stats in {stats.last_reconcile_seconds:.1f}s, {drift} counts corrected")
+    finally:
+        client.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -1,44 +1,85 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, File, Query, Request, Response, UploadFile
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import InsertOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional
+from typing import List, Literal, Optional, Tuple
 import uuid
+import secrets
+import asyncio
+import time
 from datetime import datetime, timezone, timedelta
-from passlib.context import CryptContext
 import jwt
+from contextlib import asynccontextmanager
+
+from admission import AdmissionMiddleware, MemoryAdmissionStore
+from allocation import Allocator
+from etags import ResponseCache, bump_versions, collection_version, etag_matches, make_etag
+from events import ChangeStreamRelay, EventBus, OwnWrites
+from fanout import ProfileFanout
+from geo import TransportLimits, point, within_km
+from waitlist import WaitlistQueues, indexed_candidates
+from indexes import ensure_indexes
+from materialize import PotentialMatchStore
+from match_status import ORGAN_LISTS, TransitionConflict, committed_organs, open_match, profile_status, release_organs, reserve_organs, supports_transactions, transition_match
+from migrate_dates import migrate_string_dates, string_date_collections
+from metrics import LoopLagMonitor, RequestMetricsMiddleware, mongo_listeners, password_duration, registry as metrics_registry
+from compatibility import PROFILE_COLLECTIONS, CompatibilityIndex, IndexSync, candidate_pipeline, compatibility_matrix, compatibility_score, is_blood_compatible
+from codec import FastJSONResponse, dumpb, dumps, json_response
+from compression import CompressionMiddleware
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, fetch_page, ndjson_stream
+from passwords import PasswordHasher, PasswordPoolFull
+from principals import PrincipalCache
+from registry_stats import RegistryStats
+from registry_io import EXPORT_COLLECTIONS, IMPORT_KINDS, MEDIA_TYPES, RegistryImporter, export_chunks, file_format
+import storage
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# The database client, caches and background services the routes use. They
+# are built by build_services() when the application's lifespan starts, so
+# importing this module connects to nothing and starts no workers.
+client = db = None
+password_hasher = principal_cache = response_cache = None
+match_index = index_sync = allocator = waitlist = None
+event_bus = own_writes = potential_matches = registry_stats = None
+profile_fanout = event_relay = loop_lag_monitor = None
 
 # Security
 JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production')
 JWT_ALGORITHM = 'HS256'
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
-
-# Create the main app without a prefix
-app = FastAPI()
+# Trust the signed token claims for id/role checks instead of resolving the user
+TRUST_TOKEN_CLAIMS = os.environ.get('AUTH_TRUST_TOKEN_CLAIMS', 'false').lower() == 'true'
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
+# Prometheus scrapes, outside /api and only with METRICS_TOKEN; served when it is set
+metrics_router = APIRouter()
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+scrape_security = HTTPBearer(auto_error=False)
 
 # Helper functions
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+async def hash_password(password: str) -> str:
+    start = time.perf_counter()
+    try:
+        return await password_hasher.hash(password)
+    finally:
+        password_duration.observe(time.perf_counter() - start, operation="hash")
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    start = time.perf_counter()
+    try:
+        return await password_hasher.verify(plain_password, hashed_password)
+    finally:
+        password_duration.observe(time.perf_counter() - start, operation="verify")
 
 def create_access_token(data: dict) -> str:
     to_encode = data.copy()
@@ -46,39 +87,215 @@ def create_access_token(data: dict) -> str:
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
-def decode_token(token: str) -> dict:
+async def paginate(request: Request, collection, query: dict, limit: int, cursor: Optional[str], stream: bool) -> Response:
+    """Keyset page of stored documents, or an NDJSON stream of all of them when stream is set.
+
+    Pages carry an ETag derived from the collection version, so unchanged pages
+    are answered with a 304 or served from the response cache.
+    """
+    if stream:
+        try:
+            return StreamingResponse(ndjson_stream(collection, query, cursor), media_type="application/x-ndjson")
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    # Read the version first: a write racing the query can only make the body newer than its tag
+    version = await collection_version(db, collection.name)
+    etag = make_etag(collection.name, version, query, limit, cursor)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    
+    cached = response_cache.get(etag)
+    if cached is not None:
+        body, next_cursor = cached
+    else:
+        try:
+            docs, next_cursor = await fetch_page(collection, query, limit, cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        body = dumpb(docs)
+        response_cache.put(collection.name, etag, body, next_cursor)
+    
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    return Response(content=body, headers=headers, media_type="application/json")
+
+async def collections_changed(*names: str):
+    """Record a write to the listed collections, invalidating their ETags and cached pages"""
+    versions = await bump_versions(db, *names)
+    for name in names:
+        response_cache.invalidate(name)
+        if name in PROFILE_COLLECTIONS:
+            index_sync.written(name, versions[name])
+
+def admission_identity(scope) -> Tuple[str, str]:
+    """(role, subject) of a request for admission control: the token's claims, unverified against the database"""
+    for name, value in scope.get("headers", []):
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            if scheme.lower() == "bearer":
+                try:
+                    payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+                    return payload["role"], payload["user_id"]
+                except (jwt.PyJWTError, KeyError):
+                    break
+    client = scope.get("client")
+    return "anonymous", client[0] if client else "unknown"
+
+def decode_token(token: str, purpose: Optional[str] = None) -> dict:
+    """Verify a token; access tokens have no purpose, SSE tickets the purpose "sse" and are good for nothing else"""
     try:
-        return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token has expired")
-    except jwt.JWTError:
+    except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    if payload.get("purpose") != purpose:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return payload
+
+async def load_user(user_id: str) -> Optional[dict]:
+    return await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
+
+async def get_current_user(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return await user_from_payload(request, decode_token(credentials.credentials))
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    token = credentials.credentials
-    payload = decode_token(token)
+async def user_from_payload(request: Request, payload: dict) -> dict:
     user_id = payload.get("user_id")
     if not user_id:
         raise HTTPException(status_code=401, detail="Invalid token")
     
-    user = await db.users.find_one({"id": user_id}, {"_id": 0})
+    user = await principal_cache.get_or_load(user_id, load_user)
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
+    # Role label for the request metrics
+    request.state.role = user['role']
     return user
 
-# Blood type compatibility checker
-def is_blood_compatible(donor_blood: str, recipient_blood: str) -> bool:
-    compatibility = {
-        "O-": ["O-", "O+", "A-", "A+", "B-", "B+", "AB-", "AB+"],
-        "O+": ["O+", "A+", "B+", "AB+"],
-        "A-": ["A-", "A+", "AB-", "AB+"],
-        "A+": ["A+", "AB+"],
-        "B-": ["B-", "B+", "AB-", "AB+"],
-        "B+": ["B+", "AB+"],
-        "AB-": ["AB-", "AB+"],
-        "AB+": ["AB+"]
-    }
-    return recipient_blood in compatibility.get(donor_blood, [])
+async def get_current_principal(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Like get_current_user but only guaranteed to carry id, email and role"""
+    return await principal_from_payload(request, decode_token(credentials.credentials))
+
+async def get_hospital_principal(current_user: dict = Depends(get_current_principal)):
+    """The caller, who must be a hospital"""
+    if current_user['role'] != 'hospital':
+        raise HTTPException(status_code=403, detail="Only hospitals can view metrics")
+    return current_user
+
+def verify_scrape_token(credentials: Optional[HTTPAuthorizationCredentials] = Depends(scrape_security)):
+    if not credentials or not secrets.compare_digest(credentials.credentials.encode(), METRICS_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid scrape token", headers={"WWW-Authenticate": "Bearer"})
+
+async def principal_from_payload(request: Request, payload: dict) -> dict:
+    if not TRUST_TOKEN_CLAIMS:
+        return await user_from_payload(request, payload)
+    
+    if not payload.get("user_id") or not payload.get("role"):
+        raise HTTPException(status_code=401, detail="Invalid token")
+    request.state.role = payload["role"]
+    return {"id": payload["user_id"], "email": payload.get("email"), "role": payload["role"]}
+
+# Server-sent event streams: keepalive interval and ticket lifetime
+SSE_KEEPALIVE_SECONDS = 15
+SSE_TICKET_SECONDS = int(os.environ.get('SSE_TICKET_SECONDS', '60'))
+
+# Whether match status changes run in a MongoDB transaction; detected on startup
+# (needs a replica set) unless MATCH_TRANSACTIONS=off
+MATCH_TRANSACTIONS = False
+# Attempts at a profile edit racing the matches moving its organs
+PROFILE_UPDATE_RETRIES = 3
+
+# Where /matches/potential finds candidates: the resident compatibility index,
+# a filtered aggregation in the database (also used until the index loads), or
+# lists materialized in the background by potential_matches
+POTENTIAL_MATCH_SOURCE = os.environ.get('POTENTIAL_MATCH_SOURCE', 'index').lower()
+# Distance limits for the ?max_km / ?max_hours / ?ischemia filters
+transport_limits = TransportLimits.from_env()
+
+def apply_profile_change(kind: str, profile: dict) -> Optional[dict]:
+    """Update the compatibility index with a written profile, returning the previously indexed one"""
+    if kind == 'donor':
+        old = match_index.get_donor(profile['id'])
+        match_index.put_donor(profile)
+    else:
+        old = match_index.get_recipient(profile['id'])
+        match_index.put_recipient(profile)
+    if potential_matches.running:
+        potential_matches.profile_written(kind, profile)
+    return old
+
+def fan_out_profile_change(kind: str, old: Optional[dict], profile: dict, publish: bool = True):
+    """Queue the counterpart lookup of an applied profile change for its events and materialized lists"""
+    if publish or potential_matches.running:
+        profile_fanout.submit(kind, old, profile, publish)
+
+def profile_fanned_out(kind: str, old: Optional[dict], profile: dict, counterparts: List[dict], publish: bool):
+    """Handler of profile_fanout, given everyone compatible before or after the change"""
+    if potential_matches.running:
+        potential_matches.profile_changed(kind, profile, counterparts)
+    if publish:
+        publish_profile_event(kind, profile, counterparts)
+
+def publish_profile_event(kind: str, profile: dict, counterparts: List[dict]):
+    # Everyone compatible before or after the change sees a different candidate list
+    event_bus.publish({"type": "profile_changed", "kind": kind, "profile": profile}, user_ids=[profile['user_id']], roles=['hospital'])
+    event_bus.publish(
+        {"type": "potential_matches_changed", "kind": kind, "profile_id": profile['id']},
+        user_ids=[profile['user_id'], *(candidate['user_id'] for candidate in counterparts)]
+    )
+
+def publish_match_event(event_type: str, match: dict, donor: dict, recipient: dict):
+    event_bus.publish({"type": event_type, "match": match}, user_ids=[donor['user_id'], recipient['user_id']], roles=['hospital'])
+
+def profile_written(kind: str, profile: dict, previous: Optional[dict] = None):
+    """Hook for every donor or recipient profile write made by this process; previous is the stored version it replaced"""
+    registry_stats.profile_changed(kind, previous, profile)
+    old = apply_profile_change(kind, profile)
+    if event_relay.active:
+        # Fanned out when the relay echoes it
+        own_writes.record((kind, profile['id']), old)
+    else:
+        fan_out_profile_change(kind, old, profile)
+
+def users_written(user_ids: List[str]):
+    """Hook for every write to user documents made by this process"""
+    for user_id in user_ids:
+        principal_cache.invalidate(user_id)
+
+def registry_imported(kind: str, profiles: List[dict]):
+    """Hook for every batch of profiles written by a bulk import in this process.
+    
+    Updates the index and materialized lists like profile_written; events per
+    profile are only published by the change stream relay, for other workers.
+    """
+    for profile in profiles:
+        registry_stats.profile_changed(kind, None, profile)
+        old = apply_profile_change(kind, profile)
+        if event_relay.active:
+            own_writes.record((kind, profile['id']), old)
+        else:
+            fan_out_profile_change(kind, old, profile, publish=False)
+
+def match_written(match: dict, donor: dict, recipient: dict, event_type: str = "match_created", previous: Optional[dict] = None):
+    """Hook for every match created or updated by this process; previous is the stored version it replaced"""
+    registry_stats.match_changed(previous, match)
+    if not event_relay.active:
+        publish_match_event(event_type, match, donor, recipient)
+
+async def relay_change(collection: str, operation: str, document: dict):
+    if collection in PROFILE_COLLECTIONS:
+        kind = collection.removesuffix('_profiles')
+        # This process's own writes are already applied; publish them against the version they replaced
+        own, old = own_writes.pop((kind, document['id']))
+        if not own:
+            old = apply_profile_change(kind, document)
+        fan_out_profile_change(kind, old, document)
+    elif collection == 'matches':
+        donor = await db.donor_profiles.find_one({"id": document['donor_id']}, {"_id": 0, "user_id": 1})
+        recipient = await db.recipient_profiles.find_one({"id": document['recipient_id']}, {"_id": 0, "user_id": 1})
+        if donor and recipient:
+            publish_match_event("match_created" if operation == "insert" else "match_updated", document, donor, recipient)
 
 # Models
 class User(BaseModel):
@@ -104,6 +321,10 @@ class TokenResponse(BaseModel):
     token_type: str = "bearer"
     user: User
 
+class GeoPoint(BaseModel):
+    type: Literal["Point"] = "Point"
+    coordinates: List[float] = Field(min_length=2, max_length=2)  # [longitude, latitude]
+
 class DonorProfile(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -111,7 +332,13 @@ class DonorProfile(BaseModel):
     blood_type: str
     age: int
     organs_available: List[str]  # heart, kidney, liver, lungs, pancreas, intestines
+    # Organs leave organs_available through these as their matches progress
+    organs_offered: List[str] = []
+    organs_allocated: List[str] = []
+    organs_donated: List[str] = []
     medical_history: Optional[str] = None
+    hospital_id: Optional[str] = None
+    coordinates: Optional[GeoPoint] = None  # copied from the hospital
     status: str = "available"  # available, matched, donated
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
@@ -120,6 +347,7 @@ class DonorProfileCreate(BaseModel):
     age: int
     organs_available: List[str]
     medical_history: Optional[str] = None
+    hospital_id: Optional[str] = None
 
 class RecipientProfile(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -128,8 +356,14 @@ class RecipientProfile(BaseModel):
     blood_type: str
     age: int
     organs_needed: List[str]
+    # Organs leave organs_needed through these as their matches progress
+    organs_offered: List[str] = []
+    organs_allocated: List[str] = []
+    organs_received: List[str] = []
     urgency_level: str  # low, medium, high, critical
     medical_history: Optional[str] = None
+    hospital_id: Optional[str] = None
+    coordinates: Optional[GeoPoint] = None  # copied from the hospital
     status: str = "waiting"  # waiting, matched, received
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
@@ -139,6 +373,7 @@ class RecipientProfileCreate(BaseModel):
     organs_needed: List[str]
     urgency_level: str
     medical_history: Optional[str] = None
+    hospital_id: Optional[str] = None
 
 class HospitalProfile(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -147,12 +382,15 @@ class HospitalProfile(BaseModel):
     hospital_name: str
     location: str
     contact_number: str
+    coordinates: Optional[GeoPoint] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class HospitalProfileCreate(BaseModel):
     hospital_name: str
     location: str
     contact_number: str
+    latitude: Optional[float] = Field(None, ge=-90, le=90)
+    longitude: Optional[float] = Field(None, ge=-180, le=180)
 
 class Match(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -164,14 +402,124 @@ class Match(BaseModel):
     status: str = "pending"  # pending, accepted, rejected, completed
     created_by: str  # hospital user_id
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: Optional[datetime] = None
+    version: int = 0  # bumped by every status change
 
 class MatchCreate(BaseModel):
     donor_id: str
     recipient_id: str
     organ_type: str
 
+class MatchBatchCreate(BaseModel):
+    matches: List[MatchCreate] = Field(min_length=1, max_length=1000)
+
+class MatchBatchError(BaseModel):
+    index: int
+    status_code: int
+    detail: str
+
+class MatchBatchResult(BaseModel):
+    created: List[Match]
+    errors: List[MatchBatchError]
+
 class MatchStatusUpdate(BaseModel):
     status: str
+    version: Optional[int] = None  # the version last read; a stale one is rejected with 409
+
+# Row validation and stored document models of the bulk registry import
+REGISTRY_MODELS = {
+    "donor": (DonorProfileCreate, DonorProfile),
+    "recipient": (RecipientProfileCreate, RecipientProfile),
+}
+
+
+def hospital_coordinates(profile_data: HospitalProfileCreate) -> Optional[dict]:
+    if (profile_data.latitude is None) != (profile_data.longitude is None):
+        raise HTTPException(status_code=400, detail="Give both latitude and longitude, or neither")
+    if profile_data.latitude is None:
+        return None
+    return point(profile_data.longitude, profile_data.latitude)
+
+async def hospital_placement(hospital_id: Optional[str]) -> dict:
+    """The hospital fields stored on a donor or recipient profile registered at a hospital"""
+    if hospital_id is None:
+        return {"hospital_id": None, "coordinates": None}
+    hospital = await db.hospital_profiles.find_one({"id": hospital_id}, {"_id": 0, "coordinates": 1})
+    if not hospital:
+        raise HTTPException(status_code=400, detail="Hospital not found")
+    return {"hospital_id": hospital_id, "coordinates": hospital.get('coordinates')}
+
+async def viewer_location(current_user: dict) -> dict:
+    """GeoJSON location of the caller's profile, which distance filters are measured from"""
+    collection = db[f"{current_user['role']}_profiles"]
+    profile = await collection.find_one({"user_id": current_user['id']}, {"_id": 0, "coordinates": 1})
+    if not profile or not profile.get('coordinates'):
+        raise HTTPException(status_code=400, detail="Distance filters need a profile with hospital coordinates")
+    return profile['coordinates']
+
+async def distance_query(current_user: dict, max_km: Optional[float], max_hours: Optional[float]) -> dict:
+    radius = transport_limits.radius_km(max_km, max_hours)
+    if radius is None:
+        return {}
+    return {"coordinates": within_km(await viewer_location(current_user), radius)}
+
+async def update_own_profile(kind: str, user_id: str, changes: dict) -> Tuple[Optional[dict], Optional[dict]]:
+    """Apply a user's edit of their profile, returning (previous, updated) or (None, None) if it doesn't exist.
+    
+    The edited pool leaves out organs held by matches, which stay where they
+    are; the write is conditional on those not moving meanwhile.
+    """
+    collection = db[f"{kind}_profiles"]
+    lists = ORGAN_LISTS[kind]
+    for _ in range(PROFILE_UPDATE_RETRIES):
+        current = await collection.find_one({"user_id": user_id}, {"_id": 0})
+        if not current:
+            return None, None
+        committed = committed_organs(kind, current)
+        edit = {**changes, lists['pool']: [organ for organ in changes[lists['pool']] if organ not in committed]}
+        edit['status'] = profile_status(kind, {**current, **edit})
+        unmoved = {
+            lists[stage]: current[lists[stage]] if lists[stage] in current else {"$exists": False}
+            for stage in ("offered", "allocated", "done")
+        }
+        previous = await collection.find_one_and_update(
+            {"user_id": user_id, **unmoved},
+            {"$set": edit},
+            projection={"_id": 0}
+        )
+        if previous:
+            return previous, {**previous, **edit}
+    raise HTTPException(status_code=409, detail="Profile is being matched, retry")
+
+def build_match(match_data: MatchCreate, donor: Optional[dict], recipient: Optional[dict], created_by: str) -> Match:
+    """Validate a requested pairing against the stored profiles, raising HTTPException if infeasible"""
+    if not donor or not recipient:
+        raise HTTPException(status_code=404, detail="Donor or recipient not found")
+    
+    # Check blood compatibility
+    if not is_blood_compatible(donor['blood_type'], recipient['blood_type']):
+        raise HTTPException(status_code=400, detail="Blood types are not compatible")
+    
+    # Organs of other matches have left the pool; creating the match re-checks this with its write
+    if match_data.organ_type in committed_organs("donor", donor):
+        raise HTTPException(status_code=409, detail="Donor's organ is already matched")
+    if match_data.organ_type in committed_organs("recipient", recipient):
+        raise HTTPException(status_code=409, detail="Recipient's organ is already matched")
+    
+    # Check if organ is available
+    if match_data.organ_type not in donor['organs_available']:
+        raise HTTPException(status_code=400, detail="Organ not available from this donor")
+    
+    if match_data.organ_type not in recipient['organs_needed']:
+        raise HTTPException(status_code=400, detail="Recipient doesn't need this organ")
+    
+    return Match(
+        donor_id=match_data.donor_id,
+        recipient_id=match_data.recipient_id,
+        organ_type=match_data.organ_type,
+        compatibility_score=compatibility_score(donor['blood_type'], recipient['blood_type']),
+        created_by=created_by
+    )
 
 
 # Root endpoint
@@ -182,11 +530,6 @@ async def root():
 # Authentication routes
 @api_router.post("/auth/register", response_model=TokenResponse)
 async def register(user_data: UserCreate):
-    # Check if user already exists
-    existing_user = await db.users.find_one({"email": user_data.email}, {"_id": 0})
-    if existing_user:
-        raise HTTPException(status_code=400, detail="Email already registered")
-    
     # Validate role
     if user_data.role not in ["donor", "recipient", "hospital"]:
         raise HTTPException(status_code=400, detail="Invalid role")
@@ -199,10 +542,14 @@ async def register(user_data: UserCreate):
     )
     
     user_dict = user.model_dump()
-    user_dict['password'] = hash_password(user_data.password)
-    user_dict['created_at'] = user_dict['created_at'].isoformat()
+    user_dict['password'] = await hash_password(user_data.password)
     
-    await db.users.insert_one(user_dict)
+    # Email uniqueness is enforced by the unique index on users.email
+    try:
+        await db.users.insert_one(user_dict)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
+    users_written([user.id])
     
     # Create access token
     access_token = create_access_token({"user_id": user.id, "email": user.email, "role": user.role})
@@ -212,13 +559,10 @@ async def register(user_data: UserCreate):
 @api_router.post("/auth/login", response_model=TokenResponse)
 async def login(credentials: UserLogin):
     user = await db.users.find_one({"email": credentials.email}, {"_id": 0})
-    if not user or not verify_password(credentials.password, user['password']):
+    # Accounts created by a registry import have no password
+    if not user or not user.get('password') or not await verify_password(credentials.password, user['password']):
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
-    # Parse created_at back to datetime for response
-    if isinstance(user['created_at'], str):
-        user['created_at'] = datetime.fromisoformat(user['created_at'])
-    
     user_obj = User(**user)
     access_token = create_access_token({"user_id": user_obj.id, "email": user_obj.email, "role": user_obj.role})
     
@@ -226,170 +570,207 @@ async def login(credentials: UserLogin):
 
 @api_router.get("/auth/me", response_model=User)
 async def get_me(current_user: dict = Depends(get_current_user)):
-    if isinstance(current_user['created_at'], str):
-        current_user['created_at'] = datetime.fromisoformat(current_user['created_at'])
-    return User(**current_user)
+    return current_user
+
+@api_router.get("/metrics/passwords")
+async def get_password_pool_metrics(current_user: dict = Depends(get_hospital_principal)):
+    return password_hasher.stats()
+
+@api_router.get("/metrics/principals")
+async def get_principal_cache_metrics(current_user: dict = Depends(get_hospital_principal)):
+    return principal_cache.stats()
+
+@api_router.get("/metrics/responses")
+async def get_response_cache_metrics(current_user: dict = Depends(get_hospital_principal)):
+    return response_cache.stats()
+
+@api_router.get("/metrics/potential-matches")
+async def get_potential_match_metrics(current_user: dict = Depends(get_hospital_principal)):
+    return potential_matches.stats()
 
 # Donor routes
 @api_router.post("/donors", response_model=DonorProfile)
-async def create_donor_profile(profile_data: DonorProfileCreate, current_user: dict = Depends(get_current_user)):
+async def create_donor_profile(profile_data: DonorProfileCreate, current_user: dict = Depends(get_current_principal)):
     if current_user['role'] != 'donor':
         raise HTTPException(status_code=403, detail="Only donors can create donor profiles")
     
-    # Check if profile already exists
-    existing = await db.donor_profiles.find_one({"user_id": current_user['id']}, {"_id": 0})
-    if existing:
-        raise HTTPException(status_code=400, detail="Donor profile already exists")
-    
     profile = DonorProfile(
         user_id=current_user['id'],
-        **profile_data.model_dump()
+        **{**profile_data.model_dump(), **await hospital_placement(profile_data.hospital_id)}
     )
     
     profile_dict = profile.model_dump()
-    profile_dict['created_at'] = profile_dict['created_at'].isoformat()
     
-    await db.donor_profiles.insert_one(profile_dict)
+    # One profile per user is enforced by the unique index on user_id
+    try:
+        await db.donor_profiles.insert_one(profile_dict)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Donor profile already exists")
+    profile_dict.pop('_id', None)
+    await collections_changed('donor_profiles')
+    profile_written('donor', profile_dict)
     return profile
 
 @api_router.get("/donors/me", response_model=DonorProfile)
-async def get_my_donor_profile(current_user: dict = Depends(get_current_user)):
+async def get_my_donor_profile(current_user: dict = Depends(get_current_principal)):
     profile = await db.donor_profiles.find_one({"user_id": current_user['id']}, {"_id": 0})
     if not profile:
         raise HTTPException(status_code=404, detail="Donor profile not found")
     
-    if isinstance(profile['created_at'], str):
-        profile['created_at'] = datetime.fromisoformat(profile['created_at'])
-    
-    return DonorProfile(**profile)
+    return profile
 
 @api_router.put("/donors/me", response_model=DonorProfile)
-async def update_my_donor_profile(profile_data: DonorProfileCreate, current_user: dict = Depends(get_current_user)):
-    result = await db.donor_profiles.find_one_and_update(
-        {"user_id": current_user['id']},
-        {"$set": profile_data.model_dump()},
-        return_document=True,
-        projection={"_id": 0}
-    )
+async def update_my_donor_profile(profile_data: DonorProfileCreate, current_user: dict = Depends(get_current_principal)):
+    changes = {**profile_data.model_dump(), **await hospital_placement(profile_data.hospital_id)}
+    previous, result = await update_own_profile('donor', current_user['id'], changes)
     
-    if not result:
+    if not previous:
         raise HTTPException(status_code=404, detail="Donor profile not found")
     
-    if isinstance(result['created_at'], str):
-        result['created_at'] = datetime.fromisoformat(result['created_at'])
+    await collections_changed('donor_profiles')
+    profile_written('donor', result, previous)
     
-    return DonorProfile(**result)
+    return result
 
 @api_router.get("/donors", response_model=List[DonorProfile])
-async def get_all_donors(current_user: dict = Depends(get_current_user)):
+async def get_all_donors(
+    request: Request,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+    max_km: Optional[float] = Query(None, gt=0),
+    max_hours: Optional[float] = Query(None, gt=0),
+    current_user: dict = Depends(get_current_principal)
+):
     if current_user['role'] not in ['hospital', 'recipient']:
         raise HTTPException(status_code=403, detail="Access denied")
     
-    donors = await db.donor_profiles.find({}, {"_id": 0}).to_list(1000)
-    
-    for donor in donors:
-        if isinstance(donor['created_at'], str):
-            donor['created_at'] = datetime.fromisoformat(donor['created_at'])
-    
-    return [DonorProfile(**d) for d in donors]
+    query = await distance_query(current_user, max_km, max_hours)
+    return await paginate(request, db.donor_profiles, query, limit, cursor, stream)
 
 # Recipient routes
 @api_router.post("/recipients", response_model=RecipientProfile)
-async def create_recipient_profile(profile_data: RecipientProfileCreate, current_user: dict = Depends(get_current_user)):
+async def create_recipient_profile(profile_data: RecipientProfileCreate, current_user: dict = Depends(get_current_principal)):
     if current_user['role'] != 'recipient':
         raise HTTPException(status_code=403, detail="Only recipients can create recipient profiles")
     
-    existing = await db.recipient_profiles.find_one({"user_id": current_user['id']}, {"_id": 0})
-    if existing:
-        raise HTTPException(status_code=400, detail="Recipient profile already exists")
-    
     profile = RecipientProfile(
         user_id=current_user['id'],
-        **profile_data.model_dump()
+        **{**profile_data.model_dump(), **await hospital_placement(profile_data.hospital_id)}
     )
     
     profile_dict = profile.model_dump()
-    profile_dict['created_at'] = profile_dict['created_at'].isoformat()
     
-    await db.recipient_profiles.insert_one(profile_dict)
+    try:
+        await db.recipient_profiles.insert_one(profile_dict)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Recipient profile already exists")
+    profile_dict.pop('_id', None)
+    await collections_changed('recipient_profiles')
+    profile_written('recipient', profile_dict)
     return profile
 
 @api_router.get("/recipients/me", response_model=RecipientProfile)
-async def get_my_recipient_profile(current_user: dict = Depends(get_current_user)):
+async def get_my_recipient_profile(current_user: dict = Depends(get_current_principal)):
     profile = await db.recipient_profiles.find_one({"user_id": current_user['id']}, {"_id": 0})
     if not profile:
         raise HTTPException(status_code=404, detail="Recipient profile not found")
     
-    if isinstance(profile['created_at'], str):
-        profile['created_at'] = datetime.fromisoformat(profile['created_at'])
-    
-    return RecipientProfile(**profile)
+    return profile
 
 @api_router.put("/recipients/me", response_model=RecipientProfile)
-async def update_my_recipient_profile(profile_data: RecipientProfileCreate, current_user: dict = Depends(get_current_user)):
-    result = await db.recipient_profiles.find_one_and_update(
-        {"user_id": current_user['id']},
-        {"$set": profile_data.model_dump()},
-        return_document=True,
-        projection={"_id": 0}
-    )
+async def update_my_recipient_profile(profile_data: RecipientProfileCreate, current_user: dict = Depends(get_current_principal)):
+    changes = {**profile_data.model_dump(), **await hospital_placement(profile_data.hospital_id)}
+    previous, result = await update_own_profile('recipient', current_user['id'], changes)
     
-    if not result:
+    if not previous:
         raise HTTPException(status_code=404, detail="Recipient profile not found")
     
-    if isinstance(result['created_at'], str):
-        result['created_at'] = datetime.fromisoformat(result['created_at'])
+    await collections_changed('recipient_profiles')
+    profile_written('recipient', result, previous)
     
-    return RecipientProfile(**result)
+    return result
 
 @api_router.get("/recipients", response_model=List[RecipientProfile])
-async def get_all_recipients(current_user: dict = Depends(get_current_user)):
+async def get_all_recipients(
+    request: Request,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+    max_km: Optional[float] = Query(None, gt=0),
+    max_hours: Optional[float] = Query(None, gt=0),
+    current_user: dict = Depends(get_current_principal)
+):
     if current_user['role'] not in ['hospital', 'donor']:
         raise HTTPException(status_code=403, detail="Access denied")
     
-    recipients = await db.recipient_profiles.find({}, {"_id": 0}).to_list(1000)
-    
-    for recipient in recipients:
-        if isinstance(recipient['created_at'], str):
-            recipient['created_at'] = datetime.fromisoformat(recipient['created_at'])
-    
-    return [RecipientProfile(**r) for r in recipients]
+    query = await distance_query(current_user, max_km, max_hours)
+    return await paginate(request, db.recipient_profiles, query, limit, cursor, stream)
 
 # Hospital routes
 @api_router.post("/hospitals", response_model=HospitalProfile)
-async def create_hospital_profile(profile_data: HospitalProfileCreate, current_user: dict = Depends(get_current_user)):
+async def create_hospital_profile(profile_data: HospitalProfileCreate, current_user: dict = Depends(get_current_principal)):
     if current_user['role'] != 'hospital':
         raise HTTPException(status_code=403, detail="Only hospitals can create hospital profiles")
     
-    existing = await db.hospital_profiles.find_one({"user_id": current_user['id']}, {"_id": 0})
-    if existing:
-        raise HTTPException(status_code=400, detail="Hospital profile already exists")
-    
     profile = HospitalProfile(
         user_id=current_user['id'],
+        coordinates=hospital_coordinates(profile_data),
         **profile_data.model_dump()
     )
     
     profile_dict = profile.model_dump()
-    profile_dict['created_at'] = profile_dict['created_at'].isoformat()
     
-    await db.hospital_profiles.insert_one(profile_dict)
+    try:
+        await db.hospital_profiles.insert_one(profile_dict)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Hospital profile already exists")
     return profile
 
 @api_router.get("/hospitals/me", response_model=HospitalProfile)
-async def get_my_hospital_profile(current_user: dict = Depends(get_current_user)):
+async def get_my_hospital_profile(current_user: dict = Depends(get_current_principal)):
     profile = await db.hospital_profiles.find_one({"user_id": current_user['id']}, {"_id": 0})
     if not profile:
         raise HTTPException(status_code=404, detail="Hospital profile not found")
     
-    if isinstance(profile['created_at'], str):
-        profile['created_at'] = datetime.fromisoformat(profile['created_at'])
+    return profile
+
+@api_router.put("/hospitals/me", response_model=HospitalProfile)
+async def update_my_hospital_profile(profile_data: HospitalProfileCreate, current_user: dict = Depends(get_current_principal)):
+    coordinates = hospital_coordinates(profile_data)
+    result = await db.hospital_profiles.find_one_and_update(
+        {"user_id": current_user['id']},
+        {"$set": {
+            **profile_data.model_dump(exclude={"latitude", "longitude"}),
+            "coordinates": coordinates
+        }},
+        return_document=True,
+        projection={"_id": 0}
+    )
+    
+    if not result:
+        raise HTTPException(status_code=404, detail="Hospital profile not found")
+    
+    # Profiles registered here carry a copy of the coordinates for the 2dsphere index
+    changed = []
+    for collection in (db.donor_profiles, db.recipient_profiles):
+        outcome = await collection.update_many({"hospital_id": result['id']}, {"$set": {"coordinates": coordinates}})
+        if outcome.modified_count:
+            changed.append(collection.name)
+    if changed:
+        await collections_changed(*changed)
     
-    return HospitalProfile(**profile)
+    return result
 
 # Matching routes
 @api_router.get("/matches")
-async def get_matches(current_user: dict = Depends(get_current_user)):
+async def get_matches(
+    request: Request,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+    current_user: dict = Depends(get_current_principal)
+):
     query = {}
     
     if current_user['role'] == 'donor':
@@ -403,16 +784,10 @@ async def get_matches(current_user: dict = Depends(get_current_user)):
             return []
         query = {"recipient_id": recipient_profile['id']}
     
-    matches = await db.matches.find(query, {"_id": 0}).to_list(1000)
-    
-    for match in matches:
-        if isinstance(match['created_at'], str):
-            match['created_at'] = datetime.fromisoformat(match['created_at'])
-    
-    return matches
+    return await paginate(request, db.matches, query, limit, cursor, stream)
 
 @api_router.post("/matches", response_model=Match)
-async def create_match(match_data: MatchCreate, current_user: dict = Depends(get_current_user)):
+async def create_match(match_data: MatchCreate, current_user: dict = Depends(get_current_principal)):
     if current_user['role'] != 'hospital':
         raise HTTPException(status_code=403, detail="Only hospitals can create matches")
     
@@ -420,42 +795,162 @@ async def create_match(match_data: MatchCreate, current_user: dict = Depends(get
     donor = await db.donor_profiles.find_one({"id": match_data.donor_id}, {"_id": 0})
     recipient = await db.recipient_profiles.find_one({"id": match_data.recipient_id}, {"_id": 0})
     
-    if not donor or not recipient:
-        raise HTTPException(status_code=404, detail="Donor or recipient not found")
+    match = build_match(match_data, donor, recipient, current_user['id'])
+    match_dict = match.model_dump()
     
-    # Check blood compatibility
-    if not is_blood_compatible(donor['blood_type'], recipient['blood_type']):
-        raise HTTPException(status_code=400, detail="Blood types are not compatible")
+    # Offering the organ on both profiles is conditional on it still being in their pools
+    try:
+        profiles = await open_match(client, db, match_dict, MATCH_TRANSACTIONS)
+    except TransitionConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    await collections_changed('matches', 'donor_profiles', 'recipient_profiles')
+    for kind, (before, after) in profiles.items():
+        profile_written(kind, after, before)
+    match_written(match_dict, profiles['donor'][1], profiles['recipient'][1])
+    return match
+
+@api_router.post("/matches/batch", response_model=MatchBatchResult)
+async def create_matches_batch(batch: MatchBatchCreate, current_user: dict = Depends(get_current_principal)):
+    """Create many matches at once; each item succeeds or fails on its own"""
+    if current_user['role'] != 'hospital':
+        raise HTTPException(status_code=403, detail="Only hospitals can create matches")
     
-    # Check if organ is available
-    if match_data.organ_type not in donor['organs_available']:
-        raise HTTPException(status_code=400, detail="Organ not available from this donor")
+    # Prefetch every referenced profile with one query per collection
+    donor_ids = list({m.donor_id for m in batch.matches})
+    recipient_ids = list({m.recipient_id for m in batch.matches})
+    donors = {d['id']: d async for d in db.donor_profiles.find({"id": {"$in": donor_ids}}, {"_id": 0})}
+    recipients = {r['id']: r async for r in db.recipient_profiles.find({"id": {"$in": recipient_ids}}, {"_id": 0})}
     
-    if match_data.organ_type not in recipient['organs_needed']:
-        raise HTTPException(status_code=400, detail="Recipient doesn't need this organ")
+    errors = []
+    pending = []  # (batch index, match)
+    for index, match_data in enumerate(batch.matches):
+        try:
+            match = build_match(match_data, donors.get(match_data.donor_id), recipients.get(match_data.recipient_id), current_user['id'])
+        except HTTPException as e:
+            errors.append(MatchBatchError(index=index, status_code=e.status_code, detail=e.detail))
+            continue
+        pending.append((index, match))
     
-    # Calculate compatibility score
-    compatibility_score = 80  # Base score for blood compatibility
-    if donor['blood_type'] == recipient['blood_type']:
-        compatibility_score = 100  # Perfect match
+    # Offer each organ first, so items competing for one (here or in another request) fail with 409;
+    # in order, so the profile writes are reported in the order they were made
+    reserved = []  # (batch index, match)
+    moves = []  # (kind, before, after) of every profile write
+    for index, match in pending:
+        try:
+            profiles = await reserve_organs(client, db, match.model_dump(), MATCH_TRANSACTIONS)
+        except TransitionConflict as e:
+            errors.append(MatchBatchError(index=index, status_code=409, detail=str(e)))
+            continue
+        reserved.append((index, match))
+        moves.extend((kind, before, after) for kind, (before, after) in profiles.items())
     
-    match = Match(
-        donor_id=match_data.donor_id,
-        recipient_id=match_data.recipient_id,
-        organ_type=match_data.organ_type,
-        compatibility_score=compatibility_score,
-        created_by=current_user['id']
-    )
+    failed = set()
+    if reserved:
+        try:
+            await db.matches.bulk_write([InsertOne(match.model_dump()) for _, match in reserved], ordered=False)
+        except BulkWriteError as e:
+            for write_error in e.details.get('writeErrors', []):
+                failed.add(write_error['index'])
+                errors.append(MatchBatchError(index=reserved[write_error['index']][0], status_code=500, detail=write_error.get('errmsg', "Write failed")))
     
-    match_dict = match.model_dump()
-    match_dict['created_at'] = match_dict['created_at'].isoformat()
+    # Organs offered for matches that were not stored go back to the pools
+    for position in sorted(failed):
+        profiles = await release_organs(db, reserved[position][1].model_dump())
+        moves.extend((kind, before, after) for kind, (before, after) in profiles.items())
     
-    await db.matches.insert_one(match_dict)
-    return match
+    errors.sort(key=lambda error: error.index)
+    created = [match for position, (_, match) in enumerate(reserved) if position not in failed]
+    if moves:
+        await collections_changed(*(['matches'] if created else []), 'donor_profiles', 'recipient_profiles')
+    for kind, before, after in moves:
+        profile_written(kind, after, before)
+    for match in created:
+        match_written(match.model_dump(), donors[match.donor_id], recipients[match.recipient_id])
+    return MatchBatchResult(created=created, errors=errors)
+
+@api_router.put("/matches/{match_id}/status", response_model=Match)
+async def update_match_status(match_id: str, update: MatchStatusUpdate, current_user: dict = Depends(get_current_principal)):
+    """Move a match through pending -> accepted -> completed (or rejected), updating the donor and recipient with it"""
+    if current_user['role'] != 'hospital':
+        raise HTTPException(status_code=403, detail="Only hospitals can update matches")
+    
+    match = await db.matches.find_one({"id": match_id}, {"_id": 0})
+    if not match:
+        raise HTTPException(status_code=404, detail="Match not found")
+    version = match.get('version', 0) if update.version is None else update.version
+    
+    try:
+        updated, profiles = await transition_match(client, db, match, update.status, version, MATCH_TRANSACTIONS)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except TransitionConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    
+    await collections_changed('matches', *(f"{kind}_profiles" for kind in profiles))
+    for kind, (before, after) in profiles.items():
+        profile_written(kind, after, before)
+    match_written(updated, profiles['donor'][1], profiles['recipient'][1], "match_updated", previous=match)
+    return updated
+
+@api_router.get("/matches/matrix")
+async def get_compatibility_matrix(current_user: dict = Depends(get_current_principal)):
+    """Every feasible pairing of available donors and waiting recipients, in columnar form"""
+    if current_user['role'] != 'hospital':
+        raise HTTPException(status_code=403, detail="Only hospitals can view the compatibility matrix")
+    
+    await index_current()
+    try:
+        return json_response(compatibility_matrix(match_index.available_donors(), match_index.waiting_recipients()))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def index_current():
+    """Wait for the compatibility index to reflect writes made by other processes"""
+    if not event_relay.active:
+        await index_sync.current()
+
+async def find_candidates(kind: str, profile: dict, radii_km: Optional[dict] = None, limit: Optional[int] = None) -> List[dict]:
+    """Compatible counterparts of a profile, from the resident index or a server-side query.
+    
+    Donors come oldest first, recipients in waiting list priority order; at
+    most ``limit`` are returned. Distance limits are always applied by the
+    database, through the 2dsphere index.
+    """
+    if radii_km is not None:
+        if not profile.get('coordinates'):
+            raise HTTPException(status_code=400, detail="Distance filters need a profile with hospital coordinates")
+        collection = db.donor_profiles if kind == 'donor' else db.recipient_profiles
+        return await collection.aggregate(candidate_pipeline(kind, profile, radii_km, limit)).to_list(None)
+    
+    if POTENTIAL_MATCH_SOURCE in ('index', 'materialized') and match_index.loaded:
+        if event_relay.active or await index_sync.fresh():
+            return indexed_candidates(match_index, waitlist, kind, profile, limit)
+        # Another process wrote profiles: answer from the database while the index reloads
+        index_sync.refresh()
+    
+    collection = db.donor_profiles if kind == 'donor' else db.recipient_profiles
+    return await collection.aggregate(candidate_pipeline(kind, profile, limit=limit)).to_list(None)
 
 @api_router.get("/matches/potential")
-async def get_potential_matches(current_user: dict = Depends(get_current_user)):
-    """Get potential matches based on blood type and organ compatibility"""
+async def get_potential_matches(
+    max_km: Optional[float] = Query(None, gt=0),
+    max_hours: Optional[float] = Query(None, gt=0),
+    ischemia: bool = False,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    current_user: dict = Depends(get_current_principal)
+):
+    """Get potential matches based on blood type and organ compatibility.
+    
+    Donors see recipients by urgency, then time on the waiting list, then
+    score; ``limit`` returns only the top candidates. ``max_km`` and
+    ``max_hours`` bound the transport distance for every organ; ``ischemia``
+    also limits each organ type to the distance it can travel within its
+    ischemia time.
+    """
+    if POTENTIAL_MATCH_SOURCE == 'materialized' and max_km is None and max_hours is None and not ischemia:
+        stored = await potential_matches.read(current_user['role'], current_user['id'], limit)
+        if stored is not None:
+            return json_response(stored)
     
     if current_user['role'] == 'recipient':
         # Get recipient profile
@@ -463,21 +958,8 @@ async def get_potential_matches(current_user: dict = Depends(get_current_user)):
         if not recipient:
             return []
         
-        # Find compatible donors
-        all_donors = await db.donor_profiles.find({"status": "available"}, {"_id": 0}).to_list(1000)
-        compatible_donors = []
-        
-        for donor in all_donors:
-            # Check blood compatibility
-            if is_blood_compatible(donor['blood_type'], recipient['blood_type']):
-                # Check if any needed organ is available
-                matching_organs = set(recipient['organs_needed']) & set(donor['organs_available'])
-                if matching_organs:
-                    donor['matching_organs'] = list(matching_organs)
-                    donor['compatibility_score'] = 100 if donor['blood_type'] == recipient['blood_type'] else 80
-                    compatible_donors.append(donor)
-        
-        return compatible_donors
+        radii = transport_limits.radii_km(recipient['organs_needed'], max_km, max_hours, ischemia)
+        return json_response(await find_candidates('donor', recipient, radii, limit))
     
     elif current_user['role'] == 'donor':
         # Get donor profile
@@ -485,34 +967,147 @@ async def get_potential_matches(current_user: dict = Depends(get_current_user)):
         if not donor:
             return []
         
-        # Find compatible recipients
-        all_recipients = await db.recipient_profiles.find({"status": "waiting"}, {"_id": 0}).to_list(1000)
-        compatible_recipients = []
-        
-        for recipient in all_recipients:
-            # Check blood compatibility
-            if is_blood_compatible(donor['blood_type'], recipient['blood_type']):
-                # Check if any available organ is needed
-                matching_organs = set(donor['organs_available']) & set(recipient['organs_needed'])
-                if matching_organs:
-                    recipient['matching_organs'] = list(matching_organs)
-                    recipient['compatibility_score'] = 100 if donor['blood_type'] == recipient['blood_type'] else 80
-                    compatible_recipients.append(recipient)
-        
-        return compatible_recipients
+        radii = transport_limits.radii_km(donor['organs_available'], max_km, max_hours, ischemia)
+        return json_response(await find_candidates('recipient', donor, radii, limit))
     
     return []
 
-# Include the router in the main app
-app.include_router(api_router)
+# Registry import/export routes
+@api_router.post("/registry/{registry}/import")
+async def import_registry(
+    registry: Literal["donors", "recipients"],
+    file: UploadFile = File(...),
+    format: Optional[Literal["csv", "parquet"]] = None,
+    current_user: dict = Depends(get_current_principal)
+):
+    """Register the donors or recipients of a CSV or Parquet file, one user and profile per row.
+    
+    Rows are validated like POST /donors and /recipients and written in
+    chunks; rows without a hospital_id are registered at the caller's
+    hospital. Invalid rows are skipped and listed in the report.
+    """
+    if current_user['role'] != 'hospital':
+        raise HTTPException(status_code=403, detail="Only hospitals can import registries")
+    try:
+        fmt = file_format(file.filename, format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    hospital = await db.hospital_profiles.find_one({"user_id": current_user['id']}, {"_id": 0, "id": 1})
+    kind = IMPORT_KINDS[registry]
+    create_model, profile_model = REGISTRY_MODELS[kind]
+    importer = RegistryImporter(
+        db, kind, create_model, profile_model, User,
+        hospital_id=hospital['id'] if hospital else None,
+        on_written=registry_imported,
+        on_users_written=users_written
+    )
+    # The upload is spooled to disk by the server, so the file is read in chunks from there
+    report = await importer.run(file.file, fmt)
+    if report['imported']:
+        await collections_changed(f"{kind}_profiles")
+    return report
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+@api_router.get("/registry/{registry}/export")
+async def export_registry(
+    registry: Literal["donors", "recipients", "matches"],
+    format: Literal["csv", "parquet"] = "csv",
+    current_user: dict = Depends(get_current_principal)
+):
+    """Every profile or match as a streamed CSV or Parquet file"""
+    if current_user['role'] != 'hospital':
+        raise HTTPException(status_code=403, detail="Only hospitals can export registries")
+    try:
+        fmt = file_format(None, format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return StreamingResponse(
+        export_chunks(db[EXPORT_COLLECTIONS[registry]], fmt),
+        media_type=MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{registry}.{fmt}"'}
+    )
+
+# Dashboard routes
+@api_router.get("/stats")
+async def get_registry_stats(current_user: dict = Depends(get_current_principal)):
+    """Registry counts by blood type, organ and status, urgency, waiting time and match conversion"""
+    if current_user['role'] != 'hospital':
+        raise HTTPException(status_code=403, detail="Only hospitals can view registry statistics")
+    
+    return json_response(await registry_stats.summary())
+
+@api_router.get("/metrics/stats")
+async def get_registry_stats_metrics(current_user: dict = Depends(get_hospital_principal)):
+    return registry_stats.stats()
+
+# Event routes
+@api_router.post("/events/ticket")
+async def create_event_ticket(current_user: dict = Depends(get_current_principal)):
+    """A ticket opening GET /events for the caller within SSE_TICKET_SECONDS"""
+    expire = datetime.now(timezone.utc) + timedelta(seconds=SSE_TICKET_SECONDS)
+    ticket = jwt.encode(
+        {"user_id": current_user['id'], "email": current_user.get('email'), "role": current_user['role'], "purpose": "sse", "exp": expire},
+        JWT_SECRET,
+        algorithm=JWT_ALGORITHM
+    )
+    return {"ticket": ticket, "expires_in": SSE_TICKET_SECONDS}
+
+@api_router.get("/events")
+async def stream_events(request: Request, ticket: str):
+    """Server-sent events for the caller.
+    
+    EventSource cannot set headers, so the stream is opened with a ticket from
+    POST /events/ticket in the query string, keeping the long-lived access
+    token out of URLs and access logs.
+    """
+    user = await principal_from_payload(request, decode_token(ticket, purpose="sse"))
+    
+    async def event_stream():
+        queue = event_bus.subscribe(user['id'], user['role'])
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {dumps(event)}\n\n"
+        finally:
+            event_bus.unsubscribe(user['id'], user['role'], queue)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@api_router.get("/metrics/events")
+async def get_event_metrics(current_user: dict = Depends(get_hospital_principal)):
+    return {**event_bus.stats(), "change_streams": event_relay.active}
+
+@metrics_router.get("/metrics")
+async def get_metrics(scraper: None = Depends(verify_scrape_token)):
+    """All process metrics in the Prometheus text format, for scrapers holding METRICS_TOKEN"""
+    return Response(metrics_registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Allocation routes
+@api_router.get("/allocations")
+async def get_allocation_plan(full: bool = False, current_user: dict = Depends(get_current_principal)):
+    """Optimal donor organ -> recipient assignment over the current pool, per organ type"""
+    if current_user['role'] != 'hospital':
+        raise HTTPException(status_code=403, detail="Only hospitals can view allocation plans")
+    
+    await index_current()
+    return json_response(await allocator.solve_in_thread(full=full))
+
+async def password_pool_full_handler(request, exc: PasswordPoolFull):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Authentication is busy, please retry shortly"},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
 
 # Configure logging
 logging.basicConfig(
@@ -521,6 +1116,164 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+class AccessLogPathOnly(logging.Filter):
+    """Drops the query string from uvicorn's access log lines, which may carry SSE tickets"""
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if isinstance(record.args, tuple) and len(record.args) == 5:
+            client_addr, method, path, http_version, status_code = record.args
+            record.args = (client_addr, method, path.partition("?")[0], http_version, status_code)
+        return True
+
+logging.getLogger("uvicorn.access").addFilter(AccessLogPathOnly())
+
+async def detect_transactions():
+    global MATCH_TRANSACTIONS
+    if os.environ.get('MATCH_TRANSACTIONS', 'auto').lower() != 'off':
+        MATCH_TRANSACTIONS = await supports_transactions(db)
+    logger.info("Match status transactions %s", "enabled" if MATCH_TRANSACTIONS else "unavailable, using compensating writes")
+
+async def warm_up():
+    """Open pooled connections and start the hashing workers before the first requests"""
+    start = time.perf_counter()
+    connections = int(os.environ.get('MONGO_WARMUP_CONNECTIONS', os.environ.get('MONGO_MIN_POOL_SIZE') or '1'))
+    await storage.warm_up(db, connections)
+    await password_hasher.warm_up()
+    logger.info("Warmed up %d database connections in %.0f ms", connections, (time.perf_counter() - start) * 1000)
+
+async def migrate_dates_before_serving():
+    """Keyset cursors and the index order by created_at, which must not mix strings and dates"""
+    pending = await string_date_collections(db)
+    if not pending:
+        return
+    if os.environ.get('MIGRATE_DATES', 'on').lower() == 'off':
+        raise RuntimeError(f"String dates remain in {', '.join(pending)}: run migrate_dates.py before serving")
+    migrated = await migrate_string_dates(db)
+    logger.info("Migrated string dates: %s", ", ".join(f"{name} {count}" for name, count in migrated.items() if count))
+
+def build_services():
+    """Create the client, caches and background services the routes use, as this module's globals"""
+    global client, db, password_hasher, principal_cache, response_cache
+    global match_index, index_sync, allocator, waitlist, event_bus, own_writes
+    global potential_matches, registry_stats, profile_fanout, event_relay, loop_lag_monitor
+    
+    # Database connection: MongoDB, or the in-memory engine when STORAGE_BACKEND=memory
+    client, db = storage.connect(event_listeners=mongo_listeners())
+    password_hasher = PasswordHasher.from_env()
+    principal_cache = PrincipalCache.from_env()
+    # Serialized list responses by ETag
+    response_cache = ResponseCache.from_env()
+    
+    # Compatibility index of available donors and waiting recipients, kept current
+    # by the profile routes and loaded from the database on startup. It sees other
+    # processes' writes through the change stream relay; without a replica set it
+    # is only current while this process is the single writer, so reads check the
+    # collection versions first and reload it after a foreign write.
+    match_index = CompatibilityIndex()
+    index_sync = IndexSync(db, match_index)
+    # Allocation plan over the index, re-solved only for organs whose pool changed
+    allocator = Allocator(match_index)
+    # Urgency-ordered recipient queues per (organ, blood type) for donor-side top-k lookups
+    waitlist = WaitlistQueues(match_index)
+    
+    # Per-user push events. With a replica set, a change stream relays every write
+    # (from any worker) to this process; otherwise writes publish in-process.
+    event_bus = EventBus()
+    event_relay = ChangeStreamRelay(db, ["donor_profiles", "recipient_profiles", "matches"], relay_change)
+    # Profile writes of this process already applied to the index, awaiting their echo from the relay
+    own_writes = OwnWrites()
+    # Finds the counterparts of each profile change once, in the background
+    profile_fanout = ProfileFanout(match_index, profile_fanned_out)
+    
+    potential_matches = PotentialMatchStore.from_env(db, match_index, waitlist)
+    # Dashboard counters, adjusted by the write hooks and reconciled periodically
+    registry_stats = RegistryStats.from_env(db)
+    loop_lag_monitor = LoopLagMonitor()
+    
+    metrics_registry.stats_gauge("password_pool", "Password hashing pool state", password_hasher.stats)
+    metrics_registry.stats_gauge("principal_cache", "Principal cache state", principal_cache.stats)
+    metrics_registry.stats_gauge("event_bus", "Server-sent event bus state", event_bus.stats)
+    metrics_registry.stats_gauge("response_cache", "Serialized list response cache state", response_cache.stats)
+    metrics_registry.stats_gauge("index_sync", "Compatibility index reloads after foreign writes", index_sync.stats)
+    metrics_registry.stats_gauge("waitlist", "Waiting list priority queue state", waitlist.stats)
+    metrics_registry.stats_gauge("profile_fanout", "Profile change fan-out queue state", profile_fanout.stats)
+    metrics_registry.stats_gauge("potential_matches", "Materialized potential match worker state", potential_matches.stats)
+    metrics_registry.stats_gauge("registry_stats", "Registry statistics counter state", registry_stats.stats)
+
+async def start_services():
+    if os.environ.get('MONGO_ENSURE_INDEXES', 'true').lower() == 'true':
+        for conflict in await ensure_indexes(db):
+            # Serve without the index rather than not at all; the duplicates need fixing by hand
+            logger.error("Unique index missing: %s", conflict)
+    await migrate_dates_before_serving()
+    if os.environ.get('WARMUP', 'on').lower() != 'off':
+        await warm_up()
+    await index_sync.load()
+    logger.info("Compatibility index loaded")
+    await detect_transactions()
+    if os.environ.get('EVENTS_CHANGE_STREAMS', 'auto').lower() != 'off':
+        await event_relay.start()
+    profile_fanout.start()
+    if POTENTIAL_MATCH_SOURCE == 'materialized':
+        potential_matches.start(refresh=index_current, unsettled=profile_fanout.busy)
+    registry_stats.start()
+    loop_lag_monitor.start()
+
+async def stop_services():
+    await loop_lag_monitor.stop()
+    await profile_fanout.stop()
+    await potential_matches.stop()
+    await registry_stats.stop()
+    await event_relay.stop()
+    client.close()
+    password_hasher.shutdown()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    build_services()
+    try:
+        await start_services()
+        yield
+    finally:
+        await stop_services()
+
+def create_app() -> FastAPI:
+    """The ASGI application: routes, error handlers and middleware.
+    
+    Its lifespan builds the database client, caches and background services
+    on startup and closes them on shutdown. They are this module's globals,
+    so one application serves per process; gunicorn.conf.py runs several
+    processes.
+    """
+    app = FastAPI(default_response_class=FastJSONResponse, lifespan=lifespan)
+    app.include_router(api_router)
+    if METRICS_TOKEN:
+        app.include_router(metrics_router)
+    app.add_exception_handler(PasswordPoolFull, password_pool_full_handler)
+    
+    # Innermost first: shed requests skip compression, but still get CORS headers and metrics
+    if os.environ.get('COMPRESSION', 'on').lower() != 'off':
+        app.add_middleware(CompressionMiddleware, **CompressionMiddleware.options_from_env())
+    if os.environ.get('ADMISSION', 'on').lower() != 'off':
+        # Admission control counters; swap in a shared AdmissionStore to enforce limits across workers
+        admission_store = MemoryAdmissionStore()
+        metrics_registry.stats_gauge("admission", "Admission control state", admission_store.stats)
+        app.add_middleware(
+            AdmissionMiddleware,
+            rules=AdmissionMiddleware.rules_from_env(),
+            identify=admission_identity,
+            store=admission_store
+        )
+    app.add_middleware(
+        CORSMiddleware,
+        allow_credentials=True,
+        allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=["X-Next-Cursor", "ETag"],
+    )
+    app.add_middleware(RequestMetricsMiddleware)
+    return app
+
+# Served by `uvicorn server:app`, or by gunicorn with gunicorn.conf.py for several workers
+app = create_app()
@@ -0,0 +1,1070 @@
+"""Storage backends behind the ``db`` handle used by the API.
+
+``STORAGE_BACKEND=mongo`` (the default) connects to ``MONGO_URL`` through
+Motor. ``STORAGE_BACKEND=memory`` uses the in-memory engine below, which
+implements the subset of the Motor collection API this codebase uses with
+MongoDB's query, update, projection, sort and unique index semantics, so the
+app, tests and benchmarks run without a database server.
+
+The memory engine keeps everything in the current process: use it for tests,
+CI-scale benchmarks and single-worker demo deployments, never for real data.
+"""
+import asyncio
+import heapq
+import os
+import re
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+from geo import EARTH_RADIUS_KM, haversine_km
+
+BACKENDS = ("mongo", "memory")
+
+# Environment variable -> (MongoClient option, type). Unset variables keep the driver defaults.
+CLIENT_OPTIONS = {
+    "MONGO_MAX_POOL_SIZE": ("maxPoolSize", int),
+    "MONGO_MIN_POOL_SIZE": ("minPoolSize", int),
+    "MONGO_MAX_CONNECTING": ("maxConnecting", int),
+    "MONGO_MAX_IDLE_TIME_MS": ("maxIdleTimeMS", int),
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": ("waitQueueTimeoutMS", int),
+    "MONGO_CONNECT_TIMEOUT_MS": ("connectTimeoutMS", int),
+    "MONGO_SOCKET_TIMEOUT_MS": ("socketTimeoutMS", int),
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": ("serverSelectionTimeoutMS", int),
+    "MONGO_COMPRESSORS": ("compressors", str),  # e.g. "zstd,snappy,zlib"; zstd and snappy need extra packages
+    "MONGO_ZLIB_LEVEL": ("zlibCompressionLevel", int),
+    "MONGO_APP_NAME": ("appname", str),
+}
+
+
+def client_options_from_env() -> dict:
+    """Connection pool, timeout and compression settings from the MONGO_* variables"""
+    options = {}
+    for variable, (option, kind) in CLIENT_OPTIONS.items():
+        value = os.environ.get(variable)
+        if value:
+            options[option] = kind(value)
+    return options
+
+
+def connect(backend: Optional[str] = None, **client_options):
+    """The (client, db) pair for the configured backend.
+
+    Motor connects lazily, so creating the client opens no sockets; see
+    ``warm_up`` for opening them before traffic arrives.
+    """
+    backend = (backend or os.environ.get('STORAGE_BACKEND', 'mongo')).lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown storage backend: {backend}")
+    db_name = os.environ.get('DB_NAME', 'test_database')
+    if backend == "memory":
+        client = MemoryClient()
+    else:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        options = {**client_options_from_env(), **client_options}
+        client = AsyncIOMotorClient(os.environ['MONGO_URL'], tz_aware=True, **options)
+    return client, client[db_name]
+
+
+async def warm_up(db, connections: int = 1):
+    """Open up to ``connections`` pooled connections with concurrent pings.
+
+    Each in-flight command holds its own connection, so the pool grows to the
+    number of concurrent pings, and server selection, the TLS handshake and
+    authentication happen here rather than in the first requests.
+    """
+    await asyncio.gather(*(db.command("ping") for _ in range(max(1, connections))))
+
+
+# Values and field paths
+
+_MISSING = object()
+
+def _copy(value):
+    # Documents only nest dicts and lists; everything else stored is immutable
+    if isinstance(value, dict):
+        return {k: _copy(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy(v) for v in value]
+    return value
+
+def _store(value):
+    """Copy a value as MongoDB would store it: UTC datetimes at millisecond precision"""
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        value = value.astimezone(timezone.utc)
+        return value.replace(microsecond=value.microsecond // 1000 * 1000)
+    if isinstance(value, dict):
+        return {k: _store(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_store(v) for v in value]
+    return value
+
+def _get(doc: dict, path: str):
+    value = doc
+    for part in path.split("."):
+        if isinstance(value, dict):
+            value = value.get(part, _MISSING)
+        elif isinstance(value, list) and part.isdigit():
+            value = value[int(part)] if int(part) < len(value) else _MISSING
+        else:
+            return _MISSING
+        if value is _MISSING:
+            return _MISSING
+    return value
+
+def _getter(path: str):
+    """Fast accessor for one field path"""
+    if "." not in path:
+        return lambda doc: doc.get(path, _MISSING)
+    return lambda doc: _get(doc, path)
+
+def _set(doc: dict, path: str, value):
+    *parents, last = path.split(".")
+    for part in parents:
+        doc = doc.setdefault(part, {})
+    doc[last] = value
+
+def _unset(doc: dict, path: str):
+    *parents, last = path.split(".")
+    for part in parents:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(last, None)
+
+def _hashable(value):
+    if isinstance(value, dict):
+        return ("__dict__",) + tuple((k, _hashable(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return ("__list__",) + tuple(_hashable(v) for v in value)
+    return value
+
+
+# BSON comparison order, so mixed-type sorts and range queries behave like MongoDB
+def _type_rank(value) -> int:
+    if value is None or value is _MISSING:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime):
+        return 9
+    return 10
+
+class _SortKey:
+    __slots__ = ("rank", "value")
+
+    def __init__(self, value):
+        if isinstance(value, datetime) and value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        self.rank = _type_rank(value)
+        self.value = value
+
+    def __lt__(self, other):
+        if self.rank != other.rank:
+            return self.rank < other.rank
+        if self.rank in (1, 4, 5):
+            return False
+        return self.value < other.value
+
+    def __eq__(self, other):
+        return self.rank == other.rank and (self.rank == 1 or self.value == other.value)
+
+def _compare(a, b) -> Optional[int]:
+    """-1, 0 or 1, or None when the values are not comparable"""
+    if a is _MISSING or _type_rank(a) != _type_rank(b) or _type_rank(a) in (4, 5):
+        return None
+    left, right = _SortKey(a), _SortKey(b)
+    return -1 if left < right else (1 if right < left else 0)
+
+
+# Query matching
+
+_TYPE_NAMES = {
+    "double": float, "string": str, "object": dict, "array": list, "objectId": ObjectId,
+    "bool": bool, "date": datetime, "null": type(None), "int": int, "long": int,
+}
+
+def _equals(value, target) -> bool:
+    if value is _MISSING:
+        return target is None
+    if isinstance(value, list) and not isinstance(target, list):
+        return any(_equals(item, target) for item in value)
+    if isinstance(value, datetime) and isinstance(target, datetime):
+        return _SortKey(value) == _SortKey(target)
+    if isinstance(value, bool) != isinstance(target, bool):
+        return False
+    return value == target
+
+def _candidates(value) -> list:
+    # A field holding an array matches an operator if the array or any element does
+    if isinstance(value, list):
+        return [value] + value
+    return [value]
+
+def _match_operator(value, op: str, arg, doc: dict, path: str) -> bool:
+    if op == "$eq":
+        return _equals(value, arg)
+    if op == "$ne":
+        return not _equals(value, arg)
+    if op in ("$gt", "$gte", "$lt", "$lte"):
+        for candidate in _candidates(value):
+            result = _compare(candidate, arg)
+            if result is not None and {"$gt": result > 0, "$gte": result >= 0, "$lt": result < 0, "$lte": result <= 0}[op]:
+                return True
+        return False
+    if op == "$in":
+        return any(_match_regex(value, item) if isinstance(item, re.Pattern) else _equals(value, item) for item in arg)
+    if op == "$nin":
+        return not _match_operator(value, "$in", arg, doc, path)
+    if op == "$exists":
+        return (value is not _MISSING) == bool(arg)
+    if op == "$type":
+        names = arg if isinstance(arg, list) else [arg]
+        for candidate in _candidates(value) if value is not _MISSING else []:
+            for name in names:
+                expected = _TYPE_NAMES.get(name)
+                if expected is not None and isinstance(candidate, expected) and not (expected is int and isinstance(candidate, bool)):
+                    return True
+        return False
+    if op == "$regex":
+        return _match_regex(value, re.compile(arg) if isinstance(arg, str) else arg)
+    if op == "$options":
+        return True
+    if op == "$size":
+        return isinstance(value, list) and len(value) == arg
+    if op == "$all":
+        return all(_equals(value, item) for item in arg)
+    if op == "$elemMatch":
+        return isinstance(value, list) and any(
+            _matches(item, arg) if isinstance(item, dict) else _match_condition(item, arg, doc, path)
+            for item in value
+        )
+    if op == "$not":
+        return not _match_condition(value, arg, doc, path)
+    if op == "$geoWithin":
+        if set(arg) != {"$centerSphere"}:
+            raise OperationFailure(f"unsupported $geoWithin shape: {', '.join(arg)}")
+        center, radians = arg["$centerSphere"]
+        position = _position(value)
+        return position is not None and haversine_km(position, center) <= radians * EARTH_RADIUS_KM
+    raise OperationFailure(f"unknown operator: {op}")
+
+def _position(value) -> Optional[List[float]]:
+    """[longitude, latitude] of a GeoJSON point or legacy coordinate pair"""
+    if isinstance(value, dict) and value.get("type") == "Point":
+        value = value.get("coordinates")
+    if isinstance(value, list) and len(value) == 2 and all(isinstance(v, (int, float)) for v in value):
+        return value
+    return None
+
+def _match_regex(value, pattern) -> bool:
+    return any(isinstance(candidate, str) and pattern.search(candidate) for candidate in _candidates(value))
+
+def _match_condition(value, condition, doc: dict, path: str) -> bool:
+    if isinstance(condition, re.Pattern):
+        return _match_regex(value, condition)
+    if isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+        if "$regex" in condition:
+            flags = re.IGNORECASE if "i" in condition.get("$options", "") else 0
+            pattern = condition["$regex"]
+            condition = {**condition, "$regex": re.compile(pattern, flags) if isinstance(pattern, str) else pattern}
+        return all(_match_operator(value, op, arg, doc, path) for op, arg in condition.items())
+    return _equals(value, condition)
+
+def _matches(doc: dict, query: dict) -> bool:
+    for key, condition in query.items():
+        if key == "$and":
+            if not all(_matches(doc, sub) for sub in condition):
+                return False
+        elif key == "$or":
+            if not any(_matches(doc, sub) for sub in condition):
+                return False
+        elif key == "$nor":
+            if any(_matches(doc, sub) for sub in condition):
+                return False
+        elif key.startswith("$"):
+            raise OperationFailure(f"unknown top level operator: {key}")
+        elif not _match_condition(_get(doc, key), condition, doc, key):
+            return False
+    return True
+
+
+# Projection, sort and updates
+
+def _project(doc: dict, projection) -> dict:
+    if not projection:
+        return _copy(doc)
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+    include_id = bool(projection.get("_id", 1))
+    fields = {k: v for k, v in projection.items() if k != "_id"}
+    if any(fields.values()):
+        result = {}
+        if include_id and "_id" in doc:
+            result["_id"] = doc["_id"]
+        for path, wanted in fields.items():
+            if wanted:
+                value = _get(doc, path)
+                if value is not _MISSING:
+                    _set(result, path, _copy(value))
+        return result
+    result = _copy(doc)
+    for path in fields:
+        _unset(result, path)
+    if not include_id:
+        result.pop("_id", None)
+    return result
+
+def _sort_spec(key_or_list, direction=None) -> List[Tuple[str, int]]:
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction or 1)]
+    return [(key, int(d)) for key, d in (key_or_list.items() if isinstance(key_or_list, dict) else key_or_list)]
+
+def _sorted(docs: List[dict], spec: List[Tuple[str, int]], limit: int = 0) -> List[dict]:
+    if not spec:
+        return docs[:limit] if limit else docs
+    if all(direction == 1 for _, direction in spec):
+        key = lambda doc: tuple(_SortKey(_get(doc, field)) for field, _ in spec)
+        return heapq.nsmallest(limit, docs, key=key) if limit else sorted(docs, key=key)
+    docs = list(docs)
+    # Stable sorts from the least significant key up
+    for field, direction in reversed(spec):
+        docs.sort(key=lambda doc: _SortKey(_get(doc, field)), reverse=direction == -1)
+    return docs[:limit] if limit else docs
+
+def _apply_update(doc: dict, update, inserting: bool = False) -> dict:
+    if not any(key.startswith("$") for key in update):
+        # Replacement document
+        replaced = _store(update)
+        replaced["_id"] = doc["_id"]
+        return replaced
+    doc = _copy(doc)
+    for op, fields in update.items():
+        for path, value in fields.items():
+            if op == "$set" or (op == "$setOnInsert" and inserting):
+                _set(doc, path, _store(value))
+            elif op == "$setOnInsert":
+                continue
+            elif op == "$unset":
+                _unset(doc, path)
+            elif op == "$inc":
+                current = _get(doc, path)
+                _set(doc, path, (0 if current is _MISSING else current) + value)
+            elif op in ("$min", "$max"):
+                current = _get(doc, path)
+                result = _compare(_store(value), current) if current is not _MISSING else -1 if op == "$min" else 1
+                if current is _MISSING or (result is not None and (result < 0 if op == "$min" else result > 0)):
+                    _set(doc, path, _store(value))
+            elif op in ("$push", "$addToSet"):
+                current = _get(doc, path)
+                items = current if isinstance(current, list) else []
+                new = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                for item in _store(new):
+                    if op == "$push" or not any(_equals(existing, item) for existing in items):
+                        items.append(item)
+                _set(doc, path, items)
+            elif op == "$pull":
+                current = _get(doc, path)
+                if isinstance(current, list):
+                    _set(doc, path, [item for item in current if not _match_condition(item, value, doc, path)])
+            elif op == "$currentDate":
+                _set(doc, path, _store(datetime.now(timezone.utc)))
+            else:
+                raise OperationFailure(f"Unknown modifier: {op}")
+    return doc
+
+def _upsert_seed(query: dict) -> dict:
+    """The equality fields of a filter, which an upsert copies into the new document"""
+    doc = {}
+    for key, condition in query.items():
+        if key == "$and":
+            for sub in condition:
+                doc.update(_upsert_seed(sub))
+        elif not key.startswith("$"):
+            if isinstance(condition, dict) and any(k.startswith("$") for k in condition):
+                if "$eq" in condition:
+                    _set(doc, key, _store(condition["$eq"]))
+            else:
+                _set(doc, key, _store(condition))
+    return doc
+
+
+# Aggregation
+
+def _truthy(value) -> bool:
+    return value not in (None, _MISSING, False, 0)
+
+def _expr_compare(op: str):
+    def evaluate(args, doc, variables):
+        left, right = (_expr(arg, doc, variables) for arg in args)
+        left, right = _SortKey(None if left is _MISSING else left), _SortKey(None if right is _MISSING else right)
+        return {"$eq": left == right, "$ne": not left == right, "$gt": right < left,
+                "$gte": not left < right, "$lt": left < right, "$lte": not right < left}[op]
+    return evaluate
+
+def _expr_filter(spec, doc, variables):
+    items = _expr(spec["input"], doc, variables)
+    if not isinstance(items, list):
+        return None
+    name = spec.get("as", "this")
+    return [item for item in items if _truthy(_expr(spec["cond"], doc, {**variables, name: item}))]
+
+def _expr_cond(spec, doc, variables):
+    if isinstance(spec, list):
+        spec = {"if": spec[0], "then": spec[1], "else": spec[2]}
+    branch = "then" if _truthy(_expr(spec["if"], doc, variables)) else "else"
+    return _expr(spec[branch], doc, variables)
+
+def _expr_if_null(args, doc, variables):
+    for arg in args:
+        value = _expr(arg, doc, variables)
+        if value not in (None, _MISSING):
+            return value
+    return None
+
+def _expr_set_intersection(args, doc, variables):
+    first, *rest = (_expr(arg, doc, variables) or [] for arg in args)
+    others = [{_hashable(item) for item in other} for other in rest]
+    unique = {_hashable(item): item for item in first}
+    return [item for key, item in unique.items() if all(key in other for other in others)]
+
+def _expr_index_of_array(args, doc, variables):
+    array, value = _expr(args[0], doc, variables), _expr(args[1], doc, variables)
+    if array is None:
+        return None
+    return next((position for position, item in enumerate(array) if _equals(item, value)), -1)
+
+_EXPRESSIONS = {
+    "$literal": lambda arg, doc, variables: arg,
+    "$eq": _expr_compare("$eq"), "$ne": _expr_compare("$ne"),
+    "$gt": _expr_compare("$gt"), "$gte": _expr_compare("$gte"),
+    "$lt": _expr_compare("$lt"), "$lte": _expr_compare("$lte"),
+    "$and": lambda args, doc, variables: all(_truthy(_expr(arg, doc, variables)) for arg in args),
+    "$or": lambda args, doc, variables: any(_truthy(_expr(arg, doc, variables)) for arg in args),
+    "$not": lambda args, doc, variables: not _truthy(_expr(args[0] if isinstance(args, list) else args, doc, variables)),
+    "$in": lambda args, doc, variables: any(
+        _equals(_expr(args[0], doc, variables), item) for item in _expr(args[1], doc, variables) or []
+    ),
+    "$size": lambda arg, doc, variables: len(_expr(arg[0] if isinstance(arg, list) else arg, doc, variables)),
+    "$add": lambda args, doc, variables: sum(_expr(arg, doc, variables) or 0 for arg in args),
+    "$cond": _expr_cond,
+    "$ifNull": _expr_if_null,
+    "$filter": _expr_filter,
+    "$setIntersection": _expr_set_intersection,
+    "$indexOfArray": _expr_index_of_array,
+}
+
+def _expr(expression, doc: dict, variables: dict):
+    """Evaluate an aggregation expression against a document"""
+    if isinstance(expression, str) and expression.startswith("$$"):
+        name, _, path = expression[2:].partition(".")
+        value = doc if name == "ROOT" else variables.get(name, _MISSING)
+        return _get(value, path) if path and isinstance(value, dict) else value
+    if isinstance(expression, str) and expression.startswith("$"):
+        return _get(doc, expression[1:])
+    if isinstance(expression, list):
+        return [_expr(item, doc, variables) for item in expression]
+    if isinstance(expression, dict):
+        if len(expression) == 1 and next(iter(expression)).startswith("$"):
+            op, arg = next(iter(expression.items()))
+            if op not in _EXPRESSIONS:
+                raise OperationFailure(f"Unrecognized expression '{op}'")
+            return _EXPRESSIONS[op](arg, doc, variables)
+        return {key: _expr(value, doc, variables) for key, value in expression.items()}
+    return expression
+
+def _project_stage(doc: dict, spec: dict) -> dict:
+    include_id = spec.get("_id", 1)
+    fields = {key: value for key, value in spec.items() if key != "_id"}
+    if fields and all(value in (0, False) for value in fields.values()):
+        return _project(doc, spec)
+    result = {}
+    if include_id not in (0, False):
+        value = doc.get("_id", _MISSING) if include_id in (1, True) else _expr(include_id, doc, {})
+        if value is not _MISSING:
+            result["_id"] = value
+    for path, value in fields.items():
+        value = _get(doc, path) if value in (1, True) else _expr(value, doc, {})
+        if value is not _MISSING:
+            _set(result, path, _copy(value))
+    return result
+
+_ACCUMULATORS = {
+    "$sum": lambda values: sum(v for v in values if isinstance(v, (int, float)) and not isinstance(v, bool)),
+    "$avg": lambda values: (lambda nums: sum(nums) / len(nums) if nums else None)([v for v in values if isinstance(v, (int, float))]),
+    "$min": lambda values: min((v for v in values if v not in (None, _MISSING)), key=_SortKey, default=None),
+    "$max": lambda values: max((v for v in values if v not in (None, _MISSING)), key=_SortKey, default=None),
+    "$first": lambda values: values[0] if values else None,
+    "$last": lambda values: values[-1] if values else None,
+    "$push": lambda values: [v for v in values if v is not _MISSING],
+    "$addToSet": lambda values: list({_hashable(v): v for v in values if v is not _MISSING}.values()),
+}
+
+def _group_stage(docs: List[dict], spec: dict) -> List[dict]:
+    groups: Dict[Any, Tuple[Any, List[dict]]] = {}
+    for doc in docs:
+        key = _expr(spec["_id"], doc, {})
+        key = None if key is _MISSING else key
+        groups.setdefault(_hashable(key), (key, []))[1].append(doc)
+    results = []
+    for key, members in groups.values():
+        result = {"_id": key}
+        for field, accumulator in spec.items():
+            if field == "_id":
+                continue
+            (op, expression), = accumulator.items()
+            if op not in _ACCUMULATORS:
+                raise OperationFailure(f"unknown group operator '{op}'")
+            result[field] = _ACCUMULATORS[op]([_expr(expression, doc, {}) for doc in members])
+        results.append(result)
+    return results
+
+def _run_pipeline(docs: List[dict], pipeline: List[dict]) -> List[dict]:
+    for stage in pipeline:
+        (name, spec), = stage.items()
+        if name == "$match":
+            spec = _store(spec)
+            docs = [doc for doc in docs if _matches(doc, spec)]
+        elif name == "$sort":
+            docs = _sorted(docs, _sort_spec(spec))
+        elif name == "$skip":
+            docs = docs[spec:]
+        elif name == "$limit":
+            docs = docs[:spec]
+        elif name == "$project":
+            docs = [_project_stage(doc, spec) for doc in docs]
+        elif name in ("$addFields", "$set"):
+            docs = [{**doc, **{field: _expr(value, doc, {}) for field, value in spec.items()}} for doc in docs]
+        elif name == "$unset":
+            docs = [_project(doc, {field: 0 for field in ([spec] if isinstance(spec, str) else spec)}) for doc in docs]
+        elif name == "$group":
+            docs = _group_stage(docs, spec)
+        elif name == "$count":
+            docs = [{spec: len(docs)}] if docs else []
+        else:
+            raise OperationFailure(f"Unrecognized pipeline stage name: '{name}'")
+    return docs
+
+
+# Engine
+
+class _Index:
+    """Unique constraint or multikey equality lookup on the leading field of an index"""
+
+    def __init__(self, name: str, keys: List[Tuple[str, int]], unique: bool):
+        self.name = name
+        self.keys = keys
+        self.unique = unique
+        self.field = keys[0][0]
+        self._field_value = _getter(self.field)
+        self._key_values = [_getter(field) for field, _ in keys]
+        self.entries: Dict[Any, set] = {}
+        self.unique_keys: Dict[tuple, Any] = {}
+
+    def _lookup_keys(self, doc: dict):
+        value = self._field_value(doc)
+        if value is _MISSING:
+            return (None,)
+        if isinstance(value, list):
+            return {_hashable(value), *(_hashable(item) for item in value)}
+        return (_hashable(value),)
+
+    def unique_key(self, doc: dict) -> tuple:
+        values = (get(doc) for get in self._key_values)
+        return tuple(None if value is _MISSING else _hashable(value) for value in values)
+
+    def add(self, doc: dict):
+        for key in self._lookup_keys(doc):
+            self.entries.setdefault(key, set()).add(doc["_id"])
+        if self.unique:
+            self.unique_keys[self.unique_key(doc)] = doc["_id"]
+
+    def remove(self, doc: dict):
+        for key in self._lookup_keys(doc):
+            ids = self.entries.get(key)
+            if ids is not None:
+                ids.discard(doc["_id"])
+                if not ids:
+                    del self.entries[key]
+        if self.unique:
+            self.unique_keys.pop(self.unique_key(doc), None)
+
+    def conflict(self, doc: dict) -> bool:
+        owner = self.unique_keys.get(self.unique_key(doc), _MISSING)
+        return owner is not _MISSING and owner != doc["_id"]
+
+    def lookup(self, condition) -> Optional[set]:
+        """Ids possibly matching an equality or $in condition on the field, None if not indexable"""
+        if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+            if set(condition) == {"$in"} and not any(isinstance(v, re.Pattern) for v in condition["$in"]):
+                values = condition["$in"]
+            elif "$eq" in condition:
+                values = [condition["$eq"]]
+            else:
+                return None
+        elif isinstance(condition, re.Pattern):
+            return None
+        else:
+            values = [condition]
+        ids = set()
+        for value in values:
+            if isinstance(value, datetime):
+                value = _store(value)
+            ids |= self.entries.get(_hashable(value), set())
+        return ids
+
+
+class _ResultCursor:
+    """Async cursor over results computed on first use"""
+
+    def __init__(self):
+        self._results: Optional[List[dict]] = None
+        self._position = 0
+
+    def _evaluate(self) -> List[dict]:
+        raise NotImplementedError
+
+    async def to_list(self, length: Optional[int] = None) -> List[dict]:
+        results = self._evaluate()
+        end = self._position + length if length else len(results)
+        taken = results[self._position:end]
+        self._position += len(taken)
+        return taken
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> dict:
+        results = self._evaluate()
+        if self._position >= len(results):
+            raise StopAsyncIteration
+        self._position += 1
+        return results[self._position - 1]
+
+    async def close(self):
+        self._results = []
+        self._position = 0
+
+
+class MemoryCursor(_ResultCursor):
+    def __init__(self, collection: "MemoryCollection", query: dict, projection):
+        super().__init__()
+        self._collection = collection
+        self._query = query or {}
+        self._projection = projection
+        self._sort: List[Tuple[str, int]] = []
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key_or_list, direction=None) -> "MemoryCursor":
+        self._sort = _sort_spec(key_or_list, direction)
+        return self
+
+    def skip(self, count: int) -> "MemoryCursor":
+        self._skip = count
+        return self
+
+    def limit(self, count: int) -> "MemoryCursor":
+        self._limit = count
+        return self
+
+    def _evaluate(self) -> List[dict]:
+        if self._results is None:
+            docs = self._collection._select(self._query)
+            wanted = self._skip + self._limit if self._limit else 0
+            docs = _sorted(docs, self._sort, wanted)[self._skip:]
+            self._results = [_project(doc, self._projection) for doc in docs]
+        return self._results
+
+
+class MemoryAggregateCursor(_ResultCursor):
+    def __init__(self, collection: "MemoryCollection", pipeline: List[dict]):
+        super().__init__()
+        self._collection = collection
+        self._pipeline = list(pipeline)
+
+    def _evaluate(self) -> List[dict]:
+        if self._results is None:
+            pipeline = self._pipeline
+            if any("$geoNear" in stage for stage in pipeline[1:]):
+                raise OperationFailure("$geoNear is only valid as the first stage in a pipeline")
+            if pipeline and "$geoNear" in pipeline[0]:
+                docs, pipeline = self._collection._geo_near(pipeline[0]["$geoNear"]), pipeline[1:]
+            elif pipeline and "$match" in pipeline[0]:
+                # A leading $match can use the indexes
+                docs, pipeline = self._collection._select(pipeline[0]["$match"]), pipeline[1:]
+            else:
+                docs = list(self._collection._docs.values())
+            self._results = [_copy(doc) for doc in _run_pipeline(docs, pipeline)]
+        return self._results
+
+
+
+class MemoryCollection:
+    def __init__(self, database: "MemoryDatabase", name: str):
+        self.database = database
+        self.name = name
+        self._docs: Dict[Any, dict] = {}
+        # Insertion sequence of each document, for natural order after an index lookup
+        self._sequence: Dict[Any, int] = {}
+        self._next_sequence = 0
+        self._indexes: Dict[str, _Index] = {}
+        self.create_index_sync([("_id", 1)], name="_id_", unique=True)
+
+    # Indexes
+
+    def create_index_sync(self, keys, name: Optional[str] = None, unique: bool = False) -> str:
+        # Directions are 1/-1, or a string such as "2dsphere" for special index types
+        keys = [(field, d if isinstance(d, str) else int(d)) for field, d in ([(keys, 1)] if isinstance(keys, str) else keys.items() if isinstance(keys, dict) else keys)]
+        name = name or "_".join(f"{field}_{direction}" for field, direction in keys)
+        if name in self._indexes:
+            return name
+        index = _Index(name, keys, unique)
+        for doc in self._docs.values():
+            if unique and index.conflict(doc):
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.full_name} index: {name}", 11000)
+            index.add(doc)
+        self._indexes[name] = index
+        return name
+
+    async def create_index(self, keys, **kwargs) -> str:
+        return self.create_index_sync(keys, name=kwargs.get("name"), unique=kwargs.get("unique", False))
+
+    async def create_indexes(self, indexes) -> List[str]:
+        names = []
+        for model in indexes:
+            document = model.document
+            names.append(self.create_index_sync(list(document["key"].items()), document.get("name"), document.get("unique", False)))
+        return names
+
+    async def drop_index(self, name: str):
+        self._indexes.pop(name, None)
+
+    async def index_information(self) -> dict:
+        return {
+            name: {"key": index.keys, **({"unique": True} if index.unique and name != "_id_" else {})}
+            for name, index in self._indexes.items()
+        }
+
+    @property
+    def full_name(self) -> str:
+        return f"{self.database.name}.{self.name}"
+
+    # Reads
+
+    def _select(self, query: dict) -> List[dict]:
+        """Stored documents matching query, narrowed through an index where one applies"""
+        # Query values are compared as they would be stored
+        query = _store(query or {})
+        best = None
+        for key, condition in query.items():
+            if key.startswith("$"):
+                continue
+            for index in self._indexes.values():
+                if index.field == key:
+                    ids = index.lookup(condition)
+                    if ids is not None and (best is None or len(ids) < len(best)):
+                        best = ids
+                    break
+        if best is None:
+            source = self._docs.values()
+        else:
+            # Keep insertion (natural) order
+            source = [self._docs[doc_id] for doc_id in sorted(best, key=self._sequence.__getitem__)]
+        return [doc for doc in source if _matches(doc, query)] if query else list(source)
+
+    def _geo_near(self, spec: dict) -> List[dict]:
+        """Documents of a spherical $geoNear stage, nearest first, with the distance in meters"""
+        geo_fields = [index.field for index in self._indexes.values() if any(d == "2dsphere" for _, d in index.keys)]
+        key = spec.get("key") or (geo_fields[0] if len(geo_fields) == 1 else None)
+        if key is None or key not in geo_fields:
+            raise OperationFailure("$geoNear requires exactly one 2dsphere index, or a key naming one")
+        near = _position(spec["near"])
+        multiplier = spec.get("distanceMultiplier", 1)
+        found = []
+        for doc in self._select(spec.get("query") or {}):
+            position = _position(_get(doc, key))
+            if position is None:
+                continue
+            meters = haversine_km(position, near) * 1000
+            if meters > spec.get("maxDistance", float("inf")) or meters < spec.get("minDistance", 0):
+                continue
+            found.append((meters, self._sequence[doc["_id"]], doc))
+        found.sort(key=lambda item: item[:2])
+        return [{**doc, spec["distanceField"]: meters * multiplier} for meters, _, doc in found]
+
+    def find(self, filter: Optional[dict] = None, projection=None, sort=None, limit: int = 0, skip: int = 0) -> MemoryCursor:
+        cursor = MemoryCursor(self, filter, projection)
+        if sort:
+            cursor.sort(sort)
+        return cursor.skip(skip).limit(limit)
+
+    async def find_one(self, filter: Optional[dict] = None, projection=None, sort=None, session=None) -> Optional[dict]:
+        if filter is not None and not isinstance(filter, dict):
+            filter = {"_id": filter}
+        results = await self.find(filter, projection, sort=sort, limit=1).to_list(1)
+        return results[0] if results else None
+
+    async def count_documents(self, filter: dict, limit: int = 0, skip: int = 0) -> int:
+        count = max(0, len(self._select(filter)) - skip)
+        return min(count, limit) if limit else count
+
+    def aggregate(self, pipeline: List[dict], **kwargs) -> MemoryAggregateCursor:
+        return MemoryAggregateCursor(self, pipeline)
+
+    async def estimated_document_count(self) -> int:
+        return len(self._docs)
+
+    async def distinct(self, key: str, filter: Optional[dict] = None) -> list:
+        values = []
+        for doc in self._select(filter or {}):
+            value = _get(doc, key)
+            for item in value if isinstance(value, list) else [value]:
+                if item is not _MISSING and not any(_equals(item, seen) for seen in values):
+                    values.append(item)
+        return values
+
+    # Writes
+
+    def _check_unique(self, doc: dict):
+        for index in self._indexes.values():
+            if index.unique and index.conflict(doc):
+                key = {field: _get(doc, field) for field, _ in index.keys}
+                raise DuplicateKeyError(
+                    f"E11000 duplicate key error collection: {self.full_name} index: {index.name} dup key: {key}",
+                    11000, {"keyValue": key}
+                )
+
+    def _insert(self, document: dict):
+        if "_id" not in document:
+            # Like the driver, the caller's document receives the generated _id
+            document["_id"] = ObjectId()
+        doc = _store(document)
+        self._check_unique(doc)
+        self._docs[doc["_id"]] = doc
+        self._sequence[doc["_id"]] = self._next_sequence
+        self._next_sequence += 1
+        for index in self._indexes.values():
+            index.add(doc)
+        return doc["_id"]
+
+    def _replace(self, old: dict, new: dict):
+        for index in self._indexes.values():
+            index.remove(old)
+        try:
+            self._check_unique(new)
+        except DuplicateKeyError:
+            for index in self._indexes.values():
+                index.add(old)
+            raise
+        self._docs[new["_id"]] = new
+        for index in self._indexes.values():
+            index.add(new)
+
+    def _delete(self, doc: dict):
+        for index in self._indexes.values():
+            index.remove(doc)
+        del self._docs[doc["_id"]]
+        del self._sequence[doc["_id"]]
+
+    def _update(self, query: dict, update: dict, upsert: bool, multi: bool, sort=None) -> Tuple[int, int, Any, Optional[dict], Optional[dict]]:
+        """(matched, modified, upserted id, document before, document after) of an update"""
+        docs = self._select(query)
+        if sort:
+            docs = _sorted(docs, _sort_spec(sort))
+        if not multi:
+            docs = docs[:1]
+        if not docs:
+            if not upsert:
+                return 0, 0, None, None, None
+            seed = _upsert_seed(query)
+            seed.setdefault("_id", ObjectId())
+            new = _apply_update(seed, update, inserting=True)
+            new.setdefault("_id", seed["_id"])
+            self._insert(new)
+            return 0, 0, new["_id"], None, new
+        modified = 0
+        before = after = None
+        for doc in docs:
+            new = _apply_update(doc, update)
+            if new.get("_id") != doc["_id"]:
+                raise OperationFailure("Performing an update on the path '_id' would modify the immutable field '_id'")
+            if new != doc:
+                self._replace(doc, new)
+                modified += 1
+            before, after = doc, new
+        return len(docs), modified, None, before, after
+
+    async def insert_one(self, document: dict, bypass_document_validation: bool = False, session=None) -> InsertOneResult:
+        return InsertOneResult(self._insert(document), True)
+
+    async def insert_many(self, documents: Iterable[dict], ordered: bool = True, bypass_document_validation: bool = False) -> InsertManyResult:
+        requests = [InsertOne(document) for document in documents]
+        result = await self.bulk_write(requests, ordered=ordered)
+        return InsertManyResult([request._doc["_id"] for request in requests], result.acknowledged)
+
+    async def update_one(self, filter: dict, update: dict, upsert: bool = False, session=None) -> UpdateResult:
+        matched, modified, upserted, _, _ = self._update(filter, update, upsert, multi=False)
+        return UpdateResult(self._raw_update(matched, modified, upserted), True)
+
+    async def update_many(self, filter: dict, update: dict, upsert: bool = False, session=None) -> UpdateResult:
+        matched, modified, upserted, _, _ = self._update(filter, update, upsert, multi=True)
+        return UpdateResult(self._raw_update(matched, modified, upserted), True)
+
+    async def replace_one(self, filter: dict, replacement: dict, upsert: bool = False) -> UpdateResult:
+        if any(key.startswith("$") for key in replacement):
+            raise ValueError("replacement can not include $ operators")
+        return await self.update_one(filter, replacement, upsert=upsert)
+
+    @staticmethod
+    def _raw_update(matched: int, modified: int, upserted) -> dict:
+        raw = {"n": matched + (1 if upserted is not None else 0), "nModified": modified, "ok": 1.0}
+        if upserted is not None:
+            raw["upserted"] = upserted
+        return raw
+
+    async def find_one_and_update(self, filter: dict, update: dict, projection=None, sort=None,
+                                  upsert: bool = False, return_document: bool = False, session=None) -> Optional[dict]:
+        _, _, _, before, after = self._update(filter, update, upsert, multi=False, sort=sort)
+        doc = after if return_document else before
+        return _project(doc, projection) if doc is not None else None
+
+    async def find_one_and_replace(self, filter: dict, replacement: dict, projection=None, sort=None,
+                                   upsert: bool = False, return_document: bool = False) -> Optional[dict]:
+        return await self.find_one_and_update(filter, replacement, projection, sort, upsert, return_document)
+
+    async def find_one_and_delete(self, filter: dict, projection=None, sort=None) -> Optional[dict]:
+        docs = _sorted(self._select(filter), _sort_spec(sort) if sort else [], 1)
+        if not docs:
+            return None
+        self._delete(docs[0])
+        return _project(docs[0], projection)
+
+    async def delete_one(self, filter: dict) -> DeleteResult:
+        docs = self._select(filter)[:1]
+        for doc in docs:
+            self._delete(doc)
+        return DeleteResult({"n": len(docs), "ok": 1.0}, True)
+
+    async def delete_many(self, filter: dict) -> DeleteResult:
+        docs = self._select(filter)
+        for doc in docs:
+            self._delete(doc)
+        return DeleteResult({"n": len(docs), "ok": 1.0}, True)
+
+    async def bulk_write(self, requests, ordered: bool = True, bypass_document_validation: bool = False) -> BulkWriteResult:
+        result = {
+            "writeErrors": [], "writeConcernErrors": [], "nInserted": 0, "nUpserted": 0,
+            "nMatched": 0, "nModified": 0, "nRemoved": 0, "upserted": [],
+        }
+        for position, request in enumerate(requests):
+            try:
+                if isinstance(request, InsertOne):
+                    self._insert(request._doc)
+                    result["nInserted"] += 1
+                elif isinstance(request, (UpdateOne, UpdateMany, ReplaceOne)):
+                    matched, modified, upserted, _, _ = self._update(
+                        request._filter, request._doc, bool(request._upsert), multi=isinstance(request, UpdateMany)
+                    )
+                    result["nMatched"] += matched
+                    result["nModified"] += modified
+                    if upserted is not None:
+                        result["nUpserted"] += 1
+                        result["upserted"].append({"index": position, "_id": upserted})
+                elif isinstance(request, (DeleteOne, DeleteMany)):
+                    deleted = await (self.delete_many if isinstance(request, DeleteMany) else self.delete_one)(request._filter)
+                    result["nRemoved"] += deleted.deleted_count
+                else:
+                    raise TypeError(f"{request!r} is not a valid request")
+            except (DuplicateKeyError, OperationFailure) as e:
+                result["writeErrors"].append({
+                    "index": position, "code": e.code or 2, "errmsg": str(e),
+                    "keyValue": (e.details or {}).get("keyValue"), "op": getattr(request, "_doc", None)
+                })
+                if ordered:
+                    break
+        if result["writeErrors"]:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+    async def drop(self):
+        self.database._collections.pop(self.name, None)
+
+    def watch(self, *args, **kwargs):
+        return self.database.watch(*args, **kwargs)
+
+
+class MemoryDatabase:
+    def __init__(self, client: "MemoryClient", name: str):
+        self.client = client
+        self.name = name
+        self._collections: Dict[str, MemoryCollection] = {}
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = MemoryCollection(self, name)
+        return collection
+
+    def __getattr__(self, name: str) -> MemoryCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def get_collection(self, name: str) -> MemoryCollection:
+        return self[name]
+
+    async def list_collection_names(self) -> List[str]:
+        return list(self._collections)
+
+    async def drop_collection(self, name: str):
+        self._collections.pop(name, None)
+
+    async def command(self, command, *args, **kwargs):
+        name = next(iter(command)) if isinstance(command, dict) else command
+        if name == "ping":
+            return {"ok": 1.0}
+        raise OperationFailure(f"Command {name} is not supported by the in-memory storage engine")
+
+    def watch(self, *args, **kwargs):
+        # Same failure as a standalone mongod, so change stream consumers fall back
+        raise OperationFailure("The $changeStream stage is only supported on replica sets", 40573)
+
+
+class MemoryClient:
+    def __init__(self):
+        self._databases: Dict[str, MemoryDatabase] = {}
+
+    def __getitem__(self, name: str) -> MemoryDatabase:
+        database = self._databases.get(name)
+        if database is None:
+            database = self._databases[name] = MemoryDatabase(self, name)
+        return database
+
+    def get_database(self, name: str) -> MemoryDatabase:
+        return self[name]
+
+    async def drop_database(self, name):
+        self._databases.pop(getattr(name, "name", name), None)
+
+    async def list_database_names(self) -> List[str]:
+        return list(self._databases)
+
+    def close(self):
+        pass
@@ -0,0 +1,139 @@
+"""Urgency-ordered waiting list queues over the compatibility index.
+
+Waiting recipients are kept in one sorted queue per (organ, blood type),
+ordered by urgency (most urgent first), then time on the list (longest first).
+Every recipient in a queue scores the same against a given donor, so the
+candidates of a donor are a k-way merge of the queues compatible with it, with
+the blood type score as the final tie-break. Taking the top ``k`` costs
+O(k log q) for q merged queues instead of a scan of the whole pool.
+"""
+import heapq
+from bisect import bisect_left, insort
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from codec import parse_date
+from compatibility import BLOOD_COMPATIBILITY, URGENCY_LEVELS, CompatibilityIndex, candidate_view, compatibility_score
+
+
+def urgency_rank(level: Optional[str]) -> int:
+    # Unknown levels rank below "low", like $indexOfArray in candidate_pipeline
+    return URGENCY_LEVELS.index(level) if level in URGENCY_LEVELS else -1
+
+def queue_key(recipient: dict) -> Tuple[int, datetime, str]:
+    created_at = parse_date(recipient['created_at'])
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    return -urgency_rank(recipient.get('urgency_level')), created_at, recipient['id']
+
+
+class WaitlistQueues:
+    """Sorted recipient queues per (organ, blood type), kept current through the index listeners"""
+
+    def __init__(self, index: CompatibilityIndex):
+        self.index = index
+        self.queues: Dict[Tuple[str, str], List[Tuple[int, datetime, str]]] = {}
+        self._keys: Dict[str, Tuple[int, datetime, str]] = {}
+        self.generation = None
+        index.listeners.append(self.profile_changed)
+
+    def profile_changed(self, kind: str, old: Optional[dict], new: Optional[dict]):
+        if kind != 'recipient' or self.generation != self.index.generation:
+            return
+        if old is not None:
+            self._remove(old)
+        if new is not None:
+            self._add(new)
+
+    def _add(self, recipient: dict):
+        key = queue_key(recipient)
+        self._keys[recipient['id']] = key
+        for organ in set(recipient['organs_needed']):
+            insort(self.queues.setdefault((organ, recipient['blood_type']), []), key)
+
+    def _remove(self, recipient: dict):
+        key = self._keys.pop(recipient['id'], None)
+        if key is None:
+            return
+        for organ in set(recipient['organs_needed']):
+            queue = self.queues.get((organ, recipient['blood_type']))
+            if queue is None:
+                continue
+            position = bisect_left(queue, key)
+            if position < len(queue) and queue[position] == key:
+                del queue[position]
+            if not queue:
+                del self.queues[(organ, recipient['blood_type'])]
+
+    def _sync(self):
+        # A reload of the index replaces every entry
+        if self.generation != self.index.generation:
+            self.queues.clear()
+            self._keys.clear()
+            for recipient in self.index.waiting_recipients():
+                self._add(recipient)
+            self.generation = self.index.generation
+
+    def _merged(self, donor: dict) -> Iterator[Tuple[int, datetime, int, str, str]]:
+        streams = []
+        for organ in dict.fromkeys(donor['organs_available']):
+            for blood in BLOOD_COMPATIBILITY.get(donor['blood_type'], []):
+                queue = self.queues.get((organ, blood))
+                if queue:
+                    streams.append(_entries(queue, compatibility_score(donor['blood_type'], blood), organ))
+        return heapq.merge(*streams)
+
+    def top_recipients(self, donor: dict, limit: Optional[int] = None) -> List[dict]:
+        """Waiting recipients compatible with a donor in priority order, annotated like recipients_for.
+
+        A recipient needing several of the donor's organs sits in several
+        queues under the same key, so its entries come out of the merge together.
+        """
+        self._sync()
+        found: List[dict] = []
+        for _, group in _grouped(self._merged(donor)):
+            if limit is not None and len(found) >= limit:
+                break
+            (_, _, score, recipient_id, _), organs = group[0], [entry[4] for entry in group]
+            found.append({
+                **self.index.get_recipient(recipient_id),
+                'matching_organs': [organ for organ in dict.fromkeys(donor['organs_available']) if organ in organs],
+                'compatibility_score': -score
+            })
+        return found
+
+    def stats(self) -> dict:
+        self._sync()
+        return {"queues": len(self.queues), "recipients": len(self._keys)}
+
+
+def indexed_candidates(index: CompatibilityIndex, waitlist: WaitlistQueues, kind: str, profile: dict,
+                       limit: Optional[int] = None) -> List[dict]:
+    """Candidates of ``kind`` for a profile from the resident structures, trimmed for display.
+
+    Recipients come in waiting list priority order, donors oldest first.
+    """
+    if kind == 'recipient':
+        # Merge the compatible waiting list queues, stopping after the top ``limit``
+        found = waitlist.top_recipients(profile, limit)
+    else:
+        # Walk the compatible (blood type, organ) buckets
+        found = index.donors_for(profile)
+        found.sort(key=lambda candidate: (candidate['created_at'], candidate['id']))
+        found = found[:limit]
+    return [candidate_view(kind, candidate) for candidate in found]
+
+
+def _entries(queue: list, score: int, organ: str) -> Iterator[Tuple[int, datetime, int, str, str]]:
+    for urgency, created_at, recipient_id in queue:
+        yield urgency, created_at, -score, recipient_id, organ
+
+def _grouped(entries) -> Iterator[Tuple[str, list]]:
+    group: list = []
+    for entry in entries:
+        if group and entry[:4] != group[0][:4]:
+            yield group[0][3], group
+            group = []
+        group.append(entry)
+    if group:
+        yield group[0][3], group
@@ -0,0 +1,328 @@
+"""Async load test and latency benchmark for the LifeLink API.
+
+Runs a mixed workload (logins, dashboard loads, potential-match lookups and
+match creation) at a fixed concurrency and reports p50/p95/p99 latency,
+requests per second, bytes on the wire and server-side JSON encoding time
+(from the Server-Timing header) per route.
+
+By default the FastAPI app runs in-process against a throwaway database on the
+local MongoDB from backend/.env, or on the in-memory storage engine with
+--storage memory. Pass --base-url to drive a running server.
+
+    python backend_benchmark.py --concurrency 32 --duration 30 --output bench.json
+    python backend_benchmark.py --output new.json --compare bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+
+import httpx
+
+BACKEND_DIR = Path(__file__).parent / "backend"
+
+BLOOD_TYPES = ["O-", "O+", "A-", "A+", "B-", "B+", "AB-", "AB+"]
+ORGANS = ["heart", "kidney", "liver", "lungs", "pancreas", "intestines"]
+URGENCY = ["low", "medium", "high", "critical"]
+
+# Relative frequency of each scenario in the mixed workload
+WORKLOAD = {
+    "login": 5,
+    "hospital_dashboard": 20,
+    "donor_dashboard": 20,
+    "recipient_dashboard": 20,
+    "potential_matches": 25,
+    "create_match": 10,
+}
+
+
+def server_timing(header, metric) -> float:
+    """Seconds reported for one metric of a Server-Timing header, 0 if absent"""
+    for entry in (header or "").split(","):
+        name, *params = entry.strip().split(";")
+        if name == metric:
+            for param in params:
+                key, _, value = param.partition("=")
+                if key.strip() == "dur":
+                    return float(value) / 1000
+    return 0.0
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, round(pct / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class APIBenchmark:
+    def __init__(self, client: httpx.AsyncClient, concurrency: int, duration: float, users: int, seed: int):
+        self.client = client
+        self.concurrency = concurrency
+        self.duration = duration
+        self.users = users
+        self.random = random.Random(seed)
+        self.password = "bench-password"
+        self.accounts = {"donor": [], "recipient": [], "hospital": []}
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.bytes_received = defaultdict(int)
+        self.serialize_seconds = defaultdict(float)
+
+    async def request(self, route, method, path, token=None, **kwargs):
+        headers = kwargs.pop("headers", {})
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, path, headers=headers, **kwargs)
+        except httpx.HTTPError:
+            self.errors[route] += 1
+            return None
+        self.latencies[route].append(time.perf_counter() - start)
+        self.bytes_received[route] += int(response.headers.get("content-length", len(response.content)))
+        self.serialize_seconds[route] += server_timing(response.headers.get("server-timing"), "serialize")
+        if response.status_code >= 400:
+            self.errors[route] += 1
+        return response
+
+    async def register(self, role):
+        email = f"bench_{role}_{uuid.uuid4().hex[:12]}@example.com"
+        response = await self.request("POST /auth/register", "POST", "/auth/register", json={
+            "email": email, "password": self.password, "name": f"Bench {role}", "role": role
+        })
+        if response is None or response.status_code != 200:
+            raise RuntimeError(f"Registration failed: {response.text if response is not None else 'no response'}")
+        token = response.json()["access_token"]
+
+        if role == "donor":
+            await self.request("POST /donors", "POST", "/donors", token, json={
+                "blood_type": self.random.choice(BLOOD_TYPES),
+                "age": self.random.randint(18, 70),
+                "organs_available": self.random.sample(ORGANS, self.random.randint(1, 3))
+            })
+        elif role == "recipient":
+            await self.request("POST /recipients", "POST", "/recipients", token, json={
+                "blood_type": self.random.choice(BLOOD_TYPES),
+                "age": self.random.randint(1, 80),
+                "organs_needed": self.random.sample(ORGANS, 1),
+                "urgency_level": self.random.choice(URGENCY)
+            })
+        else:
+            await self.request("POST /hospitals", "POST", "/hospitals", token, json={
+                "hospital_name": "Bench General", "location": "Bench City", "contact_number": "555-0100"
+            })
+        self.accounts[role].append({"email": email, "token": token})
+
+    async def setup(self):
+        roles = ["donor", "recipient"] * self.users + ["hospital"] * max(1, self.users // 10)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def register(role):
+            async with semaphore:
+                await self.register(role)
+
+        await asyncio.gather(*(register(role) for role in roles))
+        # Setup traffic is not part of the measurement
+        self.latencies.clear()
+        self.errors.clear()
+        self.bytes_received.clear()
+        self.serialize_seconds.clear()
+
+    async def scenario_login(self):
+        role = self.random.choice(list(self.accounts))
+        account = self.random.choice(self.accounts[role])
+        await self.request("POST /auth/login", "POST", "/auth/login", json={"email": account["email"], "password": self.password})
+
+    async def scenario_hospital_dashboard(self):
+        token = self.random.choice(self.accounts["hospital"])["token"]
+        await asyncio.gather(
+            self.request("GET /hospitals/me", "GET", "/hospitals/me", token),
+            self.request("GET /donors", "GET", "/donors", token),
+            self.request("GET /recipients", "GET", "/recipients", token),
+            self.request("GET /matches", "GET", "/matches", token),
+        )
+
+    async def scenario_donor_dashboard(self):
+        token = self.random.choice(self.accounts["donor"])["token"]
+        await asyncio.gather(
+            self.request("GET /donors/me", "GET", "/donors/me", token),
+            self.request("GET /matches/potential", "GET", "/matches/potential", token),
+            self.request("GET /matches", "GET", "/matches", token),
+        )
+
+    async def scenario_recipient_dashboard(self):
+        token = self.random.choice(self.accounts["recipient"])["token"]
+        await asyncio.gather(
+            self.request("GET /recipients/me", "GET", "/recipients/me", token),
+            self.request("GET /matches/potential", "GET", "/matches/potential", token),
+            self.request("GET /matches", "GET", "/matches", token),
+        )
+
+    async def scenario_potential_matches(self):
+        role = self.random.choice(["donor", "recipient"])
+        token = self.random.choice(self.accounts[role])["token"]
+        await self.request("GET /matches/potential", "GET", "/matches/potential", token)
+
+    async def scenario_create_match(self):
+        token = self.random.choice(self.accounts["recipient"])["token"]
+        response = await self.request("GET /matches/potential", "GET", "/matches/potential", token)
+        recipient = await self.request("GET /recipients/me", "GET", "/recipients/me", token)
+        if not response or not recipient or response.status_code != 200 or recipient.status_code != 200 or not response.json():
+            return
+        donor = self.random.choice(response.json())
+        hospital = self.random.choice(self.accounts["hospital"])["token"]
+        await self.request("POST /matches", "POST", "/matches", hospital, json={
+            "donor_id": donor["id"],
+            "recipient_id": recipient.json()["id"],
+            "organ_type": self.random.choice(donor["matching_organs"])
+        })
+
+    async def run(self) -> dict:
+        scenarios = list(WORKLOAD)
+        weights = [WORKLOAD[name] for name in scenarios]
+        deadline = time.perf_counter() + self.duration
+
+        async def worker():
+            while time.perf_counter() < deadline:
+                name = self.random.choices(scenarios, weights)[0]
+                await getattr(self, f"scenario_{name}")()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        elapsed = time.perf_counter() - start
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> dict:
+        routes = {}
+        for route, samples in sorted(self.latencies.items()):
+            samples = sorted(samples)
+            routes[route] = {
+                "requests": len(samples),
+                "errors": self.errors.get(route, 0),
+                "rps": round(len(samples) / elapsed, 2),
+                "p50_ms": round(percentile(samples, 50) * 1000, 2),
+                "p95_ms": round(percentile(samples, 95) * 1000, 2),
+                "p99_ms": round(percentile(samples, 99) * 1000, 2),
+                "mean_bytes": round(self.bytes_received[route] / len(samples)),
+                "mean_serialize_ms": round(self.serialize_seconds[route] * 1000 / len(samples), 3),
+            }
+        total = sum(route["requests"] for route in routes.values())
+        return {
+            "timestamp": datetime.now().isoformat(),
+            "concurrency": self.concurrency,
+            "duration_s": round(elapsed, 2),
+            "users": self.users,
+            "accept_encoding": self.client.headers.get("accept-encoding"),
+            "total_requests": total,
+            "total_rps": round(total / elapsed, 2),
+            "routes": routes,
+        }
+
+
+def print_report(result: dict):
+    print(f"\n📊 {result['total_requests']} requests in {result['duration_s']}s "
+          f"({result['total_rps']} req/s, concurrency {result['concurrency']})")
+    print(f"{'route':<26}{'reqs':>8}{'err':>6}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'bytes':>10}{'json ms':>10}")
+    for route, stats in result["routes"].items():
+        print(f"{route:<26}{stats['requests']:>8}{stats['errors']:>6}{stats['rps']:>9}"
+              f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}{stats['mean_bytes']:>10}"
+              f"{stats['mean_serialize_ms']:>10}")
+
+
+def compare(result: dict, baseline: dict, threshold: float) -> list:
+    """Routes whose p95 latency or throughput regressed by more than threshold"""
+    regressions = []
+    for route, stats in result["routes"].items():
+        before = baseline.get("routes", {}).get(route)
+        if not before:
+            continue
+        if before["p95_ms"] and stats["p95_ms"] > before["p95_ms"] * (1 + threshold):
+            regressions.append(f"{route}: p95 {before['p95_ms']}ms -> {stats['p95_ms']}ms")
+        if before["rps"] and stats["rps"] < before["rps"] * (1 - threshold):
+            regressions.append(f"{route}: rps {before['rps']} -> {stats['rps']}")
+    return regressions
+
+
+async def in_process_client(storage: str = None):
+    """ASGI client for the app on a fresh database, plus a teardown coroutine"""
+    from dotenv import load_dotenv
+
+    load_dotenv(BACKEND_DIR / ".env")
+    db_name = f"bench_{uuid.uuid4().hex[:8]}"
+    os.environ["DB_NAME"] = db_name
+    if storage:
+        os.environ["STORAGE_BACKEND"] = storage
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+
+    lifespan = server.app.router.lifespan_context(server.app)
+    await lifespan.__aenter__()
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://bench/api", timeout=60)
+
+    async def teardown():
+        await client.aclose()
+        await server.client.drop_database(db_name)
+        await lifespan.__aexit__(None, None, None)
+
+    return client, teardown
+
+
+async def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", help="benchmark a running server, e.g. http://localhost:8001/api")
+    parser.add_argument("--storage", choices=["mongo", "memory"], help="storage backend of the in-process app")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20, help="seconds of measured load")
+    parser.add_argument("--users", type=int, default=50, help="donors and recipients to register")
+    parser.add_argument("--accept-encoding", default="gzip, br", help='sent with every request; "identity" disables compression')
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the machine-readable results to this JSON file")
+    parser.add_argument("--compare", help="baseline results JSON to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.15, help="allowed relative regression (default 0.15)")
+    args = parser.parse_args(argv)
+
+    if args.base_url:
+        client = httpx.AsyncClient(base_url=args.base_url.rstrip("/"), timeout=60,
+                                   limits=httpx.Limits(max_connections=args.concurrency * 4))
+
+        async def teardown():
+            await client.aclose()
+    else:
+        client, teardown = await in_process_client(args.storage)
+
+    client.headers["Accept-Encoding"] = args.accept_encoding
+    try:
+        benchmark = APIBenchmark(client, args.concurrency, args.duration, args.users, args.seed)
+        print(f"🧪 Registering {args.users} donors and recipients...")
+        await benchmark.setup()
+        print(f"🚀 Running mixed workload for {args.duration}s at concurrency {args.concurrency}...")
+        result = await benchmark.run()
+    finally:
+        await teardown()
+
+    print_report(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(result, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f"❌ {regression}")
+        if regressions:
+            return 1
+        print("🎉 No regressions against baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
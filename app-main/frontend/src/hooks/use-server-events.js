@@ -0,0 +1,71 @@
+import { useEffect, useRef } from "react";
+import axios from "axios";
+import { API } from "@/App";
+
+const EVENT_TYPES = ["match_created", "match_updated", "profile_changed", "potential_matches_changed"];
+const RECONNECT_MS = 5000;
+
+// Replace the item with the same id in a list, or append it
+export const upsertById = (items, item) => {
+  const index = items.findIndex((existing) => existing.id === item.id);
+  if (index === -1) return [...items, item];
+  const next = [...items];
+  next[index] = item;
+  return next;
+};
+
+// Subscribe to the backend's server-sent events for the logged-in user.
+// `handlers` maps event types (match_created, match_updated, profile_changed,
+// potential_matches_changed) to callbacks receiving the parsed event.
+//
+// EventSource cannot send headers, so each connection opens with a
+// short-lived ticket rather than the access token in the URL. A reconnect
+// after the ticket expired is refused and closes the source; a new ticket is
+// fetched then.
+export function useServerEvents(handlers) {
+  const handlersRef = useRef(handlers);
+  handlersRef.current = handlers;
+
+  useEffect(() => {
+    if (!localStorage.getItem("token") || typeof EventSource === "undefined") return;
+
+    let source = null;
+    let retry = null;
+    let stopped = false;
+
+    const reconnect = () => {
+      if (!stopped) retry = setTimeout(connect, RECONNECT_MS);
+    };
+
+    const connect = async () => {
+      let ticket;
+      try {
+        ticket = (await axios.post(`${API}/events/ticket`)).data.ticket;
+      } catch (error) {
+        reconnect();
+        return;
+      }
+      if (stopped) return;
+      if (source) source.close();
+      source = new EventSource(`${API}/events?ticket=${encodeURIComponent(ticket)}`);
+      EVENT_TYPES.forEach((type) => {
+        source.addEventListener(type, (message) => {
+          const handler = handlersRef.current[type];
+          if (handler) handler(JSON.parse(message.data));
+        });
+      });
+      const current = source;
+      source.onerror = () => {
+        if (current.readyState === EventSource.CLOSED) reconnect();
+      };
+    };
+
+    connect();
+
+    return () => {
+      stopped = true;
+      clearTimeout(retry);
+      if (source) source.close();
+    };
+  }, []);
+}
@@ -0,0 +1,18 @@
+import axios from "axios";
+
+// Largest page the list endpoints serve
+const PAGE_SIZE = 1000;
+
+// Every row of a keyset-paginated list endpoint (/donors, /recipients,
+// /matches), following X-Next-Cursor until the last page
+export async function fetchAllPages(url) {
+  const rows = [];
+  let cursor = null;
+  do {
+    const params = { limit: PAGE_SIZE, ...(cursor ? { cursor } : {}) };
+    const response = await axios.get(url, { params });
+    rows.push(...response.data);
+    cursor = response.headers["x-next-cursor"] || null;
+  } while (cursor);
+  return rows;
+}
@@ -9,6 +9,8 @@ import { Badge } from '@/components/ui/badge';
 import { Heart, LogOut, User, Activity, Users } from 'lucide-react';
 import { toast } from 'sonner';
 import { API } from '@/App';
+import { fetchAllPages } from '@/lib/pagination';
+import { upsertById, useServerEvents } from '@/hooks/use-server-events';
 
 const organs = ['Heart', 'Kidney', 'Liver', 'Lungs', 'Pancreas', 'Intestines'];
 const bloodTypes = ['O-', 'O+', 'A-', 'A+', 'B-', 'B+', 'AB-', 'AB+'];
@@ -31,6 +33,12 @@ const DonorDashboard = ({ user, onLogout }) => {
     fetchMatches();
   }, []);
 
+  useServerEvents({
+    potential_matches_changed: () => fetchPotentialMatches(),
+    match_created: ({ match }) => setMatches((prev) => upsertById(prev, match)),
+    match_updated: ({ match }) => setMatches((prev) => upsertById(prev, match))
+  });
+
   const fetchProfile = async () => {
     try {
       const response = await axios.get(`${API}/donors/me`);
@@ -59,8 +67,7 @@ const DonorDashboard = ({ user, onLogout }) => {
 
   const fetchMatches = async () => {
     try {
-      const response = await axios.get(`${API}/matches`);
-      setMatches(response.data);
+      setMatches(await fetchAllPages(`${API}/matches`));
     } catch (error) {
       console.error('Failed to fetch matches:', error);
     }
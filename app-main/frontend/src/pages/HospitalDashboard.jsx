@@ -10,6 +10,8 @@ import { Dialog, DialogContent, DialogDescription, DialogHeader, DialogTitle, Di
 import { Heart, LogOut, User, Users, Building2, Activity } from 'lucide-react';
 import { toast } from 'sonner';
 import { API } from '@/App';
+import { fetchAllPages } from '@/lib/pagination';
+import { upsertById, useServerEvents } from '@/hooks/use-server-events';
 
 const organs = ['heart', 'kidney', 'liver', 'lungs', 'pancreas', 'intestines'];
 
@@ -37,6 +39,16 @@ const HospitalDashboard = ({ user, onLogout }) => {
     fetchMatches();
   }, []);
 
+  // Keep the lists current from pushed events instead of refetching them
+  useServerEvents({
+    profile_changed: ({ kind, profile }) => {
+      if (kind === 'donor') setDonors((prev) => upsertById(prev, profile));
+      if (kind === 'recipient') setRecipients((prev) => upsertById(prev, profile));
+    },
+    match_created: ({ match }) => setMatches((prev) => upsertById(prev, match)),
+    match_updated: ({ match }) => setMatches((prev) => upsertById(prev, match))
+  });
+
   const fetchProfile = async () => {
     try {
       const response = await axios.get(`${API}/hospitals/me`);
@@ -55,8 +67,7 @@ const HospitalDashboard = ({ user, onLogout }) => {
 
   const fetchDonors = async () => {
     try {
-      const response = await axios.get(`${API}/donors`);
-      setDonors(response.data);
+      setDonors(await fetchAllPages(`${API}/donors`));
     } catch (error) {
       console.error('Failed to fetch donors:', error);
     }
@@ -64,8 +75,7 @@ const HospitalDashboard = ({ user, onLogout }) => {
 
   const fetchRecipients = async () => {
     try {
-      const response = await axios.get(`${API}/recipients`);
-      setRecipients(response.data);
+      setRecipients(await fetchAllPages(`${API}/recipients`));
     } catch (error) {
       console.error('Failed to fetch recipients:', error);
     }
@@ -73,8 +83,7 @@ const HospitalDashboard = ({ user, onLogout }) => {
 
   const fetchMatches = async () => {
     try {
-      const response = await axios.get(`${API}/matches`);
-      setMatches(response.data);
+      setMatches(await fetchAllPages(`${API}/matches`));
     } catch (error) {
       console.error('Failed to fetch matches:', error);
     }
@@ -102,16 +111,14 @@ const HospitalDashboard = ({ user, onLogout }) => {
 
   const createMatch = async () => {
     try {
-      await axios.post(`${API}/matches`, {
+      const response = await axios.post(`${API}/matches`, {
         donor_id: selectedDonor.id,
         recipient_id: selectedRecipient.id,
         organ_type: selectedOrgan
       });
       toast.success('Match created successfully!');
       setIsMatchDialogOpen(false);
-      fetchMatches();
-      fetchDonors();
-      fetchRecipients();
+      setMatches((prev) => upsertById(prev, response.data));
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Failed to create match');
     }
@@ -9,6 +9,8 @@ import { Badge } from '@/components/ui/badge';
 import { Heart, LogOut, User, Activity, Users } from 'lucide-react';
 import { toast } from 'sonner';
 import { API } from '@/App';
+import { fetchAllPages } from '@/lib/pagination';
+import { upsertById, useServerEvents } from '@/hooks/use-server-events';
 
 const organs = ['Heart', 'Kidney', 'Liver', 'Lungs', 'Pancreas', 'Intestines'];
 const bloodTypes = ['O-', 'O+', 'A-', 'A+', 'B-', 'B+', 'AB-', 'AB+'];
@@ -33,6 +35,12 @@ const RecipientDashboard = ({ user, onLogout }) => {
     fetchMatches();
   }, []);
 
+  useServerEvents({
+    potential_matches_changed: () => fetchPotentialMatches(),
+    match_created: ({ match }) => setMatches((prev) => upsertById(prev, match)),
+    match_updated: ({ match }) => setMatches((prev) => upsertById(prev, match))
+  });
+
   const fetchProfile = async () => {
     try {
       const response = await axios.get(`${API}/recipients/me`);
@@ -62,8 +70,7 @@ const RecipientDashboard = ({ user, onLogout }) => {
 
   const fetchMatches = async () => {
     try {
-      const response = await axios.get(`${API}/matches`);
-      setMatches(response.data);
+      setMatches(await fetchAllPages(`${API}/matches`));
     } catch (error) {
       console.error('Failed to fetch matches:', error);
     }
@@ -0,0 +1,45 @@
+"""Fixtures running the API in process on the in-memory storage backend"""
+import os
+import sys
+from pathlib import Path
+
+import httpx
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+os.environ.setdefault("JWT_SECRET", "test-secret")
+os.environ.setdefault("PASSWORD_POOL_WORKERS", "4")
+os.environ.setdefault("WARMUP", "off")
+os.environ.setdefault("ADMISSION", "off")
+os.environ.setdefault("STATS_FLUSH_SECONDS", "0.05")
+os.environ.setdefault("METRICS_TOKEN", "scrape-token")
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def server():
+    """The server module with its application's lifespan running over a new, empty database"""
+    import server
+
+    async with server.app.router.lifespan_context(server.app):
+        yield server
+
+
+@pytest.fixture
+async def api(server):
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test/api", timeout=60) as client:
+        yield client
+
+
+async def register(api, role: str, email: str) -> dict:
+    """Authorization headers of a newly registered user"""
+    response = await api.post("/auth/register", json={"email": email, "password": "secret", "name": email, "role": role})
+    assert response.status_code == 200, response.text
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
@@ -0,0 +1,51 @@
+import asyncio
+
+import httpx
+import pytest
+
+from admission import AdmissionMiddleware, AdmissionRule, MemoryAdmissionStore
+
+pytestmark = pytest.mark.anyio
+
+
+def identify(scope) -> tuple:
+    headers = dict(scope["headers"])
+    return "donor", headers.get(b"x-user", b"anonymous").decode()
+
+
+def client(rule: AdmissionRule, release: asyncio.Event = None) -> httpx.AsyncClient:
+    async def app(scope, receive, send):
+        if release is not None:
+            await release.wait()
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    limited = AdmissionMiddleware(app, rules=[rule], identify=identify, store=MemoryAdmissionStore())
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=limited), base_url="http://test")
+
+
+async def test_rate_limit_sheds_with_429():
+    async with client(AdmissionRule("GET /limited", rate=1, burst=2)) as api:
+        first, second, third = [await api.get("/limited", headers={"x-user": "a"}) for _ in range(3)]
+        assert [first.status_code, second.status_code] == [200, 200]
+        assert third.status_code == 429
+        assert float(third.headers["Retry-After"]) > 0
+
+        # Rates are per user, and other routes are not limited
+        assert (await api.get("/limited", headers={"x-user": "b"})).status_code == 200
+        assert (await api.get("/open", headers={"x-user": "a"})).status_code == 200
+
+
+async def test_concurrency_limit_sheds_with_503():
+    release = asyncio.Event()
+    async with client(AdmissionRule("GET /limited/{id}", concurrency=1), release) as api:
+        held = asyncio.create_task(api.get("/limited/1", headers={"x-user": "a"}))
+        await asyncio.sleep(0.05)
+
+        shed = await api.get("/limited/2", headers={"x-user": "b"})
+        assert shed.status_code == 503
+        assert "Retry-After" in shed.headers
+
+        release.set()
+        assert (await held).status_code == 200
+        assert (await api.get("/limited/3", headers={"x-user": "b"})).status_code == 200
@@ -0,0 +1,97 @@
+import itertools
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from allocation import Allocator, recipient_priority, solve_organ
+from compatibility import BLOOD_TYPES, CompatibilityIndex, compatibility_score, is_blood_compatible
+from tests.conftest import register
+
+pytestmark = pytest.mark.anyio
+
+NOW = datetime(2025, 1, 1, tzinfo=timezone.utc)
+URGENCY = ["low", "medium", "high", "critical"]
+
+
+def by_blood(profiles: list) -> dict:
+    return {blood: [p for p in profiles if p['blood_type'] == blood] for blood in BLOOD_TYPES}
+
+
+def pool(rng: random.Random, donors: int, recipients: int):
+    donor_list = [
+        {"id": f"d{i}", "blood_type": rng.choice(BLOOD_TYPES), "created_at": NOW - timedelta(days=rng.randint(0, 900))}
+        for i in range(donors)
+    ]
+    recipient_list = [
+        {"id": f"r{i}", "blood_type": rng.choice(BLOOD_TYPES), "urgency_level": rng.choice(URGENCY),
+         "created_at": NOW - timedelta(days=rng.randint(0, 3000))}
+        for i in range(recipients)
+    ]
+    return donor_list, recipient_list, by_blood(donor_list), by_blood(recipient_list)
+
+
+def weight(donor: dict, recipient: dict) -> float:
+    return recipient_priority(recipient, NOW) + compatibility_score(donor['blood_type'], recipient['blood_type'])
+
+
+def best_total(donors: list, recipients: list) -> float:
+    """Maximum total weight over every assignment, by brute force"""
+    best = 0.0
+    slots = recipients + [None] * len(donors)
+    for chosen in itertools.permutations(slots, len(donors)):
+        total = 0.0
+        for donor, recipient in zip(donors, chosen):
+            if recipient is None:
+                continue
+            if not is_blood_compatible(donor['blood_type'], recipient['blood_type']):
+                break
+            total += weight(donor, recipient)
+        else:
+            best = max(best, total)
+    return best
+
+
+@pytest.mark.parametrize("seed", range(12))
+def test_solution_is_optimal_on_small_pools(seed):
+    rng = random.Random(seed)
+    donors, recipients, donors_by_blood, recipients_by_blood = pool(rng, rng.randint(1, 4), rng.randint(1, 5))
+
+    assignments = solve_organ(donors_by_blood, recipients_by_blood, NOW)
+
+    profiles = {p['id']: p for p in donors + recipients}
+    assert len({a['donor_id'] for a in assignments}) == len(assignments)
+    assert len({a['recipient_id'] for a in assignments}) == len(assignments)
+    for a in assignments:
+        assert is_blood_compatible(profiles[a['donor_id']]['blood_type'], profiles[a['recipient_id']]['blood_type'])
+    total = sum(weight(profiles[a['donor_id']], profiles[a['recipient_id']]) for a in assignments)
+    assert total == pytest.approx(best_total(donors, recipients))
+
+
+def test_only_changed_organs_are_resolved():
+    index = CompatibilityIndex()
+    allocator = Allocator(index)
+    index.put_donor({"id": "d1", "user_id": "u1", "blood_type": "O-", "organs_available": ["kidney", "liver"], "status": "available", "created_at": NOW})
+    index.put_recipient({"id": "r1", "user_id": "u2", "blood_type": "A+", "organs_needed": ["kidney"], "urgency_level": "high", "status": "waiting", "created_at": NOW})
+    index.put_recipient({"id": "r2", "user_id": "u3", "blood_type": "B+", "organs_needed": ["liver"], "urgency_level": "low", "status": "waiting", "created_at": NOW})
+    assert allocator.solve(full=True)['resolved_organs'] == ["kidney", "liver"]
+
+    index.put_recipient({"id": "r3", "user_id": "u4", "blood_type": "O+", "organs_needed": ["liver"], "urgency_level": "critical", "status": "waiting", "created_at": NOW})
+    plan = allocator.solve()
+    assert plan['resolved_organs'] == ["liver"]
+    liver = next(p for p in plan['plans'] if p['organ_type'] == "liver")
+    assert [a['recipient_id'] for a in liver['assignments']] == ["r3"]
+
+
+async def test_allocation_plan_route(server, api):
+    hospital = await register(api, "hospital", "hospital@example.com")
+    donor = await register(api, "donor", "donor@example.com")
+    recipient = await register(api, "recipient", "recipient@example.com")
+    donor_id = (await api.post("/donors", headers=donor, json={"blood_type": "O-", "age": 30, "organs_available": ["kidney"]})).json()["id"]
+    recipient_id = (await api.post("/recipients", headers=recipient, json={
+        "blood_type": "AB+", "age": 60, "organs_needed": ["kidney"], "urgency_level": "critical"
+    })).json()["id"]
+
+    assert (await api.get("/allocations", headers=donor)).status_code == 403
+    plan = (await api.get("/allocations", headers=hospital, params={"full": "true"})).json()
+    assert [(a['donor_id'], a['recipient_id']) for p in plan['plans'] for a in p['assignments']] == [(donor_id, recipient_id)]
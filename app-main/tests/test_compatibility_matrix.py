@@ -0,0 +1,75 @@
+import random
+
+import pytest
+
+import compatibility
+from compatibility import BLOOD_TYPES, compatibility_matrix, compatibility_score, is_blood_compatible
+from tests.conftest import register
+
+pytestmark = pytest.mark.anyio
+
+ORGANS = ["kidney", "liver", "heart", "lungs", "pancreas"]
+
+
+def profiles(rng: random.Random, count: int, prefix: str, field: str) -> list:
+    return [
+        {"id": f"{prefix}{i}", "blood_type": rng.choice(BLOOD_TYPES), field: rng.sample(ORGANS, rng.randint(1, 3))}
+        for i in range(count)
+    ]
+
+
+def pairs(matrix: dict) -> dict:
+    """(donor id, recipient id) -> (shared organs, score) from the columnar result"""
+    columns = matrix["pairs"]
+    return {
+        (matrix["donor_ids"][d], matrix["recipient_ids"][r]): (
+            {organ for bit, organ in enumerate(matrix["organs"]) if mask >> bit & 1}, score
+        )
+        for d, r, mask, score in zip(columns["donor"], columns["recipient"], columns["organs"], columns["score"])
+    }
+
+
+def expected_pairs(donors: list, recipients: list) -> dict:
+    result = {}
+    for donor in donors:
+        for recipient in recipients:
+            shared = set(donor["organs_available"]) & set(recipient["organs_needed"])
+            if shared and is_blood_compatible(donor["blood_type"], recipient["blood_type"]):
+                result[(donor["id"], recipient["id"])] = (shared, compatibility_score(donor["blood_type"], recipient["blood_type"]))
+    return result
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("block_cells", [1, 7, compatibility.MATRIX_BLOCK_CELLS])
+def test_matrix_matches_pairwise_checks(monkeypatch, seed, block_cells):
+    monkeypatch.setattr(compatibility, "MATRIX_BLOCK_CELLS", block_cells)
+    rng = random.Random(seed)
+    donors = profiles(rng, rng.randint(1, 30), "d", "organs_available")
+    recipients = profiles(rng, rng.randint(1, 30), "r", "organs_needed")
+
+    matrix = compatibility_matrix(donors, recipients)
+    assert pairs(matrix) == expected_pairs(donors, recipients)
+    assert matrix["count"] == len(matrix["pairs"]["donor"])
+
+
+def test_empty_pools():
+    matrix = compatibility_matrix([], [])
+    assert (matrix["count"], matrix["organs"], matrix["pairs"]["donor"]) == (0, [], [])
+
+
+async def test_matrix_route_is_for_hospitals(server, api):
+    donor = await register(api, "donor", "donor@example.com")
+    await api.post("/donors", headers=donor, json={"blood_type": "O-", "age": 35, "organs_available": ["kidney", "liver"]})
+    recipient = await register(api, "recipient", "recipient@example.com")
+    await api.post("/recipients", headers=recipient, json={
+        "blood_type": "AB+", "age": 50, "organs_needed": ["liver"], "urgency_level": "high"
+    })
+    assert (await api.get("/matches/matrix", headers=donor)).status_code == 403
+
+    hospital = await register(api, "hospital", "hospital@example.com")
+    response = await api.get("/matches/matrix", headers=hospital)
+    assert response.status_code == 200
+    matrix = response.json()
+    assert matrix["count"] == 1
+    assert [organ for bit, organ in enumerate(matrix["organs"]) if matrix["pairs"]["organs"][0] >> bit & 1] == ["liver"]
+    assert matrix["pairs"]["score"] == [compatibility_score("O-", "AB+")]
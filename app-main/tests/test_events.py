@@ -0,0 +1,104 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import jwt
+import pytest
+
+from events import EventBus, OwnWrites
+from tests.conftest import register
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_bus_delivers_by_user_and_role_once():
+    bus = EventBus()
+    donor = bus.subscribe("donor-1", "donor")
+    hospital = bus.subscribe("hospital-1", "hospital")
+
+    bus.publish({"type": "a"}, user_ids=["donor-1", "hospital-1"], roles=["hospital"])
+    bus.publish({"type": "b"}, user_ids=["someone-else"])
+
+    assert [donor.get_nowait()["type"] for _ in range(donor.qsize())] == ["a"]
+    assert [hospital.get_nowait()["type"] for _ in range(hospital.qsize())] == ["a"]
+    assert bus.stats() == {"subscribers": 2, "published": 2, "dropped": 0}
+
+
+async def test_bus_drops_events_for_full_queues_and_forgets_unsubscribed():
+    bus = EventBus(queue_size=2)
+    queue = bus.subscribe("user-1", "donor")
+    for index in range(5):
+        bus.publish({"type": str(index)}, user_ids=["user-1"])
+    assert queue.qsize() == 2
+    assert bus.stats()["dropped"] == 3
+
+    bus.unsubscribe("user-1", "donor", queue)
+    bus.publish({"type": "late"}, user_ids=["user-1"], roles=["donor"])
+    assert queue.qsize() == 2
+    assert bus.stats()["subscribers"] == 0
+
+
+def test_own_writes_pop_oldest_first_and_stay_bounded():
+    writes = OwnWrites(maxsize=3)
+    writes.record("a", {"v": 1})
+    writes.record("a", {"v": 2})
+    assert writes.pop("a") == (True, {"v": 1})
+    assert writes.pop("a") == (True, {"v": 2})
+    assert writes.pop("a") == (False, None)
+
+    for key in "bcde":
+        writes.record(key, None)
+    assert writes.pop("b") == (False, None)
+    assert writes.pop("e") == (True, None)
+
+
+async def open_stream(app, query: str) -> tuple:
+    """Run GET /api/events until its first body chunk; returns (start message, first chunk, later chunks, task)"""
+    messages, chunks = [], asyncio.Queue()
+
+    async def receive():
+        await asyncio.Event().wait()
+
+    async def send(message):
+        messages.append(message)
+        if message["type"] == "http.response.body" and message.get("body"):
+            chunks.put_nowait(message["body"].decode())
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": "/api/events", "raw_path": b"/api/events", "root_path": "", "query_string": query.encode(),
+        "headers": [], "server": ("test", 80), "client": ("127.0.0.1", 1),
+    }
+    task = asyncio.create_task(app(scope, receive, send))
+    first = await asyncio.wait_for(chunks.get(), 5)
+    return messages[0], first, chunks, task
+
+
+async def test_stream_opens_with_a_ticket_and_delivers_events(server, api):
+    donor = await register(api, "donor", "donor@example.com")
+    ticket = (await api.post("/events/ticket", headers=donor)).json()["ticket"]
+    user_id = (await api.get("/auth/me", headers=donor)).json()["id"]
+
+    start, first, chunks, task = await open_stream(server.app, f"ticket={ticket}")
+    try:
+        assert start["status"] == 200
+        assert first == "retry: 5000\n\n"
+        server.event_bus.publish({"type": "profile_changed", "profile": {"id": "p"}}, user_ids=[user_id])
+        assert (await asyncio.wait_for(chunks.get(), 5)).startswith("event: profile_changed\ndata: ")
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+async def test_stream_rejects_access_tokens_and_expired_tickets(server, api):
+    donor = await register(api, "donor", "donor@example.com")
+    access_token = donor["Authorization"].removeprefix("Bearer ")
+    assert (await api.get("/events", params={"ticket": access_token})).status_code == 401
+
+    ticket = (await api.post("/events/ticket", headers=donor)).json()["ticket"]
+    # Tickets only open the stream; they are no access token
+    assert (await api.get("/auth/me", headers={"Authorization": f"Bearer {ticket}"})).status_code == 401
+
+    payload = jwt.decode(ticket, server.JWT_SECRET, algorithms=[server.JWT_ALGORITHM])
+    expired = jwt.encode({**payload, "exp": datetime.now(timezone.utc) - timedelta(seconds=1)}, server.JWT_SECRET, algorithm=server.JWT_ALGORITHM)
+    response = await api.get("/events", params={"ticket": expired})
+    assert (response.status_code, response.json()["detail"]) == (401, "Token has expired")
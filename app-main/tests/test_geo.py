@@ -0,0 +1,102 @@
+import pytest
+
+from geo import TransportLimits, haversine_km
+from tests.conftest import register
+
+pytestmark = pytest.mark.anyio
+
+# Hospitals on the equator about 0, 100 and 1000 km east of the first
+HOSPITALS = {"near": 0.0, "close": 0.9, "far": 9.0}
+
+
+def test_haversine_distance():
+    london, paris = [-0.1278, 51.5074], [2.3522, 48.8566]
+    assert haversine_km(london, paris) == pytest.approx(344, abs=2)
+    assert haversine_km(london, london) == 0
+
+
+def test_radius_combines_distance_and_travel_time():
+    limits = TransportLimits(speed_kmh=100, ischemia_hours={"heart": 4, "kidney": 36})
+    assert limits.radius_km() is None
+    assert limits.radius_km(max_km=250, max_hours=2) == 200
+    assert limits.radii_km(["heart", "kidney"], max_km=1000) == {"heart": 1000, "kidney": 1000}
+    assert limits.radii_km(["heart", "kidney"], max_km=1000, ischemia=True) == {"heart": 400, "kidney": 1000}
+    assert limits.radii_km(["heart"], ischemia=True) == {"heart": 400}
+    assert limits.radii_km(["heart"]) is None
+
+
+async def hospital(api, name: str, longitude: float) -> str:
+    headers = await register(api, "hospital", f"{name}@example.com")
+    response = await api.post("/hospitals", headers=headers, json={
+        "hospital_name": name, "location": name, "contact_number": "1", "latitude": 0.0, "longitude": longitude
+    })
+    return response.json()["id"]
+
+
+async def registry(api) -> dict:
+    """A recipient at the near hospital; donors at the close and far hospitals"""
+    hospitals = {name: await hospital(api, name, longitude) for name, longitude in HOSPITALS.items()}
+    recipient = await register(api, "recipient", "recipient@example.com")
+    await api.post("/recipients", headers=recipient, json={
+        "blood_type": "AB+", "age": 50, "organs_needed": ["heart", "kidney"], "urgency_level": "high",
+        "hospital_id": hospitals["near"]
+    })
+    donors = {}
+    for name, organs in (("close", ["kidney"]), ("far", ["heart", "kidney"])):
+        headers = await register(api, "donor", f"{name}-donor@example.com")
+        donors[name] = (await api.post("/donors", headers=headers, json={
+            "blood_type": "O-", "age": 40, "organs_available": organs, "hospital_id": hospitals[name]
+        })).json()["id"]
+    return {"recipient": recipient, "donors": donors, "hospitals": hospitals}
+
+
+async def candidate_ids(api, headers: dict, **params) -> list:
+    response = await api.get("/matches/potential", headers=headers, params=params)
+    assert response.status_code == 200, response.text
+    return sorted(candidate["id"] for candidate in response.json())
+
+
+async def test_potential_matches_within_a_distance(server, api):
+    seeded = await registry(api)
+    donors, recipient = seeded["donors"], seeded["recipient"]
+
+    assert await candidate_ids(api, recipient) == sorted(donors.values())
+    assert await candidate_ids(api, recipient, max_km=500) == [donors["close"]]
+    # 3 hours at the default 500 km/h
+    assert await candidate_ids(api, recipient, max_hours=3) == sorted(donors.values())
+    assert await candidate_ids(api, recipient, max_hours=0.5) == [donors["close"]]
+
+
+async def test_ischemia_limits_each_organ(server, api, monkeypatch):
+    seeded = await registry(api)
+    monkeypatch.setattr(server, "transport_limits", TransportLimits(speed_kmh=100, ischemia_hours={"heart": 4, "kidney": 36}))
+
+    response = await api.get("/matches/potential", headers=seeded["recipient"], params={"ischemia": "true"})
+    organs = {candidate["id"]: candidate["matching_organs"] for candidate in response.json()}
+    # The heart can travel 400 km, the kidney 3600 km
+    assert organs == {seeded["donors"]["close"]: ["kidney"], seeded["donors"]["far"]: ["kidney"]}
+
+
+async def test_profile_lists_within_a_distance(server, api):
+    seeded = await registry(api)
+    response = await api.get("/donors", headers=seeded["recipient"], params={"max_km": 500})
+    assert [donor["id"] for donor in response.json()] == [seeded["donors"]["close"]]
+
+
+async def test_distance_filters_need_coordinates(server, api):
+    recipient = await register(api, "recipient", "recipient@example.com")
+    await api.post("/recipients", headers=recipient, json={
+        "blood_type": "AB+", "age": 50, "organs_needed": ["kidney"], "urgency_level": "high"
+    })
+    response = await api.get("/matches/potential", headers=recipient, params={"max_km": 100})
+    assert (response.status_code, response.json()["detail"]) == (400, "Distance filters need a profile with hospital coordinates")
+
+
+async def test_moving_a_hospital_moves_its_profiles(server, api):
+    seeded = await registry(api)
+    far = await api.post("/auth/login", json={"email": "far@example.com", "password": "secret"})
+    headers = {"Authorization": f"Bearer {far.json()['access_token']}"}
+    await api.put("/hospitals/me", headers=headers, json={
+        "hospital_name": "far", "location": "far", "contact_number": "1", "latitude": 0.0, "longitude": 0.5
+    })
+    assert await candidate_ids(api, seeded["recipient"], max_km=500) == sorted(seeded["donors"].values())
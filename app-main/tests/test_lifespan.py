@@ -0,0 +1,71 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+
+
+def test_import_connects_to_nothing():
+    # Without MONGO_URL, building the Motor client at import would fail
+    env = {key: value for key, value in os.environ.items() if key != "MONGO_URL"}
+    env["STORAGE_BACKEND"] = "mongo"
+    script = "import server; assert server.client is None and server.db is None and server.match_index is None"
+    result = subprocess.run([sys.executable, "-c", script], cwd=BACKEND_DIR, env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+
+async def test_each_lifespan_builds_and_closes_its_services():
+    import server
+
+    app = server.create_app()
+    async with app.router.lifespan_context(app):
+        first = (server.db, server.match_index, server.password_hasher)
+        await server.db.users.insert_one({"id": "user-1"})
+        assert server.profile_fanout.stats()["running"]
+    assert server.password_hasher._executor is None
+
+    async with app.router.lifespan_context(app):
+        assert all(new is not old for new, old in zip((server.db, server.match_index, server.password_hasher), first))
+        assert await server.db.users.count_documents({}) == 0
+
+
+async def test_warm_up_opens_connections_and_hashing_workers(monkeypatch):
+    import server
+
+    opened = []
+
+    async def warm_up(db, connections):
+        opened.append(connections)
+
+    monkeypatch.setenv("WARMUP", "on")
+    monkeypatch.setenv("MONGO_WARMUP_CONNECTIONS", "3")
+    monkeypatch.setattr(server.storage, "warm_up", warm_up)
+    app = server.create_app()
+    async with app.router.lifespan_context(app):
+        assert opened == [3]
+        assert server.password_hasher._executor is not None
+
+
+async def test_failed_startup_closes_what_it_built(monkeypatch):
+    import server
+
+    async def warm_up(db, connections):
+        pass
+
+    async def load(index_sync):
+        raise RuntimeError("index load failed")
+
+    monkeypatch.setenv("WARMUP", "on")
+    monkeypatch.setattr(server.storage, "warm_up", warm_up)
+    monkeypatch.setattr(server.IndexSync, "load", load)
+    app = server.create_app()
+    with pytest.raises(RuntimeError, match="index load failed"):
+        async with app.router.lifespan_context(app):
+            pass
+    # The hashing workers started by the warm-up are shut down again
+    assert server.password_hasher._executor is None
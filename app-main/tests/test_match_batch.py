@@ -0,0 +1,62 @@
+import pytest
+from pymongo.errors import BulkWriteError
+
+from tests.conftest import register
+
+pytestmark = pytest.mark.anyio
+
+
+async def seed(api) -> tuple:
+    """Hospital headers, two donors and two recipients"""
+    hospital = await register(api, "hospital", "hospital@example.com")
+    donors, recipients = [], []
+    for index, (blood_type, organs) in enumerate([("O-", ["kidney", "liver"]), ("AB+", ["heart"])]):
+        headers = await register(api, "donor", f"donor{index}@example.com")
+        donors.append((await api.post("/donors", headers=headers, json={"blood_type": blood_type, "age": 40, "organs_available": organs})).json()["id"])
+    for index, (blood_type, organs) in enumerate([("A+", ["kidney", "liver"]), ("O+", ["heart"])]):
+        headers = await register(api, "recipient", f"recipient{index}@example.com")
+        recipients.append((await api.post("/recipients", headers=headers, json={
+            "blood_type": blood_type, "age": 50, "organs_needed": organs, "urgency_level": "high"
+        })).json()["id"])
+    return hospital, donors, recipients
+
+
+async def test_each_item_succeeds_or_fails_on_its_own(server, api):
+    hospital, (o_neg, ab_pos), (a_pos, o_pos) = await seed(api)
+    response = await api.post("/matches/batch", headers=hospital, json={"matches": [
+        {"donor_id": o_neg, "recipient_id": a_pos, "organ_type": "kidney"},
+        {"donor_id": "missing", "recipient_id": a_pos, "organ_type": "kidney"},
+        {"donor_id": ab_pos, "recipient_id": o_pos, "organ_type": "heart"},
+        {"donor_id": o_neg, "recipient_id": a_pos, "organ_type": "heart"},
+        {"donor_id": o_neg, "recipient_id": a_pos, "organ_type": "liver"},
+    ]})
+    assert response.status_code == 200
+    result = response.json()
+
+    assert [(match["donor_id"], match["organ_type"]) for match in result["created"]] == [(o_neg, "kidney"), (o_neg, "liver")]
+    assert [(error["index"], error["status_code"]) for error in result["errors"]] == [(1, 404), (2, 400), (3, 400)]
+    stored = await server.db.matches.find({}, {"_id": 0}).to_list(None)
+    assert sorted(match["id"] for match in stored) == sorted(match["id"] for match in result["created"])
+
+
+async def test_batch_is_for_hospitals(server, api):
+    donor = await register(api, "donor", "donor@example.com")
+    response = await api.post("/matches/batch", headers=donor, json={"matches": [
+        {"donor_id": "d", "recipient_id": "r", "organ_type": "kidney"}
+    ]})
+    assert response.status_code == 403
+
+
+async def test_failed_inserts_are_reported(server, api, monkeypatch):
+    hospital, (o_neg, _), (a_pos, _) = await seed(api)
+
+    async def bulk_write(collection, requests, ordered=True):
+        raise BulkWriteError({"writeErrors": [{"index": 0, "errmsg": "disk full"}]})
+
+    # On the class: Motor hands out a new collection object on every attribute access
+    monkeypatch.setattr(type(server.db.matches), "bulk_write", bulk_write)
+    response = await api.post("/matches/batch", headers=hospital, json={"matches": [
+        {"donor_id": o_neg, "recipient_id": a_pos, "organ_type": "kidney"}
+    ]})
+    result = response.json()
+    assert (result["created"], result["errors"]) == ([], [{"index": 0, "status_code": 500, "detail": "disk full"}])
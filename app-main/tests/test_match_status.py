@@ -0,0 +1,172 @@
+import asyncio
+
+import pytest
+from pymongo.errors import BulkWriteError
+
+from tests.conftest import register
+
+pytestmark = pytest.mark.anyio
+
+
+async def create_match(api) -> tuple:
+    """Hospital headers and a pending match between a new donor and recipient"""
+    hospital = await register(api, "hospital", "hospital@example.com")
+    donor = await register(api, "donor", "donor@example.com")
+    recipient = await register(api, "recipient", "recipient@example.com")
+    donor_id = (await api.post("/donors", headers=donor, json={"blood_type": "O-", "age": 35, "organs_available": ["kidney"]})).json()["id"]
+    recipient_id = (await api.post("/recipients", headers=recipient, json={
+        "blood_type": "A+", "age": 50, "organs_needed": ["kidney"], "urgency_level": "high"
+    })).json()["id"]
+    response = await api.post("/matches", headers=hospital, json={"donor_id": donor_id, "recipient_id": recipient_id, "organ_type": "kidney"})
+    assert response.status_code == 200, response.text
+    return hospital, response.json()
+
+
+async def test_transitions_follow_the_state_machine(server, api):
+    hospital, match = await create_match(api)
+
+    accepted = await api.put(f"/matches/{match['id']}/status", headers=hospital, json={"status": "accepted"})
+    assert accepted.status_code == 200
+    assert accepted.json()["status"] == "accepted"
+
+    completed = await api.put(f"/matches/{match['id']}/status", headers=hospital, json={"status": "completed"})
+    assert completed.status_code == 200
+
+    reopened = await api.put(f"/matches/{match['id']}/status", headers=hospital, json={"status": "pending"})
+    assert reopened.status_code == 409
+    assert reopened.json()["detail"] == "Cannot change match status from completed to pending"
+
+
+async def test_pending_match_cannot_complete(server, api):
+    hospital, match = await create_match(api)
+    response = await api.put(f"/matches/{match['id']}/status", headers=hospital, json={"status": "completed"})
+    assert response.status_code == 409
+    assert response.json()["detail"] == "Cannot change match status from pending to completed"
+
+
+async def test_stale_version_conflicts(server, api):
+    hospital, match = await create_match(api)
+    response = await api.put(f"/matches/{match['id']}/status", headers=hospital, json={"status": "accepted", "version": match["version"]})
+    assert response.status_code == 200
+
+    stale = await api.put(f"/matches/{match['id']}/status", headers=hospital, json={"status": "rejected", "version": match["version"]})
+    assert stale.status_code == 409
+    current = await server.db.matches.find_one({"id": match["id"]})
+    assert current["status"] == "accepted"
+
+
+async def test_unavailable_donor_cannot_be_matched_again(server, api):
+    hospital, match = await create_match(api)
+    await api.put(f"/matches/{match['id']}/status", headers=hospital, json={"status": "accepted"})
+
+    other = await register(api, "recipient", "other@example.com")
+    other_id = (await api.post("/recipients", headers=other, json={
+        "blood_type": "O-", "age": 40, "organs_needed": ["kidney"], "urgency_level": "low"
+    })).json()["id"]
+    response = await api.post("/matches", headers=hospital, json={"donor_id": match["donor_id"], "recipient_id": other_id, "organ_type": "kidney"})
+    assert response.status_code == 409
+
+
+async def profiles(api, email_prefix: str, donor_organs: list, recipients: int) -> tuple:
+    """A donor offering donor_organs and the ids of recipients who each need all of them"""
+    donor = await register(api, "donor", f"{email_prefix}-donor@example.com")
+    donor_id = (await api.post("/donors", headers=donor, json={"blood_type": "O-", "age": 35, "organs_available": donor_organs})).json()["id"]
+    recipient_ids = []
+    for index in range(recipients):
+        recipient = await register(api, "recipient", f"{email_prefix}-recipient{index}@example.com")
+        recipient_ids.append((await api.post("/recipients", headers=recipient, json={
+            "blood_type": "B+", "age": 50, "organs_needed": donor_organs, "urgency_level": "high"
+        })).json()["id"])
+    return donor_id, recipient_ids
+
+
+async def test_organs_are_consumed_one_match_at_a_time(server, api):
+    hospital = await register(api, "hospital", "hospital@example.com")
+    donor_id, (recipient_id,) = await profiles(api, "multi", ["kidney", "liver"], 1)
+    match = (await api.post("/matches", headers=hospital, json={"donor_id": donor_id, "recipient_id": recipient_id, "organ_type": "kidney"})).json()
+
+    donor = await server.db.donor_profiles.find_one({"id": donor_id})
+    assert (donor["organs_available"], donor["organs_offered"], donor["status"]) == (["liver"], ["kidney"], "available")
+
+    await api.put(f"/matches/{match['id']}/status", headers=hospital, json={"status": "accepted"})
+    donor = await server.db.donor_profiles.find_one({"id": donor_id})
+    assert (donor["organs_available"], donor["organs_allocated"], donor["status"]) == (["liver"], ["kidney"], "available")
+
+    # The liver is still in the pool, and the same pair can be matched for it
+    liver = await api.post("/matches", headers=hospital, json={"donor_id": donor_id, "recipient_id": recipient_id, "organ_type": "liver"})
+    assert liver.status_code == 200, liver.text
+    await api.put(f"/matches/{liver.json()['id']}/status", headers=hospital, json={"status": "accepted"})
+    donor = await server.db.donor_profiles.find_one({"id": donor_id})
+    recipient = await server.db.recipient_profiles.find_one({"id": recipient_id})
+    assert (donor["organs_allocated"], donor["status"]) == (["kidney", "liver"], "matched")
+    assert (recipient["organs_allocated"], recipient["status"]) == (["kidney", "liver"], "matched")
+
+    await api.put(f"/matches/{match['id']}/status", headers=hospital, json={"status": "completed"})
+    donor = await server.db.donor_profiles.find_one({"id": donor_id})
+    assert (donor["organs_donated"], donor["status"]) == (["kidney"], "matched")
+
+
+async def test_rejecting_returns_the_organ_to_the_pool(server, api):
+    hospital, match = await create_match(api)
+    response = await api.put(f"/matches/{match['id']}/status", headers=hospital, json={"status": "rejected"})
+    assert response.status_code == 200
+
+    donor = await server.db.donor_profiles.find_one({"id": match["donor_id"]})
+    assert (donor["organs_available"], donor["organs_offered"], donor["status"]) == (["kidney"], [], "available")
+
+
+async def test_concurrent_matches_for_one_organ_create_one(server, api):
+    hospital = await register(api, "hospital", "hospital@example.com")
+    donor_id, recipient_ids = await profiles(api, "race", ["heart"], 5)
+    responses = await asyncio.gather(*(
+        api.post("/matches", headers=hospital, json={"donor_id": donor_id, "recipient_id": recipient_id, "organ_type": "heart"})
+        for recipient_id in recipient_ids
+    ))
+
+    assert sorted(response.status_code for response in responses) == [200, 409, 409, 409, 409]
+    assert await server.db.matches.count_documents({"donor_id": donor_id}) == 1
+    donor = await server.db.donor_profiles.find_one({"id": donor_id})
+    assert (donor["organs_available"], donor["organs_offered"]) == ([], ["heart"])
+
+
+async def test_batch_items_competing_for_an_organ(server, api):
+    hospital = await register(api, "hospital", "hospital@example.com")
+    donor_id, recipient_ids = await profiles(api, "batch", ["lungs"], 2)
+    response = await api.post("/matches/batch", headers=hospital, json={"matches": [
+        {"donor_id": donor_id, "recipient_id": recipient_id, "organ_type": "lungs"} for recipient_id in recipient_ids
+    ]})
+
+    result = response.json()
+    assert len(result["created"]) == 1
+    assert [(error["index"], error["status_code"]) for error in result["errors"]] == [(1, 409)]
+
+
+async def test_profile_edit_keeps_matched_organs_out_of_the_pool(server, api):
+    hospital, match = await create_match(api)
+    donor = await server.db.donor_profiles.find_one({"id": match["donor_id"]})
+    token = (await api.post("/auth/login", json={"email": "donor@example.com", "password": "secret"})).json()["access_token"]
+    response = await api.put("/donors/me", headers={"Authorization": f"Bearer {token}"}, json={
+        "blood_type": donor["blood_type"], "age": 36, "organs_available": ["kidney", "pancreas"]
+    })
+    assert response.status_code == 200, response.text
+    assert (response.json()["organs_available"], response.json()["organs_offered"]) == (["pancreas"], ["kidney"])
+
+
+async def test_failed_batch_insert_releases_its_organs(server, api, monkeypatch):
+    hospital = await register(api, "hospital", "hospital@example.com")
+    donor_id, (recipient_id,) = await profiles(api, "failed", ["kidney"], 1)
+
+    async def bulk_write(collection, requests, ordered=True):
+        raise BulkWriteError({"writeErrors": [{"index": 0, "errmsg": "disk full"}]})
+
+    # On the class: Motor hands out a new collection object on every attribute access
+    monkeypatch.setattr(type(server.db.matches), "bulk_write", bulk_write)
+    response = await api.post("/matches/batch", headers=hospital, json={"matches": [
+        {"donor_id": donor_id, "recipient_id": recipient_id, "organ_type": "kidney"}
+    ]})
+    assert response.json()["errors"][0]["status_code"] == 500
+
+    donor = await server.db.donor_profiles.find_one({"id": donor_id})
+    recipient = await server.db.recipient_profiles.find_one({"id": recipient_id})
+    assert (donor["organs_available"], donor["organs_offered"], donor["status"]) == (["kidney"], [], "available")
+    assert (recipient["organs_needed"], recipient["organs_offered"]) == (["kidney"], [])
@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+BLOOD_TYPES = ["O-", "O+", "A-", "A+", "B-", "B+", "AB-", "AB+"]
+ORGANS = ["kidney", "liver", "heart"]
+URGENCY = ["critical", "high", "medium", "low"]
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def donor(i: int) -> dict:
+    return {
+        "id": f"donor-{i:03d}", "user_id": f"donor-user-{i:03d}", "blood_type": BLOOD_TYPES[i % 8],
+        "age": 20 + i % 50, "organs_available": [ORGANS[i % 3], ORGANS[(i + 1) % 3]],
+        "status": "available", "created_at": START + timedelta(hours=i * 7 % 97)
+    }
+
+
+def recipient(i: int) -> dict:
+    return {
+        "id": f"recipient-{i:03d}", "user_id": f"recipient-user-{i:03d}", "blood_type": BLOOD_TYPES[i * 3 % 8],
+        "age": 20 + i % 50, "organs_needed": [ORGANS[i % 3]], "urgency_level": URGENCY[i % 4],
+        "status": "waiting", "created_at": START + timedelta(hours=i * 5 % 89)
+    }
+
+
+async def seed(server, donors: int = 60, recipients: int = 60):
+    await server.db.donor_profiles.insert_many([donor(i) for i in range(donors)])
+    await server.db.recipient_profiles.insert_many([recipient(i) for i in range(recipients)])
+    await server.index_sync.load()
+
+
+async def candidates(server, monkeypatch, source: str, kind: str, profile: dict, limit=None) -> list:
+    monkeypatch.setattr(server, "POTENTIAL_MATCH_SOURCE", source)
+    return [candidate["id"] for candidate in await server.find_candidates(kind, profile, limit=limit)]
+
+
+async def test_index_matches_query(server, monkeypatch):
+    await seed(server)
+    for i in range(0, 60, 7):
+        for kind, profile in (("recipient", donor(i)), ("donor", recipient(i))):
+            indexed = await candidates(server, monkeypatch, "index", kind, profile)
+            queried = await candidates(server, monkeypatch, "query", kind, profile)
+            assert indexed == queried
+            assert await candidates(server, monkeypatch, "index", kind, profile, limit=3) == queried[:3]
+
+
+async def test_foreign_write_falls_back_to_query(server, monkeypatch):
+    await seed(server, recipients=0)
+    profile = donor(0)
+    assert await candidates(server, monkeypatch, "index", "recipient", profile) == []
+
+    # Written by another process: not in this index, only announced through the version counter
+    newcomer = {**recipient(0), "id": "recipient-foreign", "blood_type": "O-", "organs_needed": ["kidney"]}
+    await server.db.recipient_profiles.insert_one(dict(newcomer))
+    await server.bump_versions(server.db, "recipient_profiles")
+
+    assert not await server.index_sync.fresh()
+    assert "recipient-foreign" in await candidates(server, monkeypatch, "index", "recipient", profile)
+    await server.index_sync.current()
+    assert server.match_index.get_recipient("recipient-foreign") is not None
+    assert await server.index_sync.fresh()
+
+
+async def test_index_follows_profile_updates(server):
+    await seed(server, donors=0, recipients=0)
+    kidney_recipient = {**recipient(0), "blood_type": "O-", "organs_needed": ["kidney"]}
+    assert [candidate["id"] for candidate in server.match_index.donors_for(kidney_recipient)] == []
+
+    server.match_index.put_donor({**donor(0), "blood_type": "O-", "organs_available": ["kidney"]})
+    assert [candidate["id"] for candidate in server.match_index.donors_for(kidney_recipient)] == ["donor-000"]
+
+    server.match_index.put_donor({**donor(0), "blood_type": "O-", "organs_available": ["kidney"], "status": "donated"})
+    assert server.match_index.donors_for(kidney_recipient) == []
+
+
+async def test_index_orders_donors_with_string_dates(server, monkeypatch):
+    late, early = donor(1), donor(2)
+    late["created_at"] = datetime(2024, 3, 1, tzinfo=timezone.utc)
+    early["created_at"] = "2024-02-01T00:00:00Z"
+    late["blood_type"] = early["blood_type"] = "O-"
+    late["organs_available"] = early["organs_available"] = ["kidney"]
+    server.match_index.put_donor(late)
+    server.match_index.put_donor(early)
+
+    found = await candidates(server, monkeypatch, "index", "donor", {**recipient(0), "blood_type": "O-", "organs_needed": ["kidney"]})
+    assert found == [early["id"], late["id"]]
@@ -0,0 +1,88 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from pymongo.errors import AutoReconnect
+
+import storage
+from compatibility import CompatibilityIndex
+from materialize import PotentialMatchStore
+from waitlist import WaitlistQueues, indexed_candidates
+
+pytestmark = pytest.mark.anyio
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def donor(i: int, **fields) -> dict:
+    return {"id": f"donor-{i}", "user_id": f"donor-user-{i}", "blood_type": "O-", "age": 40, "organs_available": ["kidney"],
+            "status": "available", "created_at": START + timedelta(hours=i), **fields}
+
+
+def recipient(i: int, **fields) -> dict:
+    return {"id": f"recipient-{i}", "user_id": f"recipient-user-{i}", "blood_type": "A+", "age": 50, "organs_needed": ["kidney"],
+            "urgency_level": "high", "status": "waiting", "created_at": START + timedelta(hours=i), **fields}
+
+
+async def until(condition, timeout: float = 2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+@pytest.fixture
+async def store():
+    _, db = storage.connect("memory")
+    await db.donor_profiles.insert_many([donor(i) for i in range(3)])
+    await db.recipient_profiles.insert_many([recipient(i) for i in range(4)])
+    index = CompatibilityIndex()
+    await index.load(db)
+    store = PotentialMatchStore(db, index, WaitlistQueues(index), capacity=3, rebuild_retry_seconds=0.01)
+    yield store
+    await store.stop()
+
+
+async def test_rebuild_stores_the_indexed_candidates(store):
+    store.start()
+    await until(lambda: not store.rebuilding)
+
+    assert await store.read("recipient", "recipient-user-0") == indexed_candidates(store.index, store.waitlist, "donor", recipient(0))
+    # Capped at three of the four recipients: only requests for up to three are answered
+    top = indexed_candidates(store.index, store.waitlist, "recipient", donor(0), 3)
+    assert await store.read("donor", "donor-user-0", limit=3) == top
+    assert await store.read("donor", "donor-user-0", limit=2) == top[:2]
+    assert await store.read("donor", "donor-user-0") is None
+
+
+async def test_written_profiles_are_computed_live_until_rewritten(store):
+    store.start()
+    await until(lambda: not store.rebuilding)
+
+    moved = donor(0, organs_available=["liver"])
+    store.index.put_donor(moved)
+    store.profile_changed("donor", moved, [store.index.get_recipient(f"recipient-{i}") for i in range(4)])
+    assert await store.read("donor", "donor-user-0") is None
+    assert await store.read("recipient", "recipient-user-1") is None
+
+    await until(lambda: not store.pending and not store._inflight)
+    assert await store.read("donor", "donor-user-0") == []
+    assert [candidate["id"] for candidate in await store.read("recipient", "recipient-user-1")] == ["donor-1", "donor-2"]
+
+
+async def test_failed_startup_rebuild_is_retried(store):
+    rebuild, attempts = store.rebuild, []
+
+    async def flaky_rebuild():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise AutoReconnect("connection lost")
+        return await rebuild()
+
+    store.rebuild = flaky_rebuild
+    store.start()
+    assert store.rebuilding
+    await until(lambda: not store.rebuilding)
+
+    assert len(attempts) == 2
+    assert await store.read("recipient", "recipient-user-1") is not None
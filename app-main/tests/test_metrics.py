@@ -0,0 +1,41 @@
+import httpx
+import pytest
+
+from tests.conftest import register
+
+pytestmark = pytest.mark.anyio
+
+JSON_METRICS = ["passwords", "principals", "responses", "potential-matches", "stats", "events"]
+
+
+async def scrape(server, headers=None) -> httpx.Response:
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await client.get("/metrics", headers=headers)
+
+
+async def test_prometheus_metrics_need_the_scrape_token(server, api):
+    assert (await scrape(server)).status_code == 401
+    assert (await scrape(server, {"Authorization": "Bearer wrong"})).status_code == 401
+
+    response = await scrape(server, {"Authorization": f"Bearer {server.METRICS_TOKEN}"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "# TYPE" in response.text
+
+
+async def test_prometheus_metrics_are_not_under_the_api(server, api):
+    hospital = await register(api, "hospital", "hospital@example.com")
+    assert (await api.get("/metrics", headers=hospital)).status_code == 404
+
+
+@pytest.mark.parametrize("name", JSON_METRICS)
+async def test_json_metrics_are_for_hospitals(server, api, name):
+    assert (await api.get(f"/metrics/{name}")).status_code == 403
+    donor = await register(api, "donor", "donor@example.com")
+    assert (await api.get(f"/metrics/{name}", headers=donor)).status_code == 403
+
+    hospital = await register(api, "hospital", "hospital@example.com")
+    response = await api.get(f"/metrics/{name}", headers=hospital)
+    assert response.status_code == 200
+    assert isinstance(response.json(), dict)
@@ -0,0 +1,94 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from tests.conftest import register
+from pagination import DEFAULT_PAGE_SIZE
+
+pytestmark = pytest.mark.anyio
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+async def seed_donors(server, count: int):
+    # Pairs share a created_at, so pages must break ties by id
+    await server.db.donor_profiles.insert_many([
+        {
+            "id": f"donor-{i:04d}", "user_id": f"user-{i:04d}", "blood_type": "O-", "age": 40,
+            "organs_available": ["kidney"], "status": "available", "created_at": START + timedelta(minutes=i // 2)
+        }
+        for i in range(count)
+    ])
+
+
+async def test_keyset_pages_cover_every_donor_once(server, api):
+    await seed_donors(server, 25)
+    headers = await register(api, "hospital", "hospital@example.com")
+
+    seen, cursor = [], None
+    while True:
+        params = {"limit": 7, **({"cursor": cursor} if cursor else {})}
+        response = await api.get("/donors", headers=headers, params=params)
+        assert response.status_code == 200
+        page = response.json()
+        assert len(page) <= 7
+        seen += [donor["id"] for donor in page]
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+
+    assert seen == [f"donor-{i:04d}" for i in range(25)]
+
+
+async def test_default_page_size(server, api):
+    await seed_donors(server, DEFAULT_PAGE_SIZE + 1)
+    headers = await register(api, "hospital", "hospital@example.com")
+
+    response = await api.get("/donors", headers=headers)
+    assert len(response.json()) == DEFAULT_PAGE_SIZE
+    assert response.headers.get("X-Next-Cursor")
+
+
+async def test_bad_cursor_is_rejected(server, api):
+    headers = await register(api, "hospital", "hospital@example.com")
+    response = await api.get("/donors", headers=headers, params={"cursor": "not-a-cursor"})
+    assert response.status_code == 400
+
+
+async def test_unchanged_page_is_not_modified(server, api):
+    await seed_donors(server, 3)
+    hospital = await register(api, "hospital", "hospital@example.com")
+
+    first = await api.get("/donors", headers=hospital)
+    etag = first.headers["ETag"]
+    again = await api.get("/donors", headers={**hospital, "If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.headers["ETag"] == etag
+
+    donor = await register(api, "donor", "donor@example.com")
+    created = await api.post("/donors", headers=donor, json={"blood_type": "A+", "age": 30, "organs_available": ["liver"]})
+    assert created.status_code == 200
+
+    changed = await api.get("/donors", headers={**hospital, "If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert len(changed.json()) == 4
+
+
+async def test_stream_returns_every_donor_after_the_cursor(server, api):
+    await seed_donors(server, 12)
+    headers = await register(api, "hospital", "hospital@example.com")
+
+    first = await api.get("/donors", headers=headers, params={"limit": 5})
+    response = await api.get("/donors", headers=headers, params={"stream": "true", "cursor": first.headers["X-Next-Cursor"]})
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row["id"] for row in rows] == [f"donor-{i:04d}" for i in range(5, 12)]
+
+
+async def test_bad_cursor_is_rejected_before_streaming(server, api):
+    headers = await register(api, "hospital", "hospital@example.com")
+    response = await api.get("/donors", headers=headers, params={"stream": "true", "cursor": "garbage"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid cursor"
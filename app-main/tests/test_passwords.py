@@ -0,0 +1,53 @@
+import asyncio
+import threading
+
+import pytest
+
+from passwords import PasswordHasher, PasswordPoolFull
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_hash_and_verify_run_in_the_pool():
+    hasher = PasswordHasher(workers=2)
+    try:
+        hashed = await hasher.hash("secret")
+        assert await hasher.verify("secret", hashed)
+        assert not await hasher.verify("wrong", hashed)
+        assert hasher.stats()["completed"] == 3
+    finally:
+        hasher.shutdown()
+
+
+async def test_saturated_pool_rejects_at_once():
+    hasher = PasswordHasher(workers=1, queue_size=1)
+    release = threading.Event()
+    try:
+        running = [asyncio.create_task(hasher._run(release.wait)) for _ in range(hasher.capacity)]
+        await asyncio.sleep(0)
+        assert hasher.stats()["in_flight"] == 1 and hasher.stats()["queue_depth"] == 1
+
+        with pytest.raises(PasswordPoolFull) as rejected:
+            await hasher.hash("secret")
+        assert rejected.value.retry_after >= 1
+        assert hasher.stats()["rejected"] == 1
+
+        release.set()
+        await asyncio.gather(*running)
+        assert await hasher.verify("secret", await hasher.hash("secret"))
+    finally:
+        release.set()
+        hasher.shutdown()
+
+
+async def test_saturated_pool_answers_503_with_retry_after(server, api):
+    server.password_hasher.pending = server.password_hasher.capacity
+    try:
+        response = await api.post("/auth/register", json={
+            "email": "donor@example.com", "password": "secret", "name": "Donor", "role": "donor"
+        })
+    finally:
+        server.password_hasher.pending = 0
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+    assert response.json()["detail"] == "Authentication is busy, please retry shortly"
@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+from principals import PrincipalCache
+
+pytestmark = pytest.mark.anyio
+
+
+class Users:
+    """A loader over a dict of users, counting calls and optionally held until released"""
+
+    def __init__(self, **users):
+        self.users = users
+        self.calls = 0
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def __call__(self, user_id: str):
+        self.calls += 1
+        found = self.users.get(user_id)
+        await self.release.wait()
+        return dict(found) if found else None
+
+
+async def calls(users: Users, count: int):
+    """Let the loop run until the loader was called count times, or a while"""
+    for _ in range(100):
+        if users.calls >= count:
+            return
+        await asyncio.sleep(0)
+
+
+async def test_concurrent_misses_share_one_load():
+    cache, users = PrincipalCache(), Users(u1={"id": "u1", "role": "hospital"})
+    results = await asyncio.gather(*(cache.get_or_load("u1", users) for _ in range(4)))
+    assert users.calls == 1
+    assert all(result == {"id": "u1", "role": "hospital"} for result in results)
+
+    assert await cache.get_or_load("u1", users) == {"id": "u1", "role": "hospital"}
+    assert (users.calls, cache.hits) == (1, 1)
+
+
+async def test_entries_expire_and_are_evicted():
+    cache, users = PrincipalCache(maxsize=2, ttl=0.05), Users(u1={"id": "u1"}, u2={"id": "u2"}, u3={"id": "u3"})
+    for user_id in ("u1", "u2", "u3"):
+        await cache.get_or_load(user_id, users)
+    assert cache.get("u1") is None
+    assert cache.get("u3") == {"id": "u3"}
+
+    await asyncio.sleep(0.06)
+    assert cache.get("u3") is None
+
+
+async def test_missing_users_are_not_cached():
+    cache, users = PrincipalCache(), Users()
+    assert await cache.get_or_load("u1", users) is None
+    users.users["u1"] = {"id": "u1"}
+    assert await cache.get_or_load("u1", users) == {"id": "u1"}
+
+
+async def test_invalidate_during_a_load_discards_its_result():
+    cache, users = PrincipalCache(), Users(u1={"id": "u1", "role": "donor"})
+    users.release.clear()
+    stale = asyncio.ensure_future(cache.get_or_load("u1", users))
+    await calls(users, 1)
+
+    # The user is written while the first load is waiting on the database
+    users.users["u1"] = {"id": "u1", "role": "hospital"}
+    cache.invalidate("u1")
+    fresh = asyncio.ensure_future(cache.get_or_load("u1", users))
+    await calls(users, 2)
+    users.release.set()
+
+    assert (await stale)["role"] == "donor"
+    assert (await fresh)["role"] == "hospital"
+    assert cache.get("u1") == {"id": "u1", "role": "hospital"}
+    assert users.calls == 2
+
+
+async def test_user_writes_invalidate_the_principal(server, api):
+    response = await api.post("/auth/register", json={"email": "h@example.com", "password": "secret", "name": "H", "role": "hospital"})
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    user_id = response.json()["user"]["id"]
+    assert (await api.get("/auth/me", headers=headers)).json()["name"] == "H"
+
+    await server.db.users.update_one({"id": user_id}, {"$set": {"name": "Renamed"}})
+    server.users_written([user_id])
+    assert (await api.get("/auth/me", headers=headers)).json()["name"] == "Renamed"
@@ -0,0 +1,56 @@
+import io
+
+import pandas as pd
+import pytest
+
+from codec import parse_date
+from tests.conftest import register
+
+pytestmark = pytest.mark.anyio
+
+ROWS = [
+    ("ada@example.com", "Ada", "O-", "34", "kidney;liver", "none"),
+    ("ben@example.com", "Ben", "AB+", "51", "heart", ""),
+    ("cy@example.com", "Cy", "A-", "29", "kidney", "asthma"),
+]
+
+
+def donors_csv(rows) -> bytes:
+    lines = ["email,name,blood_type,age,organs_available,medical_history"]
+    lines += [",".join(row) for row in rows]
+    return "\n".join(lines).encode()
+
+
+async def test_csv_round_trip(server, api):
+    hospital = await register(api, "hospital", "hospital@example.com")
+
+    bad = ("dee@example.com", "Dee", "O-", "not-a-number", "kidney", "")
+    response = await api.post("/registry/donors/import", headers=hospital, files={"file": ("donors.csv", donors_csv([*ROWS, bad]))})
+    assert response.status_code == 200, response.text
+    report = response.json()
+    assert (report["rows"], report["imported"], report["failed"]) == (4, 3, 1)
+    assert report["errors"][0]["row"] == 4
+
+    response = await api.get("/registry/donors/export", headers=hospital, params={"format": "csv"})
+    assert response.status_code == 200
+    exported = pd.read_csv(io.BytesIO(response.content), dtype=str, keep_default_na=False)
+    assert len(exported) == 3
+
+    users = {user["id"]: user["email"] async for user in server.db.users.find({}, {"id": 1, "email": 1})}
+    by_email = {users[row["user_id"]]: row for row in exported.to_dict("records")}
+    for email, _, blood_type, age, organs, history in ROWS:
+        row = by_email[email]
+        assert (row["blood_type"], row["age"], row["organs_available"], row["medical_history"]) == (blood_type, age, organs, history)
+        assert row["status"] == "available"
+        assert row["created_at"].endswith("Z")
+        assert parse_date(row["created_at"]).utcoffset().total_seconds() == 0
+
+    # Importing the export again is rejected row by row rather than duplicating donors
+    again = exported.rename(columns={"user_id": "email"})
+    again["email"] = [users[user_id] for user_id in exported["user_id"]]
+    again["name"] = "Again"
+    response = await api.post("/registry/donors/import", headers=hospital, files={"file": ("again.csv", again.to_csv(index=False).encode())})
+    report = response.json()
+    assert report["imported"] == 0 and report["failed"] == 3
+    assert {error["detail"] for error in report["errors"]} == {"Email already registered"}
+    assert await server.db.donor_profiles.count_documents({}) == 3
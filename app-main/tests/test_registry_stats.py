@@ -0,0 +1,59 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+import storage
+from registry_stats import RegistryStats, profile_keys
+from tests.conftest import register
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_counters_match_a_recount(server, api):
+    hospital = await register(api, "hospital", "hospital@example.com")
+    donors = []
+    for i, blood_type in enumerate(["O-", "O-", "A+"]):
+        headers = await register(api, "donor", f"donor{i}@example.com")
+        donors.append((await api.post("/donors", headers=headers, json={"blood_type": blood_type, "age": 30, "organs_available": ["kidney"]})).json())
+    recipient = await register(api, "recipient", "recipient@example.com")
+    recipient_id = (await api.post("/recipients", headers=recipient, json={
+        "blood_type": "A+", "age": 45, "organs_needed": ["kidney"], "urgency_level": "critical"
+    })).json()["id"]
+    match = (await api.post("/matches", headers=hospital, json={"donor_id": donors[0]["id"], "recipient_id": recipient_id, "organ_type": "kidney"})).json()
+    await api.put(f"/matches/{match['id']}/status", headers=hospital, json={"status": "accepted"})
+
+    # Unflushed deltas count too
+    summary = (await api.get("/stats", headers=hospital)).json()
+    assert summary["donors"]["total"] == 3
+    assert summary["donors"]["by_status"] == {"available": 2, "matched": 1}
+    assert summary["recipients"]["urgency"] == {"critical": {"matched": 1}}
+    assert summary["matches"]["by_status"] == {"accepted": 1}
+
+    await server.registry_stats.flush()
+    assert await server.registry_stats.reconcile() == 0
+    recounted = (await api.get("/stats", headers=hospital)).json()
+    assert {**recounted, "reconciled_at": None} == {**summary, "reconciled_at": None}
+
+
+async def test_deltas_a_recount_included_are_dropped():
+    _, db = storage.connect("memory")
+    writer, reconciler = RegistryStats(db), RegistryStats(db)
+    donor = {"id": "d1", "user_id": "u1", "blood_type": "O-", "organs_available": ["kidney"], "status": "available",
+             "created_at": datetime.now(timezone.utc)}
+
+    await db.donor_profiles.insert_one(dict(donor))
+    writer.profile_changed("donor", None, donor)
+    # The recount starts after the write's second, so it includes the write
+    await asyncio.sleep(1.1)
+    await reconciler.reconcile()
+    await writer.flush()
+    assert writer.dropped == len(profile_keys("donor", donor))
+    assert (await reconciler.summary())["donors"]["total"] == 1
+
+    second = {**donor, "id": "d2"}
+    await db.donor_profiles.insert_one(dict(second))
+    writer.profile_changed("donor", None, second)
+    await writer.flush()
+    assert (await reconciler.summary())["donors"]["total"] == 2
+    assert await reconciler.reconcile() == 0
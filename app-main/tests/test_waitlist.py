@@ -0,0 +1,103 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from compatibility import BLOOD_COMPATIBILITY, BLOOD_TYPES, URGENCY_LEVELS, CompatibilityIndex, compatibility_score
+from tests.conftest import register
+from waitlist import WaitlistQueues, urgency_rank
+
+pytestmark = pytest.mark.anyio
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+ORGANS = ["kidney", "liver", "heart"]
+
+
+def recipient(id: str, blood_type: str, organs: list, urgency: str, days_waiting: int) -> dict:
+    return {
+        "id": id, "user_id": f"user-{id}", "blood_type": blood_type, "age": 40, "organs_needed": organs,
+        "urgency_level": urgency, "status": "waiting", "created_at": START - timedelta(days=days_waiting)
+    }
+
+
+def queues(*recipients: dict) -> tuple:
+    index = CompatibilityIndex()
+    waitlist = WaitlistQueues(index)
+    for profile in recipients:
+        index.put_recipient(profile)
+    return index, waitlist
+
+
+def ranked(donor: dict, recipients: list) -> list:
+    """Compatible recipient ids by urgency, time waiting, blood type score, id: a full sort"""
+    compatible = [
+        r for r in recipients
+        if r["blood_type"] in BLOOD_COMPATIBILITY[donor["blood_type"]] and set(r["organs_needed"]) & set(donor["organs_available"])
+    ]
+    compatible.sort(key=lambda r: (
+        -urgency_rank(r["urgency_level"]), r["created_at"], -compatibility_score(donor["blood_type"], r["blood_type"]), r["id"]
+    ))
+    return [r["id"] for r in compatible]
+
+
+def test_priority_is_urgency_then_waiting_time_then_score():
+    donor = {"blood_type": "O-", "organs_available": ["kidney"]}
+    _, waitlist = queues(
+        recipient("low-long", "O-", ["kidney"], "low", 900),
+        recipient("critical-new", "A+", ["kidney"], "critical", 1),
+        recipient("critical-old", "A+", ["kidney"], "critical", 30),
+        recipient("same-wait-exact", "O-", ["kidney"], "high", 10),
+        recipient("same-wait-other", "B+", ["kidney"], "high", 10),
+    )
+    found = waitlist.top_recipients(donor)
+    assert [r["id"] for r in found] == ["critical-old", "critical-new", "same-wait-exact", "same-wait-other", "low-long"]
+    assert waitlist.top_recipients(donor, limit=2) == found[:2]
+
+
+def test_recipient_needing_several_organs_appears_once():
+    _, waitlist = queues(recipient("both", "A+", ["liver", "kidney"], "high", 5))
+    found = waitlist.top_recipients({"blood_type": "O-", "organs_available": ["kidney", "liver", "heart"]})
+    assert [(r["id"], r["matching_organs"]) for r in found] == [("both", ["kidney", "liver"])]
+
+
+def test_queues_follow_index_changes():
+    first = recipient("first", "A+", ["kidney"], "low", 5)
+    second = recipient("second", "A+", ["kidney"], "medium", 5)
+    index, waitlist = queues(first, second)
+    donor = {"blood_type": "O-", "organs_available": ["kidney"]}
+    assert [r["id"] for r in waitlist.top_recipients(donor)] == ["second", "first"]
+
+    index.put_recipient({**first, "urgency_level": "critical"})
+    assert [r["id"] for r in waitlist.top_recipients(donor)] == ["first", "second"]
+    index.put_recipient({**second, "status": "matched"})
+    assert [r["id"] for r in waitlist.top_recipients(donor)] == ["first"]
+
+
+@pytest.mark.parametrize("seed", range(8))
+def test_top_k_matches_a_full_sort(seed):
+    rng = random.Random(seed)
+    recipients = [
+        recipient(f"r{i:03d}", rng.choice(BLOOD_TYPES), rng.sample(ORGANS, rng.randint(1, 2)),
+                  rng.choice(URGENCY_LEVELS), rng.randint(0, 30))
+        for i in range(120)
+    ]
+    _, waitlist = queues(*recipients)
+    for _ in range(5):
+        donor = {"blood_type": rng.choice(BLOOD_TYPES), "organs_available": rng.sample(ORGANS, rng.randint(1, 3))}
+        expected = ranked(donor, recipients)
+        assert [r["id"] for r in waitlist.top_recipients(donor)] == expected
+        for limit in (1, 5, 40):
+            assert [r["id"] for r in waitlist.top_recipients(donor, limit)] == expected[:limit]
+
+
+async def test_donor_sees_the_top_recipients(server, api):
+    for index, urgency in enumerate(["low", "critical", "medium"]):
+        headers = await register(api, "recipient", f"recipient{index}@example.com")
+        await api.post("/recipients", headers=headers, json={
+            "blood_type": "A+", "age": 40, "organs_needed": ["kidney"], "urgency_level": urgency
+        })
+    donor = await register(api, "donor", "donor@example.com")
+    await api.post("/donors", headers=donor, json={"blood_type": "O-", "age": 35, "organs_available": ["kidney"]})
+
+    response = await api.get("/matches/potential", headers=donor, params={"limit": 2})
+    assert [r["urgency_level"] for r in response.json()] == ["critical", "medium"]